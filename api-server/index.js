@@ -1,6 +1,10 @@
 // api-server@yealink-provision - Yealink Provisioning Server
 // Cameron Fleming 2023
 
+// Instrumentation must be imported before anything that loads the mongoose schemas.
+import './lib/instrumentation.js';
+import { registry, track_requests, route_prefix, metrics_handler } from '../shared/metrics.js';
+
 import winston from 'winston';
 import mongoose from 'mongoose';
 import express from 'express';
@@ -15,10 +19,21 @@ const nanoid = customAlphabet('1234567890abcdef', 8);
 // Import express routers
 import sitesRouter from './routes/sites.js';
 import modelsRouter from './routes/models.js';
-import deviceRouter from './routes/devices.js';
-import {fetchRouter, fetchEmitter} from './routes/fetch.js';
-import configRouter from './routes/config.js';
+import deviceRouter, { deviceEmitter } from './routes/devices.js';
+import {fetchRouter, fetchEmitter, invalidate_known_macs} from './routes/fetch.js';
+import configRouter, { configEmitter } from './routes/config.js';
 import virtualDeviceRouter from './routes/virtual_device.js';
+import auditRouter from './routes/audit.js';
+import specRouter from './routes/spec.js';
+import accessRulesRouter from './routes/access_rules.js';
+import versionsRouter from './routes/versions.js';
+
+import { auditSink, audit_entry_from_fetch } from './lib/audit.js';
+import { auditStream } from './lib/audit_stream.js';
+import { run, relay, on_shutdown } from '../shared/cluster.js';
+import { layerCache } from './lib/layer_cache.js';
+import { deviceLayerHashes } from './lib/config_versions.js';
+import { accessControl, accessControlEmitter } from './lib/access_control.js';
 
 // Setup Winston logger
 const logger = winston.createLogger({
@@ -37,6 +52,13 @@ const logger = winston.createLogger({
 
 export { logger };
 
+// Metrics for the caches and audit sink, copied from their stats when metrics are collected.
+const layer_cache_requests = registry.counter('layer_cache_requests_total', 'Compiled layer cache lookups, by hit or miss.', ['result']);
+const layer_cache_entries = registry.gauge('layer_cache_entries', 'Layers currently in the compiled layer cache.');
+const audit_entries = registry.counter('audit_entries_total', 'Audit entries written to, or dropped by, the audit sink.', ['state']);
+const audit_entries_buffered = registry.gauge('audit_entries_buffered', 'Audit entries waiting to be written.');
+const audit_stream_clients = registry.gauge('audit_stream_clients', 'Clients connected to the audit stream.');
+
 // Setup MongoDB with mongoose
 
 const main = async () => {
@@ -47,45 +69,87 @@ const main = async () => {
   });
   logger.info("Connected to MongoDB.");
 
+  // Access rules are checked in memory on every fetch, so load them before accepting requests.
+  await accessControl.load();
+
   // Setup Express
   const app = express();
   app.use(cors());
-  app.use(express.json());
+  // Whole configuration trees can be sent in one request, so allow larger bodies than the default.
+  app.use(express.json({ limit: process.env.JSON_BODY_LIMIT || '10mb' }));
+
+  // Setup metrics
+  app.use(track_requests);
+  app.get('/metrics', metrics_handler);
+
+  registry.collect(() => {
+    const layer_cache = layerCache.status();
+    layer_cache_requests.set({ result: 'hit' }, layer_cache.hits);
+    layer_cache_requests.set({ result: 'miss' }, layer_cache.misses);
+    layer_cache_entries.set({}, layer_cache.entries);
+
+    const audit = auditSink.status();
+    audit_entries.set({ state: 'written' }, audit.written);
+    audit_entries.set({ state: 'dropped' }, audit.dropped);
+    audit_entries_buffered.set({}, audit.buffered);
+
+    // Audit stream connections are left out of the request metrics (they stay open), and counted here instead.
+    audit_stream_clients.set({}, auditStream.status().clients);
+  });
 
   // Setup routes
-  app.use('/sites', sitesRouter);
-  app.use('/models', modelsRouter);
-  app.use('/sites/:site/devices', deviceRouter);
-  app.use('/sites/:site/virtual_devices', virtualDeviceRouter);
-  app.use('/:target_type/:target_id/config', configRouter)
-  app.use('/fetch', fetchRouter);
-
-  // Capture events from fetchEmitter
-  // fetchEmitter.on('audit_device_fetch', async (device, result) => {
-  //   logger.info("Device fetch audit event: " + device.mac_address);
-  //   await io.emit('audit_device_fetch', device.mac_address);
-
-  //   // Add new audit log entry.
-  //   await FetchAudit.create({
-  //     id: nanoid(8),
-  //     type: "device_specific",
-  //     device_id: device.id,
-  //     success: result.result == 'success',
-  //     state_string: result.reason || "N/A",
-  //     remark: result.message || "N/A",
-  //   });
-  // });
+  const routes = [
+    ['/sites', sitesRouter],
+    ['/models', modelsRouter],
+    ['/models/:model_id/spec', specRouter],
+    ['/sites/:site/devices', deviceRouter],
+    ['/sites/:site/virtual_devices', virtualDeviceRouter],
+    ['/:target_type/:target_id/config', configRouter],
+    ['/:target_type/:target_id/versions', versionsRouter],
+    ['/:target_type/:target_id/access_rules', accessRulesRouter],
+    ['/fetch', fetchRouter],
+    ['/audit', auditRouter],
+  ];
+
+  for (const [path, router] of routes) {
+    app.use(path, route_prefix(path), router);
+  }
+
+  // Capture events from fetchEmitter, these are streamed to any watching clients, and buffered by the audit sink
+  // and written in batches so the fetch path never waits on the audit log.
+  auditSink.start();
+  fetchEmitter.on('audit_device_fetch', (device, result) => {
+    logger.debug("Device fetch audit event: " + device.mac_address);
+    const entry = audit_entry_from_fetch(device, result);
+    auditStream.publish(entry);
+    auditSink.push(entry);
+  });
+
+  // Flush any buffered audit entries before exiting.
+  on_shutdown(() => auditSink.close());
+
+  // Configuration, access rule and device changes invalidate caches in every worker when clustered.
+  relay(configEmitter, 'config_changed');
+  configEmitter.on('config_changed', (change) => {
+    layerCache.invalidate(change.target_type, change.target_id);
+    deviceLayerHashes.invalidate(change.target_type, change.target_id);
+  });
+  relay(accessControlEmitter, 'access_rules_changed');
+  relay(deviceEmitter, 'devices_changed');
+  deviceEmitter.on('devices_changed', () => invalidate_known_macs());
 
   // Start Express
   app.listen(process.env.HTTP_PORT || 3000, () => {
-    logger.info("yealink-provision api-server listening on port " + (process.env.HTTP_PORT || 3000));
+    logger.info(`yealink-provision api-server (pid ${process.pid}) listening on port ` + (process.env.HTTP_PORT || 3000));
   });
 
   // Setup Socket.IO server
-  const io = new Server();
+  // Only the websocket transport is used, long-polling needs every request from a client to reach the same worker,
+  // which isn't the case when clustered.
+  const io = new Server({ transports: ['websocket'] });
   io.listen(process.env.WS_PORT || 3001, () => {
     logger.info("yealink-provision api-server listening for websocket connections on port " + (process.env.WS_PORT || 3001));
   });
 }
 
-main();
\ No newline at end of file
+run(main, logger);
\ No newline at end of file
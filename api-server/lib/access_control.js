@@ -0,0 +1,264 @@
+// yealink-provision - Access Control (IP locking and provisioning windows)
+// Cameron Fleming 2023
+
+// Access rules (mongo/schemas/access_rule.js) are compiled into memory, so checking them on the fetch path
+// doesn't need any database queries:
+// - CIDR allowlists become a binary prefix trie per target, an address is checked by walking at most 32 (IPv4)
+//   or 128 (IPv6) bits.
+// - Provisioning windows become a sorted list of [start, end) minutes of the week in UTC.
+
+// All enabled rules are loaded at startup. When rules on a target change, accessControlEmitter emits
+// 'access_rules_changed' (relayed between workers in cluster mode) and only that target is recompiled.
+
+import net from 'net';
+import { EventEmitter } from 'events';
+
+import { AccessRule } from '../mongo/schemas/access_rule.js';
+import { logger } from '../index.js';
+
+export const accessControlEmitter = new EventEmitter();
+
+const MINUTES_PER_DAY = 1440;
+const MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY;
+
+// Parse an IP address into its bytes (4 for IPv4, 16 for IPv6), or null if it's not valid.
+// IPv4-mapped IPv6 addresses (::ffff:192.0.2.1) are treated as IPv4.
+export const parse_ip = (address) => {
+  if (!address) return null;
+
+  const mapped = address.match(/^::ffff:([0-9.]+)$/i);
+  if (mapped) address = mapped[1];
+
+  const version = net.isIP(address);
+  if (version == 4) {
+    return Uint8Array.from(address.split('.').map((octet) => parseInt(octet)));
+  }
+
+  if (version != 6) return null;
+
+  // Expand "::" and any trailing dotted IPv4 part into eight 16-bit groups.
+  let [head, tail] = address.split('::');
+  const to_groups = (part) => {
+    if (!part) return [];
+
+    const groups = [];
+    for (const item of part.split(':')) {
+      if (item.includes('.')) {
+        const octets = item.split('.').map((octet) => parseInt(octet));
+        groups.push((octets[0] << 8) | octets[1], (octets[2] << 8) | octets[3]);
+      } else {
+        groups.push(parseInt(item, 16));
+      }
+    }
+    return groups;
+  }
+
+  const head_groups = to_groups(head);
+  const tail_groups = to_groups(tail);
+  const groups = tail === undefined
+    ? head_groups
+    : [...head_groups, ...new Array(8 - head_groups.length - tail_groups.length).fill(0), ...tail_groups];
+
+  const bytes = new Uint8Array(16);
+  groups.forEach((group, i) => {
+    bytes[i * 2] = group >> 8;
+    bytes[i * 2 + 1] = group & 0xff;
+  });
+
+  return bytes;
+}
+
+// Parse "address/prefix" into { bytes, prefix }, or null if it's not valid.
+export const parse_cidr = (cidr) => {
+  const [address, prefix_string] = String(cidr).split('/');
+  const bytes = parse_ip(address);
+  if (!bytes) return null;
+
+  const max_prefix = bytes.length * 8;
+  const prefix = prefix_string === undefined ? max_prefix : parseInt(prefix_string);
+  if (!/^[0-9]*$/.test(prefix_string || '') || isNaN(prefix) || prefix < 0 || prefix > max_prefix) return null;
+
+  return { bytes: bytes, prefix: prefix };
+}
+
+const bit = (bytes, i) => (bytes[i >> 3] >> (7 - (i & 7))) & 1;
+
+// Binary prefix trie, matching an address against any number of prefixes in O(address bits).
+export class PrefixTrie {
+  constructor() {
+    this.root = { children: [null, null], terminal: false };
+  }
+
+  insert(bytes, prefix) {
+    let node = this.root;
+    for (let i = 0; i < prefix; i++) {
+      const b = bit(bytes, i);
+      if (!node.children[b]) node.children[b] = { children: [null, null], terminal: false };
+      node = node.children[b];
+    }
+    node.terminal = true;
+  }
+
+  // True if the address is inside any of the prefixes.
+  matches(bytes) {
+    let node = this.root;
+    for (let i = 0; node; i++) {
+      if (node.terminal) return true;
+      if (i >= bytes.length * 8) return false;
+      node = node.children[bit(bytes, i)];
+    }
+    return false;
+  }
+}
+
+// Parse "HH:MM" into minutes since midnight, or null if it's not valid.
+export const parse_time = (time) => {
+  const match = String(time).match(/^([01]?[0-9]|2[0-3]):([0-5][0-9])$/);
+  if (!match) return null;
+
+  return parseInt(match[1]) * 60 + parseInt(match[2]);
+}
+
+// Convert a window rule into [start, end) intervals of minutes of the week in UTC.
+const window_intervals = (rule) => {
+  const start = parse_time(rule.start);
+  let end = parse_time(rule.end);
+  if (end <= start) end += MINUTES_PER_DAY;
+
+  const intervals = [];
+  for (const day of rule.days) {
+    // Shift into UTC and wrap into the week, splitting intervals that wrap past the end of the week.
+    const from = (((day * MINUTES_PER_DAY + start - (rule.utc_offset || 0)) % MINUTES_PER_WEEK) + MINUTES_PER_WEEK) % MINUTES_PER_WEEK;
+    const to = from + (end - start);
+
+    if (to <= MINUTES_PER_WEEK) {
+      intervals.push([from, to]);
+    } else {
+      intervals.push([from, MINUTES_PER_WEEK], [0, to - MINUTES_PER_WEEK]);
+    }
+  }
+
+  return intervals.sort((a, b) => a[0] - b[0]);
+}
+
+// Check a rule from a request is valid, returns an error message or null.
+export const validate_rule = (rule) => {
+  if (rule.type == 'cidr') {
+    if (!parse_cidr(rule.cidr)) return "cidr must be a valid IPv4 or IPv6 CIDR, i.e., 203.0.113.0/24.";
+    return null;
+  }
+
+  if (rule.type == 'window') {
+    if (!Array.isArray(rule.days) || rule.days.length == 0 || !rule.days.every((day) => Number.isInteger(day) && day >= 0 && day <= 6)) {
+      return "days must be a list of days of the week, 0 (Sunday) to 6 (Saturday).";
+    }
+    if (parse_time(rule.start) === null || parse_time(rule.end) === null) return "start and end must be times, HH:MM.";
+    if (rule.utc_offset !== undefined && !Number.isInteger(rule.utc_offset)) return "utc_offset must be a number of minutes.";
+    return null;
+  }
+
+  return "type must be one of cidr or window.";
+}
+
+// Compile the rules for one target.
+const compile_rules = (rules) => {
+  const compiled = { v4: null, v6: null, windows: null };
+
+  for (const rule of rules) {
+    if (rule.type == 'cidr') {
+      const cidr = parse_cidr(rule.cidr);
+      if (!cidr) continue;
+
+      const family = cidr.bytes.length == 4 ? 'v4' : 'v6';
+      if (!compiled[family]) compiled[family] = new PrefixTrie();
+      compiled[family].insert(cidr.bytes, cidr.prefix);
+    } else if (rule.type == 'window') {
+      compiled.windows = (compiled.windows || []).concat(window_intervals(rule));
+    }
+  }
+
+  return compiled;
+}
+
+export class AccessControl {
+  constructor() {
+    this.targets = new Map();
+  }
+
+  key(target_type, target_id) {
+    return `${target_type}/${target_id}`;
+  }
+
+  // Load and compile every enabled rule.
+  async load() {
+    const rules = await AccessRule.find({ enable: true }).lean();
+
+    const by_target = new Map();
+    for (const rule of rules) {
+      const key = this.key(rule.target_type, rule.target_id);
+      if (!by_target.has(key)) by_target.set(key, []);
+      by_target.get(key).push(rule);
+    }
+
+    this.targets = new Map([...by_target].map(([key, target_rules]) => [key, compile_rules(target_rules)]));
+    logger.info(`access_control: loaded ${rules.length} access rules for ${this.targets.size} targets.`);
+  }
+
+  // Recompile the rules for a single target, after they've changed.
+  async reload(target_type, target_id) {
+    const rules = await AccessRule.find({ target_type: target_type, target_id: target_id, enable: true }).lean();
+    const key = this.key(target_type, target_id);
+
+    if (rules.length > 0) {
+      this.targets.set(key, compile_rules(rules));
+    } else {
+      this.targets.delete(key);
+    }
+
+    logger.debug(`access_control: reloaded ${rules.length} access rules for ${key}.`);
+  }
+
+  check_target(target_type, target_id, ip_bytes, minute_of_week) {
+    const compiled = this.targets.get(this.key(target_type, target_id));
+    if (!compiled) return null;
+
+    if (compiled.v4 || compiled.v6) {
+      const trie = ip_bytes ? compiled[ip_bytes.length == 4 ? 'v4' : 'v6'] : null;
+      if (!trie || !trie.matches(ip_bytes)) {
+        return {
+          reason: 'ip_not_allowed',
+          message: `Attempt to fetch configuration from an address not allowed by the ${target_type}.`,
+        };
+      }
+    }
+
+    if (compiled.windows && !compiled.windows.some(([start, end]) => minute_of_week >= start && minute_of_week < end)) {
+      return {
+        reason: 'outside_provisioning_window',
+        message: `Attempt to fetch configuration outside of the ${target_type}'s provisioning windows.`,
+      };
+    }
+
+    return null;
+  }
+
+  // Check a device can fetch its configuration from this address now.
+  // Returns null if it can, or { reason, message } if it can't.
+  check(site_id, device_id, address, now = new Date()) {
+    if (this.targets.size == 0) return null;
+
+    const ip_bytes = parse_ip(address);
+    const minute_of_week = now.getUTCDay() * MINUTES_PER_DAY + now.getUTCHours() * 60 + now.getUTCMinutes();
+
+    return this.check_target('site', site_id, ip_bytes, minute_of_week)
+      || this.check_target('device', device_id, ip_bytes, minute_of_week);
+  }
+}
+
+export const accessControl = new AccessControl();
+
+accessControlEmitter.on('access_rules_changed', (change) => {
+  accessControl.reload(change.target_type, change.target_id).catch((err) => {
+    logger.error(`access_control: failed to reload access rules for ${change.target_type}/${change.target_id}: ${err}`);
+  });
+});
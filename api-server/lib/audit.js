@@ -0,0 +1,145 @@
+// yealink-provision - Audit Sink
+// Cameron Fleming 2023
+
+// The audit sink takes audit events off the fetch path and writes them to MongoDB in batches.
+// Pushing an event only appends it to an in-memory buffer, it never waits on the database.
+// The buffer is flushed with a single insertMany when it reaches batch_size, or every flush_interval ms.
+
+// Memory use is bounded by max_buffer. Once the buffer is full new events are dropped (and counted),
+// so an unavailable database never slows down fetches or grows the buffer without limit.
+
+// A batch that fails may have been partly written. Only the entries that failed are retried, and entry IDs are
+// unique (see mongo/schemas/fetch_audit.js), so retrying an entry that was written after all is a duplicate key
+// error that's ignored rather than a second copy.
+
+import { customAlphabet } from 'nanoid';
+
+import { FetchAudit } from '../mongo/schemas/fetch_audit.js';
+import { logger } from '../index.js';
+
+// Setup nanoid, audit entry IDs are unique across every entry ever written, so they're longer than other IDs.
+const nanoid = customAlphabet('1234567890abcdef', 16);
+
+const DUPLICATE_KEY = 11000;
+
+export class AuditSink {
+  constructor(model, options = {}) {
+    this.model = model;
+    this.batch_size = options.batch_size || 500;
+    this.flush_interval = options.flush_interval || 1000;
+    this.max_buffer = options.max_buffer || 10000;
+
+    this.buffer = [];
+    this.flushing = null;
+    this.timer = null;
+
+    this.stats = {
+      accepted: 0,
+      written: 0,
+      dropped: 0,
+      failed_batches: 0,
+    };
+  }
+
+  start() {
+    if (this.timer) return;
+
+    this.timer = setInterval(() => this.flush(), this.flush_interval);
+    this.timer.unref();
+  }
+
+  // Add an entry to the buffer, returns false if the entry was dropped.
+  push(entry) {
+    if (this.buffer.length >= this.max_buffer) {
+      this.stats.dropped++;
+      return false;
+    }
+
+    this.buffer.push(entry);
+    this.stats.accepted++;
+
+    if (this.buffer.length >= this.batch_size && !this.flushing) {
+      setImmediate(() => this.flush());
+    }
+
+    return true;
+  }
+
+  // Write everything in the buffer, one batch at a time. Only one flush runs at once,
+  // concurrent callers wait for the running flush.
+  flush() {
+    if (this.flushing) return this.flushing;
+
+    this.flushing = (async () => {
+      while (this.buffer.length > 0) {
+        const batch = this.buffer.splice(0, this.batch_size);
+
+        try {
+          await this.model.insertMany(batch, { ordered: false, lean: true });
+          this.stats.written += batch.length;
+        } catch (err) {
+          // With write errors, everything else in the batch was written. Without them (i.e., the connection
+          // failed) it's unknown what was written, so the whole batch is retried.
+          const failed = err.writeErrors
+            ? [].concat(err.writeErrors).filter((error) => error.code != DUPLICATE_KEY).map((error) => batch[error.index])
+            : batch;
+          this.stats.written += batch.length - failed.length;
+          if (failed.length == 0) continue;
+
+          // Put the failed entries back at the front of the buffer to be retried on the next flush,
+          // anything that no longer fits is dropped.
+          this.stats.failed_batches++;
+          const space = Math.max(this.max_buffer - this.buffer.length, 0);
+          this.stats.dropped += Math.max(failed.length - space, 0);
+          this.buffer.unshift(...failed.slice(0, space));
+
+          logger.error(`audit: failed to write ${failed.length} of a batch of ${batch.length} entries: ${err}`);
+          break;
+        }
+      }
+    })().finally(() => {
+      this.flushing = null;
+    });
+
+    return this.flushing;
+  }
+
+  async close() {
+    clearInterval(this.timer);
+    this.timer = null;
+    await this.flush();
+  }
+
+  status() {
+    return {
+      ...this.stats,
+      buffered: this.buffer.length,
+      max_buffer: this.max_buffer,
+      batch_size: this.batch_size,
+    };
+  }
+}
+
+export const auditSink = new AuditSink(FetchAudit, {
+  batch_size: parseInt(process.env.AUDIT_BATCH_SIZE) || undefined,
+  flush_interval: parseInt(process.env.AUDIT_FLUSH_INTERVAL) || undefined,
+  max_buffer: parseInt(process.env.AUDIT_MAX_BUFFER) || undefined,
+});
+
+// Convert an audit_device_fetch event from the fetch API into an audit entry.
+export const audit_entry_from_fetch = (device, result) => {
+  return {
+    id: nanoid(8),
+    type: 'device_specific',
+    device_id: device.id,
+    site_id: device.site_id,
+    mac_address: device.mac_address,
+    result: result.result,
+    reason: result.reason || "N/A",
+    message: result.message || "N/A",
+    source_ip: result.source_ip,
+    layers: result.layers,
+    duration_ms: result.duration_ms,
+    timestamp: new Date(),
+  };
+}
@@ -0,0 +1,166 @@
+// yealink-provision - Audit Stream
+// Cameron Fleming 2023
+
+// Streams audit entries to clients as they happen, as server-sent events (GET /audit/stream).
+// Each client can filter by site, MAC address and result, entries that don't match are never serialised for it.
+
+// Slow clients can't hold up the fetch path or grow memory without limit: while a client's socket isn't accepting
+// writes, entries are queued for it up to max_buffer, then dropped and counted. The count of dropped entries is sent
+// to the client as a "dropped" event once it catches up.
+
+// In cluster mode a fetch may be handled by a different worker to the one a client is connected to. Workers with
+// clients announce their interest to the others, and entries are only broadcast while another worker is interested,
+// so there's no cost when nobody is watching.
+
+import cluster from 'cluster';
+
+import { broadcast, subscribe } from '../../shared/cluster.js';
+
+const HEARTBEAT_INTERVAL = 15000;
+// Interest from other workers expires if it isn't announced again, in case the worker exits.
+const INTEREST_TTL = HEARTBEAT_INTERVAL * 3;
+
+export class AuditStream {
+  constructor(options = {}) {
+    this.max_buffer = options.max_buffer || 1000;
+
+    this.clients = new Set();
+    this.interest = new Map();
+    this.timer = null;
+    this.stats = { published: 0, sent: 0, dropped: 0 };
+
+    subscribe('audit_stream_interest', (message) => {
+      if (message.active) {
+        this.interest.set(message.pid, Date.now() + INTEREST_TTL);
+      } else {
+        this.interest.delete(message.pid);
+      }
+    });
+
+    subscribe('audit_stream_entry', (entry) => this.deliver(entry));
+  }
+
+  announce() {
+    broadcast('audit_stream_interest', { pid: process.pid, active: this.clients.size > 0 });
+  }
+
+  other_workers_interested() {
+    if (!cluster.isWorker || this.interest.size == 0) return false;
+
+    const now = Date.now();
+    for (const [pid, expires] of this.interest) {
+      if (expires < now) this.interest.delete(pid);
+    }
+
+    return this.interest.size > 0;
+  }
+
+  // Add a client, an Express response. filter is { site_id, mac_address, result }, unset fields match anything.
+  add(res, filter) {
+    const client = { res: res, filter: filter, queue: [], blocked: false, dropped: 0 };
+
+    res.writeHead(200, {
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache',
+      'Connection': 'keep-alive',
+      'X-Accel-Buffering': 'no',
+    });
+    res.write(': connected\n\n');
+
+    res.on('drain', () => this.drain(client));
+    res.on('close', () => {
+      this.clients.delete(client);
+      if (this.clients.size == 0) this.stop();
+    });
+
+    this.clients.add(client);
+    if (this.clients.size == 1) this.start();
+  }
+
+  // Heartbeats keep idle connections open through proxies, and re-announce interest to the other workers.
+  start() {
+    this.announce();
+
+    this.timer = setInterval(() => {
+      for (const client of this.clients) {
+        this.write(client, ': heartbeat\n\n');
+      }
+      this.announce();
+    }, HEARTBEAT_INTERVAL);
+    this.timer.unref();
+  }
+
+  stop() {
+    clearInterval(this.timer);
+    this.timer = null;
+    this.announce();
+  }
+
+  matches(filter, entry) {
+    return (!filter.site_id || filter.site_id == entry.site_id)
+      && (!filter.mac_address || filter.mac_address == entry.mac_address)
+      && (!filter.result || filter.result == entry.result);
+  }
+
+  // Publish an entry from this worker.
+  publish(entry) {
+    const remote = this.other_workers_interested();
+    if (this.clients.size == 0 && !remote) return;
+
+    this.stats.published++;
+    this.deliver(entry);
+    if (remote) broadcast('audit_stream_entry', entry);
+  }
+
+  // Send an entry to the matching clients on this worker, serialised once however many clients match.
+  deliver(entry) {
+    let message = null;
+
+    for (const client of this.clients) {
+      if (!this.matches(client.filter, entry)) continue;
+
+      message = message || `event: audit\ndata: ${JSON.stringify(entry)}\n\n`;
+      this.write(client, message);
+    }
+  }
+
+  write(client, message) {
+    if (client.blocked) {
+      if (client.queue.length >= this.max_buffer) {
+        client.dropped++;
+        this.stats.dropped++;
+        return;
+      }
+
+      client.queue.push(message);
+      return;
+    }
+
+    this.stats.sent++;
+    client.blocked = !client.res.write(message);
+  }
+
+  // The client's socket is accepting writes again, send what's queued and how many entries were dropped.
+  drain(client) {
+    client.blocked = false;
+
+    if (client.dropped > 0) {
+      const dropped = client.dropped;
+      client.dropped = 0;
+      client.blocked = !client.res.write(`event: dropped\ndata: ${JSON.stringify({ dropped: dropped })}\n\n`);
+    }
+
+    while (client.queue.length > 0 && !client.blocked) {
+      this.stats.sent++;
+      client.blocked = !client.res.write(client.queue.shift());
+    }
+  }
+
+  status() {
+    return { ...this.stats, clients: this.clients.size, max_buffer: this.max_buffer };
+  }
+}
+
+export const auditStream = new AuditStream({
+  max_buffer: parseInt(process.env.AUDIT_STREAM_MAX_BUFFER) || undefined,
+});
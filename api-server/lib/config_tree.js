@@ -0,0 +1,379 @@
+// yealink-provision - Config Tree Helpers
+// Cameron Fleming 2023
+
+// Helpers for working with whole configuration subtrees at once, rather than one group at a time.
+// A subtree is loaded with a single aggregation, using $graphLookup to follow the group -> group targeting
+// and $lookup to attach each group's elements, so the number of queries doesn't grow with the size of the tree.
+
+import mongoose from 'mongoose';
+import { customAlphabet } from 'nanoid';
+
+import { Element } from '../mongo/schemas/config.js';
+import { Group } from '../mongo/schemas/group.js';
+import { logger } from '../index.js';
+
+// Setup nanoid
+const nanoid = customAlphabet('1234567890abcdef', 8);
+
+// Load the root groups matching `match`, all of their descendant groups, and every element in those groups.
+// Returns a flat array of groups, each with an `elements` array.
+export const load_subtree = async (match) => {
+  return await Group.aggregate([
+    { $match: match },
+    { $graphLookup: {
+      from: Group.collection.name,
+      startWith: '$id',
+      connectFromField: 'id',
+      connectToField: 'target_id',
+      restrictSearchWithMatch: { target_type: 'group' },
+      as: '_descendants',
+    } },
+    { $project: { _groups: { $concatArrays: [['$$ROOT'], '$_descendants'] } } },
+    { $unwind: '$_groups' },
+    { $replaceRoot: { newRoot: '$_groups' } },
+    { $unset: ['_id', '__v', '_descendants'] },
+    { $lookup: {
+      from: Element.collection.name,
+      localField: 'id',
+      foreignField: 'group_id',
+      as: 'elements',
+    } },
+    { $unset: ['elements._id', 'elements.__v'] },
+  ]);
+}
+
+// Load every group and element configured on a target (i.e., site/xyxy).
+export const load_layer = async (target_type, target_id) => {
+  return await load_subtree({ target_type: target_type, target_id: target_id });
+}
+
+// Create new copies of the groups/elements from load_subtree, with new IDs.
+// Groups whose parent is not part of the subtree are the roots of the copy, `retarget(group)` returns
+// the { target_type, target_id, name } they should be given. Descendants keep their structure.
+export const clone_subtree = (groups, retarget) => {
+  const id_map = new Map();
+  for (const group of groups) {
+    id_map.set(group.id, nanoid(8));
+  }
+
+  const new_groups = [];
+  const new_elements = [];
+
+  for (const group of groups) {
+    const is_root = group.target_type != 'group' || !id_map.has(group.target_id);
+    const target = is_root
+      ? retarget(group)
+      : { target_type: 'group', target_id: id_map.get(group.target_id), name: group.name };
+
+    new_groups.push({
+      id: id_map.get(group.id),
+      name: target.name,
+      remark: group.remark,
+      enable: group.enable,
+      target_type: target.target_type,
+      target_id: target.target_id,
+    });
+
+    for (const element of group.elements || []) {
+      new_elements.push({
+        id: nanoid(8),
+        name: element.name,
+        group_id: id_map.get(group.id),
+        value: element.value,
+        remark: element.remark,
+        enable: element.enable,
+      });
+    }
+  }
+
+  return { groups: new_groups, elements: new_elements };
+}
+
+// Run fn(session) in a transaction. Transactions need a replica set, on a standalone MongoDB server
+// fn is run without a session instead, so writes are still applied but not atomically.
+export const with_transaction = async (fn) => {
+  const session = await mongoose.startSession();
+
+  try {
+    let result;
+    await session.withTransaction(async () => {
+      result = await fn(session);
+    });
+    return result;
+  } catch (err) {
+    // IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+    if (err.code != 20) throw err;
+
+    logger.warn("config_tree: transactions are not supported by this MongoDB server, writing without a transaction.");
+    return await fn(null);
+  } finally {
+    await session.endSession();
+  }
+}
+
+// Delete a set of groups and every element inside them.
+export const delete_groups = async (group_ids, session) => {
+  const elements = await Element.deleteMany({ group_id: { $in: group_ids } }, { session });
+  const groups = await Group.deleteMany({ id: { $in: group_ids } }, { session });
+
+  return { groups: groups.deletedCount, elements: elements.deletedCount };
+}
+
+// Insert the output of clone_subtree using one bulkWrite per collection.
+export const insert_subtree = async (subtree, session) => {
+  if (subtree.groups.length > 0) {
+    await Group.bulkWrite(subtree.groups.map((group) => ({ insertOne: { document: group } })), { session });
+  }
+
+  if (subtree.elements.length > 0) {
+    await Element.bulkWrite(subtree.elements.map((element) => ({ insertOne: { document: element } })), { session });
+  }
+
+  return { groups: subtree.groups.length, elements: subtree.elements.length };
+}
+
+// Names that can't be used as keys in a plain object, assigning them changes the object's (or every object's) prototype.
+const UNSAFE_NAMES = new Set(['__proto__', 'constructor', 'prototype']);
+export const is_safe_name = (name) => !UNSAFE_NAMES.has(name);
+
+// Build the nested JSON structure of a layer from load_subtree/load_layer, for example {"account": {"1": {"enable": "1"}}}.
+// Groups become objects, elements become key/value pairs. Groups and elements with unsafe names are left out.
+export const build_tree = (groups) => {
+  const nodes = new Map();
+  for (const group of groups) {
+    const node = {};
+    for (const element of group.elements || []) {
+      if (is_safe_name(element.name)) node[element.name] = element.value;
+    }
+    nodes.set(group.id, node);
+  }
+
+  const tree = {};
+  for (const group of groups) {
+    if (!is_safe_name(group.name)) continue;
+
+    const parent = group.target_type == 'group' ? nodes.get(group.target_id) : undefined;
+    (parent || tree)[group.name] = nodes.get(group.id);
+  }
+
+  return tree;
+}
+
+// Flatten a nested configuration tree into an ordered list of [dotted key, value] pairs.
+export const flatten_tree = (tree, prefix = '', out = []) => {
+  for (const key in tree) {
+    if (typeof tree[key] === 'object' && tree[key] !== null) {
+      flatten_tree(tree[key], `${prefix}${key}.`, out);
+    } else {
+      out.push([`${prefix}${key}`, tree[key]]);
+    }
+  }
+
+  return out;
+}
+
+// Turn a list of [dotted key, value] pairs (or { key, value } objects) back into a nested tree.
+// Throws if a key is used both as a value and as a group, or contains an unsafe name.
+export const unflatten_values = (values) => {
+  const tree = {};
+
+  for (const item of values) {
+    const [key, value] = Array.isArray(item) ? item : [item.key, item.value];
+    const path = String(key).split('.');
+    if (!path.every(is_safe_name)) throw new Error(`${key} is not a valid name.`);
+
+    let node = tree;
+    for (const name of path.slice(0, -1)) {
+      if (node[name] === undefined) node[name] = {};
+      if (typeof node[name] !== 'object') throw new Error(`${key} is inside a value, not a group.`);
+      node = node[name];
+    }
+
+    const name = path[path.length - 1];
+    if (typeof node[name] === 'object') throw new Error(`${key} is a group, not a value.`);
+    node[name] = value;
+  }
+
+  return tree;
+}
+
+// Work out the writes needed to make the configuration on a target match `desired` (a nested tree).
+// Uses a single read (load_layer), and returns a plan of the changes along with the groups/elements
+// to insert, update and delete. Nothing is written, see apply_reconcile.
+// `desired` must be validated first, only groups are allowed at the root.
+export const plan_reconcile = async (target_type, target_id, desired) => {
+  const groups = await load_layer(target_type, target_id);
+
+  // Index the stored tree, children of each group by name.
+  const children = new Map();
+  const child_list = (id) => {
+    if (!children.has(id)) children.set(id, []);
+    return children.get(id);
+  }
+
+  for (const group of groups) {
+    const parent = group.target_type == 'group' ? group.target_id : null;
+    child_list(parent).push(group);
+  }
+
+  const plan = {
+    changes: [],
+    new_groups: [],
+    new_elements: [],
+    updated_elements: [],
+    deleted_group_ids: [],
+    deleted_element_ids: [],
+  };
+
+  // Delete a stored group along with every group below it.
+  const delete_group = (group, path) => {
+    plan.changes.push({ op: 'delete_group', path: path });
+
+    const stack = [group];
+    while (stack.length > 0) {
+      const next = stack.pop();
+      plan.deleted_group_ids.push(next.id);
+      stack.push(...(children.get(next.id) || []));
+    }
+  }
+
+  // Create a group (and everything in it) that isn't stored yet.
+  const create_group = (name, target, node, path) => {
+    const group = {
+      id: nanoid(8),
+      name: name,
+      enable: true,
+      target_type: target.target_type,
+      target_id: target.target_id,
+    };
+    plan.new_groups.push(group);
+    plan.changes.push({ op: 'create_group', path: path });
+
+    for (const [key, value] of Object.entries(node)) {
+      if (typeof value === 'object') {
+        create_group(key, { target_type: 'group', target_id: group.id }, value, `${path}.${key}`);
+      } else {
+        create_element(key, group.id, value, `${path}.${key}`);
+      }
+    }
+  }
+
+  const create_element = (name, group_id, value, path) => {
+    plan.new_elements.push({ id: nanoid(8), name: name, group_id: group_id, value: String(value), enable: true });
+    plan.changes.push({ op: 'create_element', path: path, value: String(value) });
+  }
+
+  // Compare the stored children of a group (or the target's root groups) with the desired node.
+  const reconcile_node = (stored_group, target, node, prefix) => {
+    const stored_groups = new Map();
+    const stored_elements = new Map();
+
+    for (const group of children.get(stored_group ? stored_group.id : null) || []) {
+      if (stored_groups.has(group.name)) {
+        delete_group(group, `${prefix}${group.name}`);
+      } else {
+        stored_groups.set(group.name, group);
+      }
+    }
+
+    for (const element of stored_group ? stored_group.elements : []) {
+      if (stored_elements.has(element.name)) {
+        plan.deleted_element_ids.push(element.id);
+        plan.changes.push({ op: 'delete_element', path: `${prefix}${element.name}`, old_value: element.value });
+      } else {
+        stored_elements.set(element.name, element);
+      }
+    }
+
+    for (const [key, value] of Object.entries(node)) {
+      const path = `${prefix}${key}`;
+      const group = stored_groups.get(key);
+      const element = stored_elements.get(key);
+      stored_groups.delete(key);
+      stored_elements.delete(key);
+
+      if (typeof value === 'object') {
+        if (element) {
+          plan.deleted_element_ids.push(element.id);
+          plan.changes.push({ op: 'delete_element', path: path, old_value: element.value });
+        }
+
+        if (group) {
+          reconcile_node(group, { target_type: 'group', target_id: group.id }, value, `${path}.`);
+        } else {
+          create_group(key, target, value, path);
+        }
+      } else {
+        if (group) delete_group(group, path);
+
+        if (!element) {
+          create_element(key, stored_group.id, value, path);
+        } else if (element.value !== String(value)) {
+          plan.updated_elements.push({ id: element.id, value: String(value) });
+          plan.changes.push({ op: 'update_element', path: path, old_value: element.value, value: String(value) });
+        }
+      }
+    }
+
+    // Anything left over is no longer in the desired tree.
+    for (const [name, group] of stored_groups) {
+      delete_group(group, `${prefix}${name}`);
+    }
+
+    for (const [name, element] of stored_elements) {
+      plan.deleted_element_ids.push(element.id);
+      plan.changes.push({ op: 'delete_element', path: `${prefix}${name}`, old_value: element.value });
+    }
+  }
+
+  reconcile_node(null, { target_type: target_type, target_id: target_id }, desired, '');
+
+  return plan;
+}
+
+// Apply a plan from plan_reconcile, using one bulkWrite per collection.
+export const apply_reconcile = async (plan, session) => {
+  const group_ops = [];
+  const element_ops = [];
+
+  for (const group of plan.new_groups) {
+    group_ops.push({ insertOne: { document: group } });
+  }
+
+  if (plan.deleted_group_ids.length > 0) {
+    group_ops.push({ deleteMany: { filter: { id: { $in: plan.deleted_group_ids } } } });
+    element_ops.push({ deleteMany: { filter: { group_id: { $in: plan.deleted_group_ids } } } });
+  }
+
+  if (plan.deleted_element_ids.length > 0) {
+    element_ops.push({ deleteMany: { filter: { id: { $in: plan.deleted_element_ids } } } });
+  }
+
+  for (const element of plan.updated_elements) {
+    element_ops.push({ updateOne: { filter: { id: element.id }, update: { $set: { value: element.value } } } });
+  }
+
+  for (const element of plan.new_elements) {
+    element_ops.push({ insertOne: { document: element } });
+  }
+
+  if (group_ops.length > 0) await Group.bulkWrite(group_ops, { session, ordered: true });
+  if (element_ops.length > 0) await Element.bulkWrite(element_ops, { session, ordered: true });
+}
+
+// Summarise a plan from plan_reconcile by the number of each type of change.
+export const summarise_reconcile = (plan) => {
+  const summary = {
+    create_group: 0,
+    delete_group: 0,
+    create_element: 0,
+    update_element: 0,
+    delete_element: 0,
+  };
+
+  for (const change of plan.changes) {
+    summary[change.op]++;
+  }
+
+  return summary;
+}
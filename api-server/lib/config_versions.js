@@ -0,0 +1,294 @@
+// yealink-provision - Config Versions
+// Cameron Fleming 2023
+
+// Every write to a target's configuration records a new version of that layer (see mongo/schemas/layer_version.js).
+// Versions are stored copy-on-write as content-addressed nodes (mongo/schemas/config_node.js): a layer tree is split
+// into one node per group, each keyed by the hash of its elements and the hashes of its child groups. Recording a
+// version only inserts the nodes whose content is new, so a write to one element adds the nodes on the path from that
+// element to the root, and everything else is shared with the previous version.
+
+// Versions are recorded by the process that made the write, never from relayed 'config_changed' events, so each write
+// is recorded once in cluster mode. Node content never changes, so nodes are cached in memory without invalidation.
+// Writes don't wait for their version to be recorded, but a target's first write waits for its configuration before
+// the write to be recorded (see seed), so there's always a version to roll back to.
+
+import crypto from 'crypto';
+
+import { ConfigNode } from '../mongo/schemas/config_node.js';
+import { LayerVersion } from '../mongo/schemas/layer_version.js';
+import { compile_layer } from './layer_cache.js';
+import { is_safe_name } from './config_tree.js';
+import { logger } from '../index.js';
+
+const DEFAULT_NODE_CACHE_SIZE = 10000;
+const DEFAULT_HASH_CACHE_SIZE = 10000;
+
+const by_name = (a, b) => (a[0] < b[0] ? -1 : a[0] > b[0] ? 1 : 0);
+
+// Split a nested configuration tree into content-addressed nodes.
+// Returns the root hash, and a Map of hash -> node for every node in the tree.
+export const snapshot_tree = (tree, nodes = new Map()) => {
+  const elements = [];
+  const groups = [];
+
+  for (const [name, value] of Object.entries(tree)) {
+    if (typeof value === 'object' && value !== null) {
+      groups.push([name, snapshot_tree(value, nodes).hash]);
+    } else {
+      elements.push([name, value]);
+    }
+  }
+
+  // MongoDB doesn't guarantee the order groups and elements are loaded in, so they're sorted by name to make the
+  // hash depend only on the content.
+  elements.sort(by_name);
+  groups.sort(by_name);
+
+  const hash = crypto.createHash('sha256').update(JSON.stringify([elements, groups])).digest('hex');
+  nodes.set(hash, { hash: hash, elements: elements, groups: groups });
+
+  return { hash: hash, nodes: nodes };
+}
+
+// The root hash of a layer tree, identifying the version that was served. Trees from the layer cache are
+// shared and never modified, so their hash is only worked out once.
+const layer_hashes = new WeakMap();
+
+export const layer_hash = (tree) => {
+  if (!layer_hashes.has(tree)) {
+    layer_hashes.set(tree, snapshot_tree(tree).hash);
+  }
+
+  return layer_hashes.get(tree);
+}
+
+// The root hashes of layers that aren't in the layer cache (devices), which are compiled afresh for every fetch so
+// layer_hash can't remember them. Each target has a generation, bumped whenever its configuration changes: take the
+// generation before compiling the layer, and get() only reuses or keeps a hash for the same generation.
+export class LayerHashes {
+  constructor(options = {}) {
+    this.max_entries = options.max_entries || DEFAULT_HASH_CACHE_SIZE;
+    this.entries = new Map();
+    this.generations = new Map();
+  }
+
+  key(target_type, target_id) {
+    return `${target_type}/${target_id}`;
+  }
+
+  generation(target_type, target_id) {
+    return this.generations.get(this.key(target_type, target_id)) || 0;
+  }
+
+  get(target_type, target_id, generation, tree) {
+    const key = this.key(target_type, target_id);
+    const entry = this.entries.get(key);
+    if (entry && entry.generation == generation) return entry.hash;
+
+    const hash = snapshot_tree(tree).hash;
+    if (this.generation(target_type, target_id) == generation) {
+      this.entries.delete(key);
+      this.entries.set(key, { generation: generation, hash: hash });
+
+      if (this.entries.size > this.max_entries) {
+        this.entries.delete(this.entries.keys().next().value);
+      }
+    }
+
+    return hash;
+  }
+
+  invalidate(target_type, target_id) {
+    const key = this.key(target_type, target_id);
+    this.entries.delete(key);
+    this.generations.set(key, this.generation(target_type, target_id) + 1);
+  }
+}
+
+export const deviceLayerHashes = new LayerHashes({
+  max_entries: parseInt(process.env.DEVICE_HASH_CACHE_SIZE) || undefined,
+});
+
+export class ConfigVersions {
+  constructor(options = {}) {
+    this.max_nodes = options.max_nodes || DEFAULT_NODE_CACHE_SIZE;
+    this.nodes = new Map();
+    this.recording = new Map();
+    // Targets known to have at least one version.
+    this.seeded = new Set();
+  }
+
+  cache_node(node) {
+    this.nodes.delete(node.hash);
+    this.nodes.set(node.hash, node);
+
+    if (this.nodes.size > this.max_nodes) {
+      this.nodes.delete(this.nodes.keys().next().value);
+    }
+  }
+
+  // Store the nodes of a snapshot that aren't already stored, with one query to find them and one bulkWrite.
+  // Upserts make this safe when another process stores the same node at the same time.
+  async store_nodes(nodes) {
+    const unknown = [...nodes.keys()].filter((hash) => !this.nodes.has(hash));
+    const stored = new Set(
+      (await ConfigNode.find({ hash: { $in: unknown } }, { _id: 0, hash: 1 }).lean()).map((node) => node.hash)
+    );
+
+    const missing = unknown.filter((hash) => !stored.has(hash)).map((hash) => nodes.get(hash));
+    if (missing.length > 0) {
+      await ConfigNode.bulkWrite(missing.map((node) => ({
+        updateOne: { filter: { hash: node.hash }, update: { $setOnInsert: node }, upsert: true },
+      })), { ordered: false });
+    }
+
+    for (const node of nodes.values()) {
+      this.cache_node(node);
+    }
+
+    return missing.length;
+  }
+
+  // Record the current configuration on a target as a new version, unless it's the same as the latest version.
+  // Writes to the same target are recorded one at a time, in the order they were made.
+  record(target_type, target_id, options = {}) {
+    const key = `${target_type}/${target_id}`;
+    const previous = this.recording.get(key) || Promise.resolve();
+
+    const recording = previous.then(() => this.record_now(target_type, target_id, options)).catch((err) => {
+      // A write must not fail because its version couldn't be recorded, the next write records the state again.
+      logger.error(`config_versions: failed to record version of ${key}: ${err}`);
+      return null;
+    });
+
+    this.recording.set(key, recording);
+    recording.finally(() => {
+      if (this.recording.get(key) === recording) this.recording.delete(key);
+    });
+
+    return recording;
+  }
+
+  // Record the configuration on a target as its "initial" version if it has no versions, call before writing to it.
+  // Each target is only looked up once per process.
+  async seed(target_type, target_id) {
+    const key = `${target_type}/${target_id}`;
+    if (this.seeded.has(key)) return;
+
+    try {
+      if (!await LayerVersion.exists({ target_type: target_type, target_id: target_id })) {
+        await this.record(target_type, target_id, { source: 'initial' });
+      }
+    } catch (err) {
+      // As with record, a write must not fail because of its version, the next write tries again.
+      logger.error(`config_versions: failed to seed versions of ${key}: ${err}`);
+      return;
+    }
+
+    if (this.seeded.size >= this.max_nodes) this.seeded.clear();
+    this.seeded.add(key);
+  }
+
+  async record_now(target_type, target_id, options) {
+    const snapshot = snapshot_tree(await compile_layer(target_type, target_id));
+    const target = { target_type: target_type, target_id: target_id };
+
+    // Another process may record a version of this target at the same time, so retry if the number is taken.
+    for (let attempt = 0; attempt < 5; attempt++) {
+      const latest = await LayerVersion.findOne(target, { _id: 0, __v: 0 }).sort({ version: -1 }).lean();
+      if (latest && latest.root_hash == snapshot.hash) return latest;
+
+      const new_nodes = await this.store_nodes(snapshot.nodes);
+
+      try {
+        const version = await LayerVersion.create({
+          ...target,
+          version: latest ? latest.version + 1 : 1,
+          root_hash: snapshot.hash,
+          source: options.source || 'write',
+          rollback_of: options.rollback_of,
+        });
+
+        logger.debug(`config_versions: recorded version ${version.version} of ${target_type}/${target_id}, ${new_nodes} new nodes.`);
+        return version;
+      } catch (err) {
+        // E11000 duplicate key, the version number was taken.
+        if (err.code != 11000) throw err;
+      }
+    }
+
+    throw new Error("version number is still taken after 5 attempts.");
+  }
+
+  // Find a version of a target by number, or by root hash (as recorded by the fetch audit).
+  async find(target_type, target_id, version) {
+    const query = { target_type: target_type, target_id: target_id };
+    if (/^[0-9]+$/.test(String(version))) {
+      query.version = parseInt(version);
+    } else {
+      query.root_hash = String(version);
+    }
+
+    return await LayerVersion.findOne(query, { _id: 0, __v: 0 }).sort({ version: -1 }).lean();
+  }
+
+  // Load the configuration tree of a version, with one query per level of the tree for nodes that aren't cached.
+  async load_tree(root_hash) {
+    const nodes = new Map();
+    let level = [root_hash];
+
+    while (level.length > 0) {
+      const missing = [];
+      for (const hash of level) {
+        if (this.nodes.has(hash)) {
+          nodes.set(hash, this.nodes.get(hash));
+        } else {
+          missing.push(hash);
+        }
+      }
+
+      if (missing.length > 0) {
+        for (const node of await ConfigNode.find({ hash: { $in: missing } }, { _id: 0, hash: 1, elements: 1, groups: 1 }).lean()) {
+          nodes.set(node.hash, node);
+          this.cache_node(node);
+        }
+      }
+
+      const next = new Set();
+      for (const hash of level) {
+        const node = nodes.get(hash);
+        if (!node) throw new Error(`config node ${hash} is missing.`);
+
+        for (const [name, child] of node.groups) {
+          if (!nodes.has(child)) next.add(child);
+        }
+      }
+      level = [...next];
+    }
+
+    // Elements come before child groups, the same order as build_tree, each sorted by name.
+    const build = (hash) => {
+      const node = nodes.get(hash);
+      const tree = {};
+
+      for (const [name, value] of node.elements) {
+        if (is_safe_name(name)) tree[name] = value;
+      }
+      for (const [name, child] of node.groups) {
+        if (is_safe_name(name)) tree[name] = build(child);
+      }
+
+      return tree;
+    }
+
+    return build(root_hash);
+  }
+
+  status() {
+    return { cached_nodes: this.nodes.size, max_nodes: this.max_nodes };
+  }
+}
+
+export const configVersions = new ConfigVersions({
+  max_nodes: parseInt(process.env.CONFIG_NODE_CACHE_SIZE) || undefined,
+});
@@ -0,0 +1,67 @@
+// yealink-provision - API Server Instrumentation
+// Cameron Fleming 2023
+
+// Metrics specific to the API server: MongoDB queries and phase timings for each fetch.
+
+// Queries are counted with a mongoose plugin, and attributed to the request that made them through
+// AsyncLocalStorage. Plugins only apply to models compiled after they're registered, so this module
+// must be imported before any of the schemas (it's the first import in index.js).
+
+import mongoose from 'mongoose';
+import { AsyncLocalStorage } from 'async_hooks';
+
+import { registry } from '../../shared/metrics.js';
+
+const query_context = new AsyncLocalStorage();
+
+export const mongo_queries = registry.counter('mongo_queries_total', 'MongoDB queries made, by model and operation.', ['model', 'operation']);
+export const fetch_queries = registry.histogram('fetch_mongo_queries', 'MongoDB queries made per device fetch.', ['result'], [1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100]);
+export const fetch_phase_duration = registry.histogram('fetch_phase_duration_seconds', 'Time spent in each phase of a device fetch.', ['phase']);
+
+const count_query = (model, operation) => {
+  mongo_queries.inc({ model: model, operation: operation });
+
+  const context = query_context.getStore();
+  if (context) context.queries++;
+}
+
+mongoose.plugin((schema) => {
+  schema.pre(/^(find|count|distinct|update|delete|replace)/, { query: true, document: false }, function () {
+    count_query(this.model.modelName, this.op);
+  });
+
+  schema.pre('aggregate', function () {
+    count_query(this.model().modelName, 'aggregate');
+  });
+
+  schema.pre('save', function () {
+    count_query(this.constructor.modelName, 'save');
+  });
+
+  schema.pre('insertMany', function () {
+    count_query(this.modelName, 'insertMany');
+  });
+});
+
+// Express middleware counting the queries made while handling a fetch. The result label is set
+// by the handler with res.locals.fetch_result, requests that don't set it are labelled "fail".
+export const track_fetch_queries = (req, res, next) => {
+  const context = { queries: 0 };
+
+  res.once('close', () => {
+    fetch_queries.observe({ result: res.locals.fetch_result || 'fail' }, context.queries);
+  });
+
+  query_context.run(context, next);
+}
+
+// Time the phases of a fetch, each call to mark(phase) records the time since the previous mark.
+export const phase_timer = () => {
+  let last = process.hrtime.bigint();
+
+  return (phase) => {
+    const now = process.hrtime.bigint();
+    fetch_phase_duration.observe({ phase: phase }, Number(now - last) / 1e9);
+    last = now;
+  }
+}
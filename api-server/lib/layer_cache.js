@@ -0,0 +1,91 @@
+// yealink-provision - Compiled Layer Cache
+// Cameron Fleming 2023
+
+// A "layer" is all of the configuration on one target (model, site, virtual device or device), compiled
+// into the nested JSON structure used by the fetch API. Layers shared by many devices (models, sites and
+// virtual devices) are compiled once and kept here, so a template linked to 200 phones is read and built
+// once, not once per phone.
+
+// Entries are dropped whenever configuration on the target changes (configEmitter 'config_changed', which is
+// relayed between workers in cluster mode). Concurrent requests for a layer that isn't cached share one compile.
+// Cached layers are shared between requests and must not be modified.
+
+import { load_layer, build_tree } from './config_tree.js';
+
+const DEFAULT_MAX_ENTRIES = 1000;
+
+// Compile the configuration on a target into a nested tree, always from the database.
+export const compile_layer = async (target_type, target_id) => {
+  return build_tree(await load_layer(target_type, target_id));
+}
+
+export class LayerCache {
+  constructor(compile, options = {}) {
+    this.compile = compile;
+    this.max_entries = options.max_entries || DEFAULT_MAX_ENTRIES;
+
+    this.entries = new Map();
+    this.pending = new Map();
+    this.stats = { hits: 0, misses: 0, invalidations: 0 };
+  }
+
+  key(target_type, target_id) {
+    return `${target_type}/${target_id}`;
+  }
+
+  async get(target_type, target_id) {
+    const key = this.key(target_type, target_id);
+
+    if (this.entries.has(key)) {
+      // Move the entry to the end, so the least recently used entry is evicted first.
+      const layer = this.entries.get(key);
+      this.entries.delete(key);
+      this.entries.set(key, layer);
+
+      this.stats.hits++;
+      return layer;
+    }
+
+    this.stats.misses++;
+
+    if (this.pending.has(key)) {
+      return await this.pending.get(key);
+    }
+
+    const compiling = this.compile(target_type, target_id);
+    this.pending.set(key, compiling);
+
+    try {
+      const layer = await compiling;
+
+      // Only keep the result if the layer wasn't invalidated while it was being compiled.
+      if (this.pending.get(key) === compiling) {
+        this.entries.set(key, layer);
+
+        if (this.entries.size > this.max_entries) {
+          this.entries.delete(this.entries.keys().next().value);
+        }
+      }
+
+      return layer;
+    } finally {
+      if (this.pending.get(key) === compiling) this.pending.delete(key);
+    }
+  }
+
+  invalidate(target_type, target_id) {
+    const key = this.key(target_type, target_id);
+
+    this.entries.delete(key);
+    this.pending.delete(key);
+    this.stats.invalidations++;
+  }
+
+  status() {
+    return { ...this.stats, entries: this.entries.size, max_entries: this.max_entries };
+  }
+}
+
+export const layerCache = new LayerCache(compile_layer, {
+  max_entries: parseInt(process.env.LAYER_CACHE_SIZE) || undefined,
+});
@@ -0,0 +1,165 @@
+// yealink-provision - Configuration Abstraction (Spec) Index
+// Cameron Fleming 2023
+
+// Loads the per-model configuration spec files (see TODO.md, "Configuration Abstraction Layer") from specs/
+// once, and compiles them into indexes so lookups never walk the spec again:
+// - by model: normalised "vendor/model name" -> compiled spec
+// - by path: dotted config path pattern -> spec node, numbered groups are "#" (i.e., linekey.#.type)
+// - by friendly value: for each path with supported_values, friendly name -> config value (i.e., BLF -> 16)
+
+// Looking up a config key only needs it converted to its pattern, which is O(depth).
+
+import fs from 'fs';
+import path from 'path';
+import { fileURLToPath } from 'url';
+
+const SPEC_DIR = process.env.SPEC_DIR || path.join(path.dirname(fileURLToPath(import.meta.url)), '..', 'specs');
+
+const normalise_name = (name) => String(name).toLowerCase().replace(/[^a-z0-9]/g, '');
+
+export const model_key = (vendor, name) => `${normalise_name(vendor)}/${normalise_name(name)}`;
+
+// Convert a config path (array or dotted string) to its pattern, numbered groups become "#".
+export const path_pattern = (config_path) => {
+  const items = Array.isArray(config_path) ? config_path : String(config_path).split('.');
+  return items.map((item) => /^[0-9]+$/.test(item) ? '#' : item).join('.');
+}
+
+// Compile a spec file into its path index.
+const compile_spec = (spec) => {
+  const paths = new Map();
+
+  const add = (node, parent, required) => {
+    const name = node.type == 'group_only_numbered' ? '#' : node.config_name;
+    const pattern = parent ? `${parent}.${name}` : name;
+
+    const compiled = {
+      pattern: pattern,
+      friendly_name: node.friendly_name,
+      config_name: name,
+      type: node.type,
+      remark: node.remark,
+      required: required,
+      default_value: node.default_value,
+      supported_values: node.supported_values,
+      children: [],
+    };
+
+    if (node.supported_values) {
+      compiled.values_by_friendly_name = Object.fromEntries(
+        node.supported_values.map((value) => [normalise_name(value.friendly_name), String(value.config_value)])
+      );
+      compiled.friendly_names_by_value = Object.fromEntries(
+        node.supported_values.map((value) => [String(value.config_value), value.friendly_name])
+      );
+    }
+
+    paths.set(pattern, compiled);
+
+    for (const [children, child_required] of [[node.required_children, true], [node.optional_children, false]]) {
+      for (const child of children || []) {
+        compiled.children.push(add(child, pattern, child_required).config_name);
+      }
+    }
+
+    return compiled;
+  }
+
+  const roots = [];
+  for (const node of spec.config_spec || []) {
+    roots.push(add(node, null, false).config_name);
+  }
+
+  return {
+    device_meta: spec.device_meta,
+    roots: roots,
+    paths: paths,
+  };
+}
+
+export class SpecIndex {
+  constructor(spec_dir = SPEC_DIR) {
+    this.spec_dir = spec_dir;
+    this.by_model = null;
+  }
+
+  // Specs are read from disk on first use only.
+  load() {
+    if (this.by_model) return;
+    this.by_model = new Map();
+
+    if (!fs.existsSync(this.spec_dir)) return;
+
+    for (const file of fs.readdirSync(this.spec_dir).filter((file) => file.endsWith('.json'))) {
+      const spec = JSON.parse(fs.readFileSync(path.join(this.spec_dir, file), 'utf8'));
+      this.by_model.set(model_key(spec.device_meta.model_vendor_name, spec.device_meta.model_name), compile_spec(spec));
+    }
+  }
+
+  // Get the compiled spec for a model, or undefined if there isn't one.
+  for_model(vendor, name) {
+    this.load();
+    return this.by_model.get(model_key(vendor, name));
+  }
+
+  // Get the spec node for a config path, or undefined if it's not in the spec.
+  lookup(spec, config_path) {
+    return spec.paths.get(path_pattern(config_path));
+  }
+
+  // Convert a value to its config value, accepting either the config value or its friendly name
+  // (i.e., "BLF" or "16" for a linekey type). Returns { value } or { error }.
+  resolve_value(spec, config_path, value) {
+    const node = this.lookup(spec, config_path);
+    if (!node) return { value: String(value) };
+
+    if (node.type == 'group_only' || node.type == 'group_only_numbered') {
+      return { error: `${config_path} is a group, not a value.` };
+    }
+
+    if (node.values_by_friendly_name) {
+      if (node.friendly_names_by_value[String(value)] !== undefined) return { value: String(value) };
+
+      const resolved = node.values_by_friendly_name[normalise_name(value)];
+      if (resolved !== undefined) return { value: resolved };
+
+      return { error: `${value} is not a supported value for ${config_path}, expected one of ${node.supported_values.map((v) => `${v.config_value} (${v.friendly_name})`).join(', ')}.` };
+    }
+
+    if (node.type == 'number' && !/^-?[0-9]+$/.test(String(value))) {
+      return { error: `${config_path} must be a number.` };
+    }
+
+    return { value: String(value) };
+  }
+
+  // Validate a list of [dotted key, value] pairs against a spec.
+  // Returns errors for invalid values, and the keys that aren't in the spec.
+  validate(spec, values) {
+    const errors = [];
+    const unknown = [];
+
+    for (const [key, value] of values) {
+      if (!spec.paths.has(path_pattern(key))) {
+        unknown.push(key);
+        continue;
+      }
+
+      const result = this.resolve_value(spec, key, value);
+      if (result.error) errors.push({ key: key, message: result.error });
+    }
+
+    return { errors: errors, unknown: unknown };
+  }
+}
+
+export const specIndex = new SpecIndex();
+
+// Convert a compiled spec to JSON for the API.
+export const spec_to_json = (spec) => {
+  return {
+    device_meta: spec.device_meta,
+    roots: spec.roots,
+    paths: Object.fromEntries(spec.paths),
+  };
+}
@@ -0,0 +1,32 @@
+// Mongoose Schema - Access Rule
+
+// Access rules restrict when and where devices can fetch their configuration, they target a site
+// (applying to every device in the site) or a single device. Both the site's and the device's rules must pass.
+
+// "cidr" rules are an IP address allowlist, if a target has any, the device must fetch from an address
+// inside one of them. For example, "203.0.113.0/24" or "2001:db8::/32".
+// "window" rules are provisioning windows, if a target has any, the device must fetch during one of them.
+// Windows are a list of days (0 = Sunday) and a start/end time ("HH:MM"), in UTC offset by utc_offset minutes.
+// A window that ends before it starts runs past midnight.
+
+import mongoose from 'mongoose';
+const { Schema } = mongoose;
+
+export const accessRuleSchema = new Schema({
+  id: { type: String, required: true },
+  target_type: { type: String, required: true, enum: ['site', 'device'] },
+  target_id: { type: String, required: true },
+  type: { type: String, required: true, enum: ['cidr', 'window'] },
+  cidr: { type: String, required: false },
+  days: { type: [Number], required: false },
+  start: { type: String, required: false },
+  end: { type: String, required: false },
+  utc_offset: { type: Number, required: false, default: 0 },
+  remark: { type: String, required: false },
+  create_date: { type: Date, required: true, default: Date.now },
+  enable: { type: Boolean, required: true, default: true },
+});
+
+accessRuleSchema.index({ target_type: 1, target_id: 1 });
+
+export const AccessRule = mongoose.model('AccessRule', accessRuleSchema);
@@ -21,4 +21,7 @@ export const elementSchema = new Schema({
   enable: { type: Boolean, required: true, default: true },
 });
 
+// Elements are always looked up by the group they belong to.
+elementSchema.index({ group_id: 1, name: 1 });
+
 export const Element = mongoose.model('Element', elementSchema);
\ No newline at end of file
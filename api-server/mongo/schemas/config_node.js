@@ -0,0 +1,18 @@
+// Mongoose Schema - Config Node
+
+// Config nodes hold the content of versioned configuration (see layer_version.js and lib/config_versions.js).
+// Each node is one group as it was served: its elements as [name, value] pairs and its child groups as
+// [name, hash] pairs, in order. Nodes are keyed by the SHA-256 hash of that content, so they're never modified,
+// and a group that's unchanged between versions (or identical on different targets) is stored only once.
+
+import mongoose from 'mongoose';
+const { Schema } = mongoose;
+
+export const configNodeSchema = new Schema({
+  hash: { type: String, required: true, unique: true },
+  elements: { type: Array, required: true, default: [] },
+  groups: { type: Array, required: true, default: [] },
+  create_date: { type: Date, required: true, default: Date.now },
+});
+
+export const ConfigNode = mongoose.model('ConfigNode', configNodeSchema);
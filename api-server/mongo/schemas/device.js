@@ -3,6 +3,7 @@
 // A device is a specific Yealink Phone (or for DECT, a base station).
 // It is assigned to a site, and inherits configuration from that site.
 // Configuration elements can be assigned to a device, and will override the site configuration.
+// Devices can also link virtual devices, which mirror their configuration between the site and device.
 
 // TODO - Yealink RPS Authentication.
 // This PoC version of yealink-provision does not support the normal
@@ -20,6 +21,12 @@ export const deviceSchema = new Schema({
   description: { type: String, required: false },
   create_date: { type: Date, required: true, default: Date.now },
   enable: { type: Boolean, required: true, default: false },
+  // Virtual devices whose configuration is mirrored onto this device, applied in order after the site
+  // and before the device's own configuration.
+  virtual_device_ids: { type: [String], required: true, default: [] },
 });
 
+// Devices are looked up by MAC address on every fetch.
+deviceSchema.index({ mac_address: 1 });
+
 export const Device = mongoose.model('Device', deviceSchema);
\ No newline at end of file
@@ -0,0 +1,47 @@
+// Mongoose Schema - Fetch Audit
+
+// A fetch audit entry is written for every attempt a device makes to fetch its configuration,
+// successful or otherwise. Entries are written in batches by the audit sink (lib/audit.js),
+// so the timestamp is set when the event happens, not when it's saved.
+
+// Entries are queried by device, site, MAC address and result, always within a time range,
+// the indexes below cover each of those lookups with the newest entries first.
+
+import mongoose from 'mongoose';
+const { Schema } = mongoose;
+
+export const fetchAuditSchema = new Schema({
+  id: { type: String, required: true },
+  type: { type: String, required: true, default: 'device_specific' },
+  device_id: { type: String, required: true },
+  site_id: { type: String, required: false },
+  mac_address: { type: String, required: false },
+  result: { type: String, required: true, enum: ['success', 'fail'] },
+  reason: { type: String, required: false },
+  message: { type: String, required: false },
+  source_ip: { type: String, required: false },
+  // Time from receiving the fetch to the result, in milliseconds.
+  duration_ms: { type: Number, required: false },
+  // For successful fetches, the layers served and the content hash of each, which identifies its version.
+  layers: {
+    type: [{ _id: false, target_type: String, target_id: String, hash: String }],
+    required: false,
+    default: undefined,
+  },
+  timestamp: { type: Date, required: true, default: Date.now },
+});
+
+// Entry IDs are unique, so a retried batch can't write an entry twice (see lib/audit.js).
+fetchAuditSchema.index({ id: 1 }, { unique: true });
+// Each filter, with and without result, has an index that also gives the newest first order, so no query has to
+// sort entries in memory. Combinations of device, site and MAC use the most selective one (device, then MAC).
+fetchAuditSchema.index({ timestamp: -1 });
+fetchAuditSchema.index({ result: 1, timestamp: -1 });
+fetchAuditSchema.index({ device_id: 1, timestamp: -1 });
+fetchAuditSchema.index({ device_id: 1, result: 1, timestamp: -1 });
+fetchAuditSchema.index({ mac_address: 1, timestamp: -1 });
+fetchAuditSchema.index({ mac_address: 1, result: 1, timestamp: -1 });
+fetchAuditSchema.index({ site_id: 1, timestamp: -1 });
+fetchAuditSchema.index({ site_id: 1, result: 1, timestamp: -1 });
+
+export const FetchAudit = mongoose.model('FetchAudit', fetchAuditSchema);
@@ -28,4 +28,8 @@ export const groupSchema = new Schema({
   target_id: { type: String, required: true },
 });
 
+// Groups are looked up by their target (and name), this also covers walking down the tree
+// as children target their parent group.
+groupSchema.index({ target_type: 1, target_id: 1, name: 1 });
+
 export const Group = mongoose.model('Group', groupSchema);
\ No newline at end of file
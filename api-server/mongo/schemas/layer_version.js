@@ -0,0 +1,27 @@
+// Mongoose Schema - Layer Version
+
+// A layer version is the configuration on one target (model, site, virtual device or device) after a write.
+// Versions are numbered from 1 for each target, and point at the root config node of the layer's content,
+// see config_node.js. A write that doesn't change the content doesn't create a version.
+
+// "source" is "write" for changes through the config API, or "rollback" for rollbacks, which also record the
+// version rolled back to in rollback_of. "initial" is the configuration a target had before its first versioned write.
+
+import mongoose from 'mongoose';
+const { Schema } = mongoose;
+
+export const layerVersionSchema = new Schema({
+  target_type: { type: String, required: true, enum: ['model', 'site', 'device', 'virtual_device'] },
+  target_id: { type: String, required: true },
+  version: { type: Number, required: true },
+  root_hash: { type: String, required: true },
+  source: { type: String, required: true, enum: ['initial', 'write', 'rollback'], default: 'write' },
+  rollback_of: { type: Number, required: false },
+  create_date: { type: Date, required: true, default: Date.now },
+});
+
+// Versions are listed newest first, and found by number or by content (the hashes recorded by the fetch audit).
+layerVersionSchema.index({ target_type: 1, target_id: 1, version: -1 }, { unique: true });
+layerVersionSchema.index({ target_type: 1, target_id: 1, root_hash: 1 });
+
+export const LayerVersion = mongoose.model('LayerVersion', layerVersionSchema);
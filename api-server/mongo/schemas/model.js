@@ -12,7 +12,12 @@ export const modelSchema = new Schema({
   name: { type: String, required: true },
   vendor: { type: String, required: true },
   remark: { type: String, required: false },
+  // The model's common cfg file, requested by every phone of this model before its <MAC>.cfg (i.e., "y000000000123").
+  // When set, the model's configuration is served in the common file rather than repeated in every <MAC>.cfg.
+  common_cfg: { type: String, required: false },
   create_date: { type: Date, required: true, default: Date.now },
 });
 
+modelSchema.index({ common_cfg: 1 }, { sparse: true });
+
 export const Model = mongoose.model('Model', modelSchema);
\ No newline at end of file
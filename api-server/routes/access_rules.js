@@ -0,0 +1,116 @@
+// yealink-provision - Access Rules API
+// Cameron Fleming 2023
+
+// These endpoints manage the access rules (IP allowlists and provisioning windows) of a site or device.
+// This router expects to be behind a target, (i.e., /site/:id/access_rules or /device/:id/access_rules).
+
+// Rules are checked in memory on the fetch path (see lib/access_control.js), so every change emits
+// 'access_rules_changed' to recompile the target's rules.
+
+import { customAlphabet } from 'nanoid';
+import { Router } from 'express';
+
+import { AccessRule } from '../mongo/schemas/access_rule.js';
+import { Site } from '../mongo/schemas/site.js';
+import { Device } from '../mongo/schemas/device.js';
+import { accessControlEmitter, validate_rule } from '../lib/access_control.js';
+
+import { logger } from '../index.js';
+
+// Setup nanoid
+const nanoid = customAlphabet('1234567890abcdef', 8);
+
+const router = Router({ mergeParams: true });
+
+const TARGETS = {
+  site: Site,
+  device: Device,
+};
+
+// Verify the target type is valid and the target exists.
+router.use(async (req, res, next) => {
+  const target_model = TARGETS[req.params.target_type];
+  if (!target_model) {
+    res.status(400).json({
+      error: 'invalid_target_type',
+      message: `Access rules can only target ${Object.keys(TARGETS).join(' or ')}.`,
+    })
+    return;
+  }
+
+  const target = await target_model.findOne({ id: req.params.target_id });
+  if (!target) {
+    res.status(404).json({
+      error: 'not_found',
+      message: `${req.params.target_type} not found.`,
+    })
+    return;
+  }
+
+  next();
+});
+
+const notify_access_rules_changed = (req) => {
+  accessControlEmitter.emit('access_rules_changed', {
+    target_type: req.params.target_type,
+    target_id: req.params.target_id,
+  });
+}
+
+// Get all access rules for the target
+router.get('/', async (req, res) => {
+  const rules = await AccessRule.find({ target_type: req.params.target_type, target_id: req.params.target_id }, { _id: 0, __v: 0 });
+  res.json(rules);
+});
+
+// Create an access rule
+// Body: { type: "cidr", cidr: "203.0.113.0/24" } or { type: "window", days: [1, 2, 3, 4, 5], start: "22:00", end: "06:00", utc_offset: 60 }
+router.post('/', async (req, res) => {
+  const error = validate_rule(req.body);
+  if (error) {
+    res.status(400).json({
+      error: 'invalid_rule',
+      message: error,
+    })
+    return;
+  }
+
+  const rule = new AccessRule({
+    id: nanoid(8),
+    target_type: req.params.target_type,
+    target_id: req.params.target_id,
+    type: req.body.type,
+    cidr: req.body.type == 'cidr' ? req.body.cidr : undefined,
+    days: req.body.type == 'window' ? req.body.days : undefined,
+    start: req.body.type == 'window' ? req.body.start : undefined,
+    end: req.body.type == 'window' ? req.body.end : undefined,
+    utc_offset: req.body.type == 'window' ? req.body.utc_offset : undefined,
+    remark: req.body.remark,
+    enable: req.body.enable,
+  });
+
+  await rule.save();
+  logger.debug(`access_rules: created ${rule.type} rule ${rule.id} on ${req.params.target_type}/${req.params.target_id}`);
+
+  notify_access_rules_changed(req);
+  res.json(rule);
+});
+
+// Delete an access rule
+router.delete('/:id', async (req, res) => {
+  const result = await AccessRule.deleteOne({ id: req.params.id, target_type: req.params.target_type, target_id: req.params.target_id });
+  if (result.deletedCount == 0) {
+    res.status(404).json({
+      error: 'not_found',
+      message: 'Access rule not found.',
+    })
+    return;
+  }
+
+  notify_access_rules_changed(req);
+  res.json({
+    message: 'Access rule deleted.',
+  })
+});
+
+export default router;
@@ -0,0 +1,103 @@
+// yealink-provision - Audit API
+// Cameron Fleming 2023
+
+// These endpoints are used to query the fetch audit log.
+// Every query is bound by a time range and a limit, and filters only on indexed fields.
+
+import { Router } from 'express';
+
+import { FetchAudit } from '../mongo/schemas/fetch_audit.js';
+import { auditSink } from '../lib/audit.js';
+import { auditStream } from '../lib/audit_stream.js';
+import { untrack_request } from '../../shared/metrics.js';
+
+import { logger } from '../index.js';
+
+const router = Router({ mergeParams: true });
+
+const DEFAULT_LIMIT = 100;
+const MAX_LIMIT = 1000;
+
+// Get audit entries, newest first.
+// Filters: device_id, site_id, mac_address, result (success/fail), from, to (ISO dates), limit.
+router.get('/', async (req, res) => {
+  const query = {};
+
+  if (req.query.device_id) query.device_id = req.query.device_id;
+  if (req.query.site_id) query.site_id = req.query.site_id;
+  if (req.query.mac_address) query.mac_address = req.query.mac_address.toUpperCase();
+
+  if (req.query.result) {
+    if (!['success', 'fail'].includes(req.query.result)) {
+      res.status(400).json({
+        error: 'invalid_result',
+        message: 'result must be one of success or fail.',
+      })
+      return;
+    }
+
+    query.result = req.query.result;
+  }
+
+  if (req.query.from || req.query.to) {
+    query.timestamp = {};
+
+    for (const [param, operator] of [['from', '$gte'], ['to', '$lte']]) {
+      if (!req.query[param]) continue;
+
+      const date = new Date(req.query[param]);
+      if (isNaN(date)) {
+        res.status(400).json({
+          error: 'invalid_date',
+          message: `${param} must be a valid date.`,
+        })
+        return;
+      }
+
+      query.timestamp[operator] = date;
+    }
+  }
+
+  const limit = Math.min(parseInt(req.query.limit) || DEFAULT_LIMIT, MAX_LIMIT);
+
+  logger.debug(`audit: querying audit log with ${JSON.stringify(query)}, limit ${limit}`);
+  const entries = await FetchAudit.find(query, { _id: 0, __v: 0 })
+    .sort({ timestamp: -1 })
+    .limit(limit)
+    .lean();
+
+  res.json(entries);
+});
+
+// Stream audit entries as they happen, as server-sent events ("audit" events, and "dropped" events with the number
+// of entries dropped if the client falls behind). Filters: site_id, mac_address, result (success/fail).
+router.get('/stream', (req, res) => {
+  if (req.query.result && !['success', 'fail'].includes(req.query.result)) {
+    res.status(400).json({
+      error: 'invalid_result',
+      message: 'result must be one of success or fail.',
+    })
+    return;
+  }
+
+  logger.debug(`audit: stream client connected from ${req.ip}`);
+  // Stream clients are counted by the audit stream, not as requests.
+  untrack_request(res);
+  auditStream.add(res, {
+    site_id: req.query.site_id,
+    mac_address: req.query.mac_address ? req.query.mac_address.toUpperCase() : undefined,
+    result: req.query.result,
+  });
+});
+
+// Get the state of the audit stream, including the number of dropped entries.
+router.get('/stream/status', async (req, res) => {
+  res.json(auditStream.status());
+});
+
+// Get the state of the audit sink, including the number of dropped entries.
+router.get('/sink', async (req, res) => {
+  res.json(auditSink.status());
+});
+
+export default router;
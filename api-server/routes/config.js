@@ -9,15 +9,46 @@ import { EventEmitter } from 'events';
 const nanoid = customAlphabet('1234567890abcdef', 8);
 
 // Create event emitter
+// 'config_changed' is emitted with { target_type, target_id } whenever configuration on a target is written,
+// anything caching configuration should listen for it.
 export const configEmitter = new EventEmitter();
 
+// Every write also records a new version of the target's configuration, in this process only (relayed events
+// don't record versions). The version is recorded in the background, the write doesn't wait for it.
+// Called just before each write, once it's been validated, so a target's configuration from before its first versioned
+// write is recorded as its initial version (see ConfigVersions.seed).
+const seed_versions = async (req) => {
+  if (ROOT_TARGET_TYPES.includes(req.params.target_type)) {
+    await configVersions.seed(req.params.target_type, req.params.target_id);
+  }
+}
+
+const notify_config_changed = (req) => {
+  configEmitter.emit('config_changed', { target_type: req.params.target_type, target_id: req.params.target_id });
+
+  if (ROOT_TARGET_TYPES.includes(req.params.target_type)) {
+    configVersions.record(req.params.target_type, req.params.target_id);
+  }
+}
+
 import { logger } from '../index.js';
 import { Element } from '../mongo/schemas/config.js';
 import { Group } from '../mongo/schemas/group.js';
 import { Site } from '../mongo/schemas/site.js'; 
+import { Model } from '../mongo/schemas/model.js';
+import { Device } from '../mongo/schemas/device.js';
+import { VirtualDevice } from '../mongo/schemas/virtual_device.js';
+import {
+  load_subtree, load_layer, clone_subtree, with_transaction, delete_groups, insert_subtree,
+  build_tree, flatten_tree, unflatten_values, is_safe_name, plan_reconcile, apply_reconcile, summarise_reconcile
+} from '../lib/config_tree.js';
+import { configVersions } from '../lib/config_versions.js';
 
 const router = Router({ mergeParams: true });
 
+// Target types that can hold root groups.
+const ROOT_TARGET_TYPES = ['model', 'site', 'virtual_device', 'device'];
+
 // This API is expected to be downstream of a "target" (i.e., /sites/:id/groups/name*/config)
 // The calls must check the type of target they're expecting, so for example if a request arrives
 // as /device/:target_id/groups/name* - the resolver needs to find groups with a target_type of 'device' and id matching
@@ -150,7 +181,18 @@ const recursive_resolve = async (target_type, target_id, path) => {
 // Names are unique to the target_type/target_id combination.
 // For example site/xyxy could have a group called "account" and so could device/xyxy.
 // But site/xyxy/account and device/xyxy/account are different groups.
+// Without a path, the whole configuration tree for the target is returned, nested by default or
+// as a list of [dotted key, value] pairs with ?format=flat.
 router.get('/*', async (req, res) => {
+  if (!req.params[0]) {
+    logger.debug(`router: call to GET /, returning whole configuration for ${req.params.target_type}/${req.params.target_id}`);
+    const tree = build_tree(await load_layer(req.params.target_type, req.params.target_id));
+
+    return res.status(200).json({
+      config: req.query.format == 'flat' ? flatten_tree(tree) : tree,
+    });
+  }
+
   logger.debug("router: call to GET /*, invoking recursive_resolve against " + req.params.target_type + "/" + req.params.target_id + "/" + req.params[0]);
   const groups = await recursive_resolve(req.params.target_type, req.params.target_id, req.params[0]);
 
@@ -183,12 +225,156 @@ router.get('/*', async (req, res) => {
   return res.status(404).send();
 })
 
+// Deep copy configuration from another target (or another part of this one), server-side.
+// The body's copy_from is { target_type, target_id, path }, the destination is the path in the URL.
+// Without a source path, every root group of the source target is copied to the root of this target.
+// With a source path, that group and everything below it is copied to the destination path, the last
+// item of which becomes the name of the copy (the source group's name is used if the destination is the root).
+// The schemas of the target types that can hold root groups, to check a target exists.
+const TARGET_MODELS = {
+  model: Model,
+  site: Site,
+  virtual_device: VirtualDevice,
+  device: Device,
+};
+
+const target_exists = async (target_type, target_id) => {
+  return !!TARGET_MODELS[target_type] && !!(await TARGET_MODELS[target_type].exists({ id: target_id }));
+}
+
+const copy_config = async (req, res) => {
+  const source = req.body.copy_from;
+  const dest_path = req.params[0] ? req.params[0].split("/") : [];
+  const source_path = source.path ? source.path.split("/") : [];
+
+  if (!source.target_type || !source.target_id) {
+    return res.status(400).json({ message: "copy_from must contain a target_type and target_id." });
+  }
+
+  // Copying from or to a target that doesn't exist would read nothing, or write groups nothing uses.
+  if (!await target_exists(source.target_type, source.target_id)) {
+    return res.status(404).json({ message: "Source target not found." });
+  }
+
+  if (ROOT_TARGET_TYPES.includes(req.params.target_type) && !await target_exists(req.params.target_type, req.params.target_id)) {
+    return res.status(404).json({ message: "Target not found." });
+  }
+
+  logger.debug(`router: copy: copying ${source.target_type}/${source.target_id}/${source_path.join("/")} to ${req.params.target_type}/${req.params.target_id}/${dest_path.join("/")}`);
+
+  // Find the source groups, either the whole layer or a single group.
+  let subtree;
+  if (source_path.length == 0) {
+    if (dest_path.length > 0) {
+      return res.status(400).json({ message: "A whole target can only be copied to the root of another target." });
+    }
+
+    subtree = await load_layer(source.target_type, source.target_id);
+  } else {
+    const source_groups = await recursive_resolve(source.target_type, source.target_id, source_path.join("/"));
+
+    if (!source_groups || source_groups.length != source_path.length || source_groups[source_groups.length - 1].name != source_path[source_path.length - 1]) {
+      return res.status(404).json({ message: "Source group not found." });
+    }
+
+    if (source_groups[source_groups.length - 1].value) {
+      return res.status(400).json({ message: "Only groups can be copied." });
+    }
+
+    subtree = await load_subtree({ id: source_groups[source_groups.length - 1].id });
+  }
+
+  if (subtree.length == 0) {
+    return res.status(404).json({ message: "Source has no configuration to copy." });
+  }
+
+  // Work out where the copied root group(s) go.
+  let retarget;
+  if (dest_path.length <= 1) {
+    // Root groups of this target.
+    if (!ROOT_TARGET_TYPES.includes(req.params.target_type)) {
+      logger.debug(`router: copy: aborting, invalid target_type: ${req.params.target_type}.`)
+      return res.status(400).json({ message: "Invalid target_type." });
+    }
+
+    retarget = (group) => ({
+      target_type: req.params.target_type,
+      target_id: req.params.target_id,
+      name: dest_path.length == 1 ? dest_path[0] : group.name,
+    });
+  } else {
+    // Child of an existing group, all parents must exist.
+    const dest_groups = await recursive_resolve(req.params.target_type, req.params.target_id, dest_path.join("/"));
+
+    if (!dest_groups || dest_groups.length < dest_path.length - 1) {
+      return res.status(404).json({ message: "One or more of the parent groups could not be found." });
+    }
+
+    if (dest_groups.length == dest_path.length) {
+      return res.status(409).json({ message: "An element OR group with this name already exists." });
+    }
+
+    const parent = dest_groups[dest_path.length - 2];
+    if (parent.value) {
+      return res.status(400).json({ message: "The destination parent is an element." });
+    }
+
+    retarget = () => ({ target_type: 'group', target_id: parent.id, name: dest_path[dest_path.length - 1] });
+  }
+
+  // Check none of the new root groups already exist. This is checked again inside the transaction, so a group created
+  // with the same name in the meantime isn't duplicated, the first check saves seeding versions for a copy that can't
+  // happen.
+  const new_subtree = clone_subtree(subtree, retarget);
+  const new_ids = new Set(new_subtree.groups.map((group) => group.id));
+  const new_roots = new_subtree.groups.filter((group) => group.target_type != 'group' || !new_ids.has(group.target_id));
+  const find_conflicts = (session) => Group.find(
+    { $or: new_roots.map((group) => ({ target_type: group.target_type, target_id: group.target_id, name: group.name })) },
+    null,
+    { session },
+  );
+  const conflict_response = (conflicts) => res.status(409).json({
+    message: "An element OR group with this name already exists.",
+    conflicts: conflicts.map((group) => group.name),
+  });
+
+  const conflicts = await find_conflicts(null);
+  if (conflicts.length > 0) {
+    return conflict_response(conflicts);
+  }
+
+  await seed_versions(req);
+  const result = await with_transaction(async (session) => {
+    const conflicts = await find_conflicts(session);
+    if (conflicts.length > 0) return { conflicts: conflicts };
+
+    return await insert_subtree(new_subtree, session);
+  });
+
+  if (result.conflicts) {
+    return conflict_response(result.conflicts);
+  }
+
+  logger.info(`router: copy: copied ${result.groups} groups and ${result.elements} elements from ${source.target_type}/${source.target_id} to ${req.params.target_type}/${req.params.target_id}`);
+  notify_config_changed(req);
+  return res.status(201).json({
+    groups: result.groups,
+    elements: result.elements,
+    roots: new_roots,
+  });
+}
+
 // Create a new config element/group, assume group unless "value" is specified, then assume element.
 // All parents, if any, must be resolved. If there is only one item in the path, it must be a group
 // And it's target_type and target_id should match that from the URL.
 // Otherwise, for children, the target_type should be group and the target_id should be the ID of the
 // parent, from the resolver.
+// If the body contains "copy_from", the group is instead copied from elsewhere, see copy_config.
 router.post('/*', async (req, res) => {
+  if (req.body.copy_from) {
+    return await copy_config(req, res);
+  }
+
   logger.debug("router: call to POST /*, invoking recursive_resolve against " + req.params.target_type + "/" + req.params.target_id + "/" + req.params[0]);
   const groups = await recursive_resolve(req.params.target_type, req.params.target_id, req.params[0]);
 
@@ -235,8 +421,11 @@ router.post('/*', async (req, res) => {
       });
 
       // Save the element
+      await seed_versions(req);
       await element.save();
 
+      notify_config_changed(req);
+
       // Return the element
       return res.status(201).json(element);
     } else {
@@ -252,8 +441,11 @@ router.post('/*', async (req, res) => {
       });
 
       // Save the group
+      await seed_versions(req);
       await group.save();
 
+      notify_config_changed(req);
+
       // Return the group
       return res.status(201).json(group);
     }
@@ -273,7 +465,7 @@ router.post('/*', async (req, res) => {
     // Create a new group
     logger.debug(`router: post*: creating new group from path above, this is a root group.`)
 
-    if (!['model', 'site', 'device'].includes(req.params.target_type)) {
+    if (!ROOT_TARGET_TYPES.includes(req.params.target_type)) {
       logger.debug(`router: create_new_group: aborting, invalid target_type: ${req.params.target_type}.`)
       return res.status(400).json({ message: "Invalid target_type." });
     }
@@ -287,8 +479,11 @@ router.post('/*', async (req, res) => {
     });
 
     // Save the group
+    await seed_versions(req);
     await group.save();
 
+    notify_config_changed(req);
+
     // Return the group
     return res.status(201).json(group);
   }
@@ -332,15 +527,108 @@ router.patch('/*', async (req, res) => {
   element.enable = req.body.enable || true;
 
   // Save the element
+  await seed_versions(req);
   await element.save();
 
+  notify_config_changed(req);
+
   // Return the element
   return res.status(200).json(element);
 })
 
+// Check a configuration tree from a request only contains groups (objects) and values (strings, numbers or booleans),
+// and that the root only contains groups. Returns an error message, or null if the tree is valid.
+const validate_tree = (tree, path = '') => {
+  if (typeof tree !== 'object' || tree === null || Array.isArray(tree)) {
+    return `${path || 'config'} must be an object.`;
+  }
+
+  for (const [key, value] of Object.entries(tree)) {
+    if (key == '' || key.includes('.') || key.includes('/') || !is_safe_name(key)) {
+      return `${path}${key} is not a valid name.`;
+    }
+
+    if (typeof value === 'object') {
+      const error = validate_tree(value, `${path}${key}.`);
+      if (error) return error;
+    } else if (path == '') {
+      return `${key} must be a group, root elements are not supported.`;
+    } else if (!['string', 'number', 'boolean'].includes(typeof value)) {
+      return `${path}${key} must be a string, number or boolean.`;
+    }
+  }
+
+  return null;
+}
+
+// Replace the whole configuration tree of a target in one request.
+// The body contains either "config", a nested tree ({"account": {"1": {"enable": 1}}}), or "values",
+// a list of [dotted key, value] pairs ([["account.1.enable", 1]]).
+// The stored tree is read once, and the differences are written with one bulkWrite per collection,
+// groups/elements missing from the request are deleted. With ?dry_run=true nothing is written.
+router.put('/', async (req, res) => {
+  const dry_run = req.query.dry_run == 'true';
+  logger.debug(`router: request to PUT / for ${req.params.target_type}/${req.params.target_id}, dry_run: ${dry_run}`);
+
+  if (!ROOT_TARGET_TYPES.includes(req.params.target_type)) {
+    logger.debug(`router: put: aborting, invalid target_type: ${req.params.target_type}.`)
+    return res.status(400).json({ message: "Invalid target_type." });
+  }
+
+  let desired = req.body.config;
+  if (req.body.values) {
+    if (!Array.isArray(req.body.values)) {
+      return res.status(400).json({ message: "values must be a list of [key, value] pairs." });
+    }
+
+    try {
+      desired = unflatten_values(req.body.values);
+    } catch (err) {
+      return res.status(400).json({ message: err.message });
+    }
+  }
+
+  const error = validate_tree(desired);
+  if (error) {
+    return res.status(400).json({ message: error });
+  }
+
+  const plan = await plan_reconcile(req.params.target_type, req.params.target_id, desired);
+
+  if (!dry_run && plan.changes.length > 0) {
+    await seed_versions(req);
+    await with_transaction((session) => apply_reconcile(plan, session));
+    notify_config_changed(req);
+    logger.info(`router: put: applied ${plan.changes.length} changes to ${req.params.target_type}/${req.params.target_id}`);
+  }
+
+  return res.status(200).json({
+    dry_run: dry_run,
+    summary: summarise_reconcile(plan),
+    changes: plan.changes,
+  });
+});
+
 // Delete an element/group, determined automatically by the existance of "value"
+// Groups with children are only deleted with ?recursive=true, which removes the whole subtree at once.
+// A recursive delete without a path removes every group configured on the target.
 router.delete('/*', async (req, res) => {
   logger.debug(`router: request to DELETE /* path ${req.params[0]}.`);
+  const recursive = req.query.recursive == 'true';
+
+  if (!req.params[0]) {
+    if (!recursive) {
+      return res.status(400).json({ message: "Deleting all configuration requires recursive=true." });
+    }
+
+    const subtree = await load_layer(req.params.target_type, req.params.target_id);
+    await seed_versions(req);
+    const result = await with_transaction((session) => delete_groups(subtree.map((group) => group.id), session));
+
+    logger.info(`router: delete*: deleted ${result.groups} groups and ${result.elements} elements from ${req.params.target_type}/${req.params.target_id}`);
+    notify_config_changed(req);
+    return res.status(200).json(result);
+  }
 
   const groups = await recursive_resolve(req.params.target_type, req.params.target_id, req.params[0]);
 
@@ -362,8 +650,19 @@ router.delete('/*', async (req, res) => {
   // If it's an element, delete it.
   if (groups[groups.length - 1].value) {
     logger.debug(`router: delete*: deleting element ${groups[groups.length - 1].id}.`)
+    await seed_versions(req);
     await Element.deleteOne({ id: groups[groups.length - 1].id })
+    notify_config_changed(req);
     return res.status(200).send();
+  } else if (recursive) {
+    // Delete the group and everything below it.
+    const subtree = await load_subtree({ id: groups[groups.length - 1].id });
+    await seed_versions(req);
+    const result = await with_transaction((session) => delete_groups(subtree.map((group) => group.id), session));
+
+    logger.debug(`router: delete*: recursively deleted group ${groups[groups.length - 1].id}, ${result.groups} groups and ${result.elements} elements.`)
+    notify_config_changed(req);
+    return res.status(200).json(result);
   } else {
     // If it's a group, check for any children.
     const child_groups = await Group.find({ target_type: 'group', target_id: groups[groups.length - 1].id });
@@ -372,12 +671,15 @@ router.delete('/*', async (req, res) => {
     if (child_groups.length > 0 || child_elements.length > 0) {
       // There are children, return 409.
       logger.debug(`router: delete*: group ${groups[groups.length - 1].id} has children, returning 409.`)
-      return res.status(409).json({ message: "Group has children." });
+      return res.status(409).json({ message: "Group has children, use recursive=true to delete them too." });
     }
 
     logger.debug(`router: delete*: deleting group ${groups[groups.length - 1].id}`)
+    await seed_versions(req);
     await Group.deleteOne({ id: groups[groups.length - 1].id })
 
+    notify_config_changed(req);
+
     // Return 200
     return res.status(200).send();
   }
@@ -5,10 +5,12 @@
 
 import { customAlphabet } from 'nanoid';
 import { Router } from 'express';
+import { EventEmitter } from 'events';
 
 import { Device } from '../mongo/schemas/device.js';
 import { Site } from '../mongo/schemas/site.js';
 import { Model } from '../mongo/schemas/model.js';
+import { VirtualDevice } from '../mongo/schemas/virtual_device.js';
 
 import { logger } from '../index.js';
 
@@ -17,6 +19,9 @@ const nanoid = customAlphabet('1234567890abcdef', 8);
 
 const router = Router({ mergeParams: true });
 
+// 'devices_changed' is emitted whenever a device is added or deleted, so the set of known MAC addresses changed.
+export const deviceEmitter = new EventEmitter();
+
 // This router expects to be behind a site ID, (i.e., /sites/:id/devices/:id)
 // So any "all" lookups should be done at the site level, not globally.
 
@@ -92,6 +97,7 @@ router.post('/', async (req, res) => {
   req.body.site_id = req.params.site; // Bit of a hack.
   const device = new Device(req.body);
   await device.save();
+  deviceEmitter.emit('devices_changed');
   res.json(device);
 
   logger.info(`Created new device, ID: ${req.body.id}, name: ${req.body.name}, mac: ${req.body.mac_address}`);
@@ -167,6 +173,68 @@ router.delete('/:id/enable', async (req, res) => {
   logger.info(`Disabled device, ID: ${device.id}`);
 });
 
+// Link a virtual device to this device, its configuration will be mirrored onto the device.
+// Virtual devices are applied in the order they're linked, after the site and before the device.
+router.post('/:id/virtual_devices', async (req, res) => {
+  const device = await Device.findOne({ id: req.params.id, site_id: req.params.site });
+  if (!device) {
+    res.status(404).json({
+      error: 'not_found',
+      message: `Device not found`,
+    })
+    return;
+  }
+
+  const virtual_device = await VirtualDevice.findOne({ id: req.body.virtual_device_id, site_id: req.params.site });
+  if (!virtual_device) {
+    res.status(400).json({
+      error: 'invalid_virtual_device',
+      message: 'The virtual_device_id provided does not exist, or is not a member of this site.',
+    })
+    return;
+  }
+
+  if (device.virtual_device_ids.includes(virtual_device.id)) {
+    res.status(400).json({
+      error: 'virtual_device_already_linked',
+      message: 'This virtual device is already linked to the device.',
+    })
+    return;
+  }
+
+  device.virtual_device_ids.push(virtual_device.id);
+  await device.save();
+  res.json(device);
+
+  logger.info(`Linked virtual device ${virtual_device.id} to device ${device.id}`);
+});
+
+// Unlink a virtual device from this device.
+router.delete('/:id/virtual_devices/:virtual_device_id', async (req, res) => {
+  const device = await Device.findOne({ id: req.params.id, site_id: req.params.site });
+  if (!device) {
+    res.status(404).json({
+      error: 'not_found',
+      message: `Device not found`,
+    })
+    return;
+  }
+
+  if (!device.virtual_device_ids.includes(req.params.virtual_device_id)) {
+    res.status(404).json({
+      error: 'virtual_device_not_linked',
+      message: 'This virtual device is not linked to the device.',
+    })
+    return;
+  }
+
+  device.virtual_device_ids.pull(req.params.virtual_device_id);
+  await device.save();
+  res.json(device);
+
+  logger.info(`Unlinked virtual device ${req.params.virtual_device_id} from device ${device.id}`);
+});
+
 // Delete a device
 router.delete('/:id', async (req, res) => {
   const device = await Device.findOne({ id: req.params.id, site_id: req.params.site });
@@ -180,6 +248,7 @@ router.delete('/:id', async (req, res) => {
 
   // Delete the device
   await Device.deleteOne({ id: req.params.id });
+  deviceEmitter.emit('devices_changed');
 
   res.json({
     status: 'device_deleted',
@@ -5,15 +5,21 @@
 // It splits the configuration elements into a hierarchy of configuratin in JSON.
 
 import { Router } from 'express';
-import { Element } from '../mongo/schemas/config.js';
-import { Group } from '../mongo/schemas/group.js';
 import { Device } from '../mongo/schemas/device.js';
 import { Site } from '../mongo/schemas/site.js';
 import { Model } from '../mongo/schemas/model.js';
 import { EventEmitter } from 'events';
+import crypto from 'crypto';
 
 import mergician from 'mergician';
 
+import { layerCache, compile_layer } from '../lib/layer_cache.js';
+import { flatten_tree } from '../lib/config_tree.js';
+import { layer_hash, deviceLayerHashes } from '../lib/config_versions.js';
+import { track_fetch_queries, phase_timer } from '../lib/instrumentation.js';
+import { accessControl } from '../lib/access_control.js';
+import { BloomFilter } from '../../shared/bloom.js';
+
 // Create event emitter
 export const fetchEmitter = new EventEmitter();
 
@@ -21,52 +27,156 @@ import { logger } from '../index.js';
 
 export const router = Router({ mergeParams: true });
 
-const get_children_object = async (root_id) => {
-  // Get all children for the root_id, store them in a JSON object that
-  // that has parent.children = [{child}] etc.
-  // Include elements in the group as "elements"
+// Compare a credential from a request against the stored one in constant time, so response times don't reveal
+// how much of it matched. Both are hashed first, as timingSafeEqual needs inputs of the same length.
+const credential_matches = (supplied, stored) => {
+  if (typeof supplied != 'string' || typeof stored != 'string') return false;
+
+  const digest = (value) => crypto.createHash('sha256').update(value).digest();
+  return crypto.timingSafeEqual(digest(supplied), digest(stored));
+}
+
+// Configuration agents pass the address of the device as client_ip, which access rules are checked against. With
+// AGENT_TOKEN set, client_ip is only trusted from requests with a matching X-Agent-Token header, otherwise the address
+// of the request itself is used. Without it, client_ip is always trusted, so the API server must only be reachable
+// by configuration agents.
+const AGENT_TOKEN = process.env.AGENT_TOKEN;
+const from_agent = (req) => !AGENT_TOKEN || credential_matches(req.get('X-Agent-Token'), AGENT_TOKEN);
 
-  let tree = {};
+const client_address = (req) => {
+  return from_agent(req) ? req.query.client_ip || req.ip : req.ip;
+}
 
-  const child_groups = await Group.find({ target_type: "group", target_id: root_id });
-  const child_elements = await Element.find({ group_id: root_id });
+// The known MACs filter is rebuilt at most every KNOWN_MACS_TTL seconds, and straight away after a device is added or
+// deleted (see invalidate_known_macs). Configuration agents poll it with If-None-Match so an unchanged filter is a 304.
+const KNOWN_MACS_TTL = (parseInt(process.env.KNOWN_MACS_TTL) || 10) * 1000;
+const KNOWN_MACS_FP_RATE = parseFloat(process.env.KNOWN_MACS_FP_RATE) || 0.01;
+let known_macs = null;
 
-  // Add the elements to the tree
-  tree.elements = child_elements;
-  tree.children = [];
+// Called when devices are added or deleted (relayed between workers in cluster mode).
+export const invalidate_known_macs = () => {
+  known_macs = null;
+}
 
-  // Recursively add the children of the groups to the tree
-  for (const child_group of child_groups) {
-    tree['children'][child_group.name] = await get_children_object(child_group.id);
+const build_known_macs = async () => {
+  const devices = await Device.find({}, { _id: 0, mac_address: 1 }).lean();
+
+  const filter = BloomFilter.for_capacity(devices.length, KNOWN_MACS_FP_RATE);
+  for (const device of devices) {
+    filter.add(device.mac_address.toUpperCase());
   }
 
-  return tree;
+  const body = JSON.stringify({ count: devices.length, ...filter.to_json() });
+  return {
+    body: body,
+    etag: `"${crypto.createHash('sha1').update(body).digest('hex')}"`,
+    expires: Date.now() + KNOWN_MACS_TTL,
+  };
 }
 
-const get_json_structure = async (group_element_tree) => {
-  // Recursively build a JSON structure from the group_element_tree. Only uses the group name/element name as the key.
-  // If an element has a value, it is stored as the value of the key.
-  // Each group should beocme a JSON object, each element should become a key/value pair. Some groups may be empty.
+// Get a Bloom filter of every known MAC address (uppercase), used by configuration agents to reject requests
+// for unknown devices without calling the API server. See shared/bloom.js.
+// Like client_ip, this is only served to configuration agents when AGENT_TOKEN is set, as it reveals every MAC address.
+router.get('/known_macs', async (req, res) => {
+  if (!from_agent(req)) {
+    res.status(403).json({
+      error: 'forbidden',
+      message: 'Known MACs are only available to configuration agents',
+    })
+    return;
+  }
 
-  let json_structure = {};
+  if (!known_macs || known_macs.expires < Date.now()) {
+    known_macs = await build_known_macs();
+  }
 
-  // Add the elements to the json_structure
-  for (const element of group_element_tree.elements) {
-    json_structure[element.name] = element.value;
+  res.set('Content-Type', 'application/json');
+  res.set('ETag', known_macs.etag);
+  if (req.fresh) {
+    res.status(304).end();
+    return;
   }
 
-  // Recursively add the children of the groups to the json_structure
-  const downstream_children = group_element_tree.children;
-  for (const [group_name, group_element_tree] of Object.entries(downstream_children)) {
-    json_structure[group_name] = await get_json_structure(group_element_tree);
+  res.send(known_macs.body);
+});
+
+// Get the common cfg configuration of a model, by its common cfg file name (i.e., y000000000123), authenticated with a
+// site password. The site is identified by the MAC address of the phone making the request, as with device fetches,
+// and the password checked against it. This is the model's configuration layer only, phones fetch it before their
+// <MAC>.cfg, which can then leave the model layer out (see exclude_common below). Supports ?format=compact like
+// device fetches.
+// Access rules aren't checked, the model's configuration isn't specific to a site or device, they're checked when
+// the phone fetches its <MAC>.cfg.
+router.get('/model/:common_cfg', async (req, res) => {
+  if (req.query.authentication_mode != "site_pw" || typeof req.query.password != 'string' || typeof req.query.mac != 'string') {
+    res.status(403).json({
+      error: 'forbidden',
+      message: 'Common cfg files require site password authentication and the MAC address of the device',
+    })
+    return;
   }
 
-  return json_structure;
-}
+  const device = await Device.findOne({ mac_address: req.query.mac.toUpperCase() });
+  const site = device ? await Site.findOne({ id: device.site_id }) : null;
+  if (!site || !credential_matches(req.query.password, site.password)) {
+    logger.debug("Aborting, unknown device or incorrect site password for common cfg.")
+    res.status(403).json({
+      error: 'forbidden',
+      message: 'Incorrect password',
+    })
+    return;
+  }
+
+  if (!device.enable || !site.enable) {
+    res.status(403).json({
+      error: 'forbidden',
+      message: device.enable ? 'Site is not enabled' : 'Device is not enabled.',
+    })
+    return;
+  }
+
+  const model = await Model.findOne({ common_cfg: req.params.common_cfg });
+  if (!model) {
+    res.status(404).json({
+      error: 'not_found',
+      message: 'No model uses that common cfg file',
+    })
+    return;
+  }
+
+  const config_tree = await layerCache.get("model", model.id);
+  logger.debug(`fetch: sending common cfg ${req.params.common_cfg} for model ${model.name} (${model.id})`);
+
+  if (req.query.format == 'compact') {
+    res.json({
+      format: 'compact',
+      model: { id: model.id, name: model.name, vendor: model.vendor, common_cfg: model.common_cfg },
+      config: flatten_tree(config_tree),
+    })
+  } else {
+    res.json({
+      model: model,
+      config: config_tree,
+    })
+  }
+});
 
 // Get a device by MAC address and password, if both match, return site, device, model and configuration.
-// Build the configuration by taking all global elements  and then all site elements and then all device elements, overwriting as needed.
-router.get('/device/:mac', async (req, res) => {
+// Build the configuration by taking all model elements, then all site elements, then the elements of any linked virtual devices
+// and then all device elements, overwriting as needed.
+// Access rules (IP allowlists and provisioning windows) are checked in memory once the request is authenticated, against
+// the address of the device (see client_address).
+// With ?exclude_common=<common cfg file name> (i.e., y000000000123), the model layer is left out if it's the model's common
+// cfg file, as the phone has been served it already.
+// With ?format=compact, only the fields a configuration agent needs are returned (no passwords), and the configuration
+// is a list of [dotted key, value] pairs in the order they should be written, i.e., [["account.1.enable", "1"]].
+// Metrics: the MongoDB queries made by each fetch are counted, and the time spent in each phase recorded.
+// "auth" covers looking up and validating the device, site and model.
+router.get('/device/:mac', track_fetch_queries, async (req, res) => {
+  const mark_phase = phase_timer();
+  const started = process.hrtime.bigint();
+  const elapsed_ms = () => Number(process.hrtime.bigint() - started) / 1e6;
+
   let authentication_mode = "device_pw";
   // TODO: temporary measure for site passwords until Yealink authentication is resolved.
   if (req.query.authentication_mode != undefined) {
@@ -75,6 +185,8 @@ router.get('/device/:mac', async (req, res) => {
     }
   }
 
+  const source_ip = client_address(req);
+
   req.params.mac = req.params.mac.toUpperCase();
   logger.debug(`fetch: fetching configuration for device ${req.params.mac} with authentication mode ${authentication_mode}`)
   const device = await Device.findOne({ mac_address: req.params.mac });
@@ -97,7 +209,9 @@ router.get('/device/:mac', async (req, res) => {
     fetchEmitter.emit('audit_device_fetch', device, {
       result: 'fail',
       reason: 'device_not_enabled',
-      message: "Attempt to fetch configuration for disabled device."
+      message: "Attempt to fetch configuration for disabled device.",
+      source_ip: source_ip,
+      duration_ms: elapsed_ms(),
     });
 
     return;
@@ -115,7 +229,9 @@ router.get('/device/:mac', async (req, res) => {
     fetchEmitter.emit('audit_device_fetch', device, {
       result: 'fail',
       reason: 'site_not_found',
-      message: "Attempt to fetch configuration for device with invalid site ID."
+      message: "Attempt to fetch configuration for device with invalid site ID.",
+      source_ip: source_ip,
+      duration_ms: elapsed_ms(),
     });
 
     return;
@@ -137,13 +253,15 @@ router.get('/device/:mac', async (req, res) => {
         fetchEmitter.emit('audit_device_fetch', device, {
           result: 'fail',
           reason: 'incorrect_username',
-          message: "Attempt to fetch configuration with incorrect username."
+          message: "Attempt to fetch configuration with incorrect username.",
+          source_ip: source_ip,
+          duration_ms: elapsed_ms(),
         });
     
         return;
       }
     
-      if (device.password != req.query.password) {
+      if (!credential_matches(req.query.password, device.password)) {
         logger.debug("Aborting, incorrect device password.")
         res.status(403).json({
           error: 'forbidden',
@@ -153,7 +271,9 @@ router.get('/device/:mac', async (req, res) => {
         fetchEmitter.emit('audit_device_fetch', device, {
           result: 'fail',
           reason: 'incorrect_password',
-          message: "Attempt to fetch configuration with incorrect password."
+          message: "Attempt to fetch configuration with incorrect password.",
+          source_ip: source_ip,
+          duration_ms: elapsed_ms(),
         });
         return;
       }
@@ -161,12 +281,21 @@ router.get('/device/:mac', async (req, res) => {
       break;
 
     case "site_pw":
-      if (req.query.password != site.password) {
+      if (!credential_matches(req.query.password, site.password)) {
         logger.debug("Aborting, incorrect site password.")
-        return res.status(403).json({
+        res.status(403).json({
           error: 'forbidden',
           message: 'Incorrect password',
         })
+
+        fetchEmitter.emit('audit_device_fetch', device, {
+          result: 'fail',
+          reason: 'incorrect_site_password',
+          message: "Attempt to fetch configuration with incorrect site password.",
+          source_ip: source_ip,
+          duration_ms: elapsed_ms(),
+        });
+        return;
       }
       break;
 
@@ -179,6 +308,26 @@ router.get('/device/:mac', async (req, res) => {
       return;
   }
 
+  // Access rules are only checked for authenticated requests, so they can't be used to find out which devices exist.
+  const denied = accessControl.check(device.site_id, device.id, source_ip);
+  if (denied) {
+    logger.debug(`Aborting, access rules denied fetch from ${source_ip}: ${denied.reason}`)
+    res.status(403).json({
+      error: 'forbidden',
+      message: denied.reason == 'ip_not_allowed' ? 'Address not allowed' : 'Outside of provisioning window',
+    })
+
+    fetchEmitter.emit('audit_device_fetch', device, {
+      result: 'fail',
+      reason: denied.reason,
+      message: denied.message,
+      source_ip: source_ip,
+      duration_ms: elapsed_ms(),
+    });
+
+    return;
+  }
+
   logger.debug("fetch: Authentication successful, validating site")
 
   if (!site.enable) {
@@ -191,7 +340,9 @@ router.get('/device/:mac', async (req, res) => {
     fetchEmitter.emit('audit_device_fetch', device, {
       result: 'fail',
       reason: 'site_not_enabled',
-      message: "Attempt to fetch configuration for device with disabled site."
+      message: "Attempt to fetch configuration for device with disabled site.",
+      source_ip: source_ip,
+      duration_ms: elapsed_ms(),
     });
 
     return;
@@ -208,90 +359,74 @@ router.get('/device/:mac', async (req, res) => {
     fetchEmitter.emit('audit_device_fetch', device, {
       result: 'fail',
       reason: 'model_not_found',
-      message: "Attempt to fetch configuration for device with invalid model ID."
+      message: "Attempt to fetch configuration for device with invalid model ID.",
+      source_ip: source_ip,
+      duration_ms: elapsed_ms(),
     });
 
     return;
   }
 
   logger.debug("fetch: Authentication successful, building configuration.")
+  mark_phase('auth');
 
   // Build a JSON schema of the configuration, for example: {"account": {"1": {"password": "test"}}}
-  // This requires resolving all groups for the target_type, then finding all children, and finally all elements
-  // noting that some parents may have elements assigned to them.
-  // Do this in the order of global, model, site, device.
-  // Overwrite as we go.
-
-  // Fetch all parent configuration groups for all target_types that affect this device.
-  // This includes a target to the model_id, a target to the site_id and a target for the device itself.
-  // Apply these in order, overwriting as we go.
-
-  // Get model configuration groups, their children and any elements assigned to them.
-  // This must be done recursively, as groups may have children, and children may have children.
-  // Elements can be assigned to any of the groups, and some groups may have elements and child groups.
-
-  let config_tree = {};
-
-  // Get all model configuration groups.
-  logger.debug(`fetch: config_builder: get model config groups for ${model.name} (${model.id})`)
-  const model_config_root_groups = await Group.find({ target_type: "model", target_id: model.id });
-
-  // Get elements and children for each root group.
-  let model_config_tree = {};
-  for (const model_config_root_group of model_config_root_groups) {
-    const root_children = await get_children_object(model_config_root_group.id);
-    
-    // Build configuration JSON structure from the root children.
-    model_config_tree[model_config_root_group.name] = await get_json_structure(root_children);
-  }
-
-  // Get site configuration groups, their children and any elements assigned to them.
-  logger.debug(`fetch: config_builder: get site config groups for ${site.name} (${site.id})`)
-  const site_config_root_groups = await Group.find({ target_type: "site", target_id: site.id });
-
-  let site_config_tree = {};
-  for (const site_config_root_group of site_config_root_groups) {
-    const root_children = await get_children_object(site_config_root_group.id);
-
-    // Build configuration JSON structure from the root children.
-    site_config_tree[site_config_root_group.name] = await get_json_structure(root_children);
-  }
-
-  // Get device configuration groups, their children and any elements assigned to them.
-  logger.debug(`fetch: config_builder: get device config groups for ${device.id} (${device.id})`)
-  const device_config_root_groups = await Group.find({ target_type: "device", target_id: device.id });
-
-  let device_config_tree = {};
-  for (const device_config_root_group of device_config_root_groups) {
-    const root_children = await get_children_object(device_config_root_group.id);
-
-    // Build configuration JSON structure from the root children.
-    device_config_tree[device_config_root_group.name] = await get_json_structure(root_children);
+  // Each layer is every group (and their children and elements) targeting the model, the site, any virtual devices
+  // linked to the device and finally the device itself. Apply these in order, overwriting as we go, so a linked
+  // virtual device clobbers settings on the site, but not settings on the device.
+
+  // The model, site and virtual device layers are shared by many devices, so these come from the compiled layer cache.
+  // The device layer is only used by this device, so it's always compiled from the database.
+  logger.debug(`fetch: config_builder: get config layers for ${model.name} (${model.id}), ${site.name} (${site.id}), ${device.virtual_device_ids.length} virtual devices and device ${device.id}`)
+  const exclude_model = !!model.common_cfg && req.query.exclude_common == model.common_cfg;
+  const device_generation = deviceLayerHashes.generation("device", device.id);
+  const targets = [
+    ...(exclude_model ? [] : [["model", model.id]]),
+    ["site", site.id],
+    ...device.virtual_device_ids.map((virtual_device_id) => ["virtual_device", virtual_device_id]),
+    ["device", device.id],
+  ];
+  const layers = await Promise.all(targets.map(([target_type, target_id]) => {
+    return target_type == "device" ? compile_layer(target_type, target_id) : layerCache.get(target_type, target_id);
+  }));
+  mark_phase('layer_resolution');
+
+  // Merge the configuration trees together, overwriting as we go.
+  const config_tree = layers.reduce((tree, layer) => mergician(tree, layer), {});
+  mark_phase('merge');
+
+  res.locals.fetch_result = 'success';
+  if (req.query.format == 'compact') {
+    res.json({
+      format: 'compact',
+      site: { id: site.id, name: site.name },
+      device: { id: device.id, name: device.name, mac_address: device.mac_address },
+      model: { id: model.id, name: model.name, vendor: model.vendor },
+      config: flatten_tree(config_tree),
+    })
+  } else {
+    res.json({
+      site: site,
+      device: device,
+      model: model,
+      config: config_tree,
+    })
   }
-
-  // Merge the three configuration trees together, overwriting as we go.
-  // This is done in the order of model, site, device.
-
-  // Merge model and site.
-  const model_site_config_tree = mergician(model_config_tree, site_config_tree);
-
-  // Merge model+site and device.
-  config_tree = mergician(model_site_config_tree, device_config_tree);
-
-  console.log("=============")
-  console.dir(config_tree);
-
-  res.json({
-    site: site,
-    device: device,
-    model: model,
-    config: config_tree,
-  })
+  mark_phase('render');
 
   fetchEmitter.emit('audit_device_fetch', device, {
     result: 'success',
     reason: "auth_ok_config_present",
-    message: "Successfully fetched configuration for device."
+    message: "Successfully fetched configuration for device.",
+    source_ip: source_ip,
+    duration_ms: elapsed_ms(),
+    // The content hash of each layer served, these identify the layer versions (see routes/versions.js).
+    // The device layer is compiled for every fetch, so its hash is kept until its configuration changes.
+    layers: targets.map(([target_type, target_id], i) => ({
+      target_type: target_type,
+      target_id: target_id,
+      hash: target_type == "device" ? deviceLayerHashes.get(target_type, target_id, device_generation, layers[i]) : layer_hash(layers[i]),
+    })),
   });
 
   logger.debug("router: configuration sent successfully, done.")
@@ -15,6 +15,26 @@ const nanoid = customAlphabet('1234567890abcdef', 8);
 
 const router = Router({ mergeParams: true });
 
+// Check a common cfg file name is valid and not used by another model, returns an error response or null.
+const validate_common_cfg = async (common_cfg, model_id) => {
+  if (!/^y[0-9]{12}$/.test(common_cfg)) {
+    return {
+      error: 'Bad Request',
+      message: 'common_cfg must be a Yealink common cfg file name without .cfg, i.e., y000000000123.',
+    };
+  }
+
+  const existing = await Model.findOne({ common_cfg: common_cfg, id: { $ne: model_id } });
+  if (existing) {
+    return {
+      error: 'Bad Request',
+      message: `common_cfg is already used by model ${existing.id}.`,
+    };
+  }
+
+  return null;
+}
+
 // Get all models
 router.get('/', async (req, res) => {
   const models = await Model.find();
@@ -46,6 +66,14 @@ router.post('/', async (req, res) => {
     return;
   }
   
+  if (req.body.common_cfg) {
+    const error = await validate_common_cfg(req.body.common_cfg, null);
+    if (error) {
+      res.status(400).json(error);
+      return;
+    }
+  }
+
   // Generate a new ID
   req.body.id = nanoid(8);
 
@@ -57,7 +85,7 @@ router.post('/', async (req, res) => {
   logger.info(`Created new phone model, ID: ${req.body.id}, name: ${req.body.name}`);
 });
 
-// Rename a model
+// Rename a model, or set its common cfg file (an empty common_cfg removes it)
 router.patch('/:id', async (req, res) => {
   const model = await Model.findOne({ id: req.params.id });
   if (!model) {
@@ -69,16 +97,25 @@ router.patch('/:id', async (req, res) => {
   }
 
   // Verify required elements are present
-  if (!req.body.name) {
+  if (!req.body.name && req.body.common_cfg === undefined) {
     res.status(400).json({
       error: 'Bad Request',
-      message: 'The request body must contain a name property',
+      message: 'The request body must contain a name or common_cfg property',
     })
     return;
   }
 
+  if (req.body.common_cfg) {
+    const error = await validate_common_cfg(req.body.common_cfg, model.id);
+    if (error) {
+      res.status(400).json(error);
+      return;
+    }
+  }
+
   // Update the model
-  model.name = req.body.name;
+  if (req.body.name) model.name = req.body.name;
+  if (req.body.common_cfg !== undefined) model.common_cfg = req.body.common_cfg || undefined;
   await model.save();
   res.json(model);
 
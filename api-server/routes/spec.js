@@ -0,0 +1,85 @@
+// yealink-provision - Configuration Abstraction (Spec) API
+// Cameron Fleming 2023
+
+// These endpoints return the configuration spec for a model, so frontends can guide users through
+// configuration and translate Yealink values into friendly names (i.e., linekey type 16 is "BLF").
+// Specs are optional, frontends should handle a 404 here.
+
+import { Router } from 'express';
+
+import { Model } from '../mongo/schemas/model.js';
+import { specIndex, spec_to_json } from '../lib/spec_index.js';
+import { flatten_tree } from '../lib/config_tree.js';
+
+import { logger } from '../index.js';
+
+const router = Router({ mergeParams: true });
+
+// Find the compiled spec for the model in the URL, or send a 404.
+const get_spec = async (req, res) => {
+  const model = await Model.findOne({ id: req.params.model_id });
+  if (!model) {
+    res.status(404).json({
+      error: 'not_found',
+      message: 'Model not found',
+    })
+    return null;
+  }
+
+  const spec = specIndex.for_model(model.vendor, model.name);
+  if (!spec) {
+    logger.debug(`spec: no spec found for model ${model.vendor} ${model.name} (${model.id})`);
+    res.status(404).json({
+      error: 'spec_not_found',
+      message: `No configuration spec is available for ${model.vendor} ${model.name}`,
+    })
+    return null;
+  }
+
+  return spec;
+}
+
+// Get the whole spec, indexed by path pattern.
+router.get('/', async (req, res) => {
+  const spec = await get_spec(req, res);
+  if (!spec) return;
+
+  res.json(spec_to_json(spec));
+});
+
+// Get the spec for a single config path, i.e., ?path=linekey.1.type
+router.get('/lookup', async (req, res) => {
+  const spec = await get_spec(req, res);
+  if (!spec) return;
+
+  const node = specIndex.lookup(spec, req.query.path || '');
+  if (!node) {
+    res.status(404).json({
+      error: 'not_found',
+      message: `${req.query.path} is not in the configuration spec`,
+    })
+    return;
+  }
+
+  res.json(node);
+});
+
+// Validate configuration against the spec. The body contains either "config", a nested tree, or "values",
+// a list of [dotted key, value] pairs, the same as PUT /<target_type>/<target_id>/config.
+router.post('/validate', async (req, res) => {
+  const spec = await get_spec(req, res);
+  if (!spec) return;
+
+  const values = req.body.values || flatten_tree(req.body.config || {});
+  if (!Array.isArray(values)) {
+    res.status(400).json({
+      error: 'invalid_values',
+      message: 'values must be a list of [key, value] pairs.',
+    })
+    return;
+  }
+
+  res.json(specIndex.validate(spec, values.map((item) => Array.isArray(item) ? item : [item.key, item.value])));
+});
+
+export default router;
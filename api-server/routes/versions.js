@@ -0,0 +1,93 @@
+// yealink-provision - Config Versions API
+// Cameron Fleming 2023
+
+// These endpoints list and retrieve the recorded versions of a target's configuration, and roll back to them.
+// This router expects to be behind a target, (i.e., /site/:id/versions). See lib/config_versions.js.
+
+import { Router } from 'express';
+
+import { LayerVersion } from '../mongo/schemas/layer_version.js';
+import { configVersions } from '../lib/config_versions.js';
+import { flatten_tree, with_transaction, plan_reconcile, apply_reconcile, summarise_reconcile } from '../lib/config_tree.js';
+import { configEmitter } from './config.js';
+
+import { logger } from '../index.js';
+
+const router = Router({ mergeParams: true });
+
+// Target types that hold versioned configuration.
+const VERSIONED_TARGET_TYPES = ['model', 'site', 'virtual_device', 'device'];
+
+const DEFAULT_LIMIT = 100;
+const MAX_LIMIT = 1000;
+
+router.use((req, res, next) => {
+  if (!VERSIONED_TARGET_TYPES.includes(req.params.target_type)) {
+    res.status(400).json({ message: "Invalid target_type." });
+    return;
+  }
+
+  next();
+});
+
+// Get the versions of the target, newest first, up to ?limit.
+router.get('/', async (req, res) => {
+  const limit = Math.min(parseInt(req.query.limit) || DEFAULT_LIMIT, MAX_LIMIT);
+
+  const versions = await LayerVersion.find({ target_type: req.params.target_type, target_id: req.params.target_id }, { _id: 0, __v: 0 })
+    .sort({ version: -1 })
+    .limit(limit)
+    .lean();
+
+  res.json(versions);
+});
+
+// Get a version, by number or root hash, along with its configuration tree (or list of [dotted key, value] pairs with ?format=flat).
+router.get('/:version', async (req, res) => {
+  const version = await configVersions.find(req.params.target_type, req.params.target_id, req.params.version);
+  if (!version) {
+    res.status(404).json({ message: "Version not found." });
+    return;
+  }
+
+  const tree = await configVersions.load_tree(version.root_hash);
+
+  res.json({
+    ...version,
+    config: req.query.format == 'flat' ? flatten_tree(tree) : tree,
+  });
+});
+
+// Roll the target's configuration back to a version. The stored tree is reconciled with the version's tree the same
+// way as a whole-tree PUT, so only the differences are written, and the rollback is recorded as a new version.
+// With ?dry_run=true nothing is written.
+router.post('/:version/rollback', async (req, res) => {
+  const dry_run = req.query.dry_run == 'true';
+
+  const version = await configVersions.find(req.params.target_type, req.params.target_id, req.params.version);
+  if (!version) {
+    res.status(404).json({ message: "Version not found." });
+    return;
+  }
+
+  const tree = await configVersions.load_tree(version.root_hash);
+  const plan = await plan_reconcile(req.params.target_type, req.params.target_id, tree);
+
+  let new_version = null;
+  if (!dry_run && plan.changes.length > 0) {
+    await with_transaction((session) => apply_reconcile(plan, session));
+    configEmitter.emit('config_changed', { target_type: req.params.target_type, target_id: req.params.target_id });
+    new_version = await configVersions.record(req.params.target_type, req.params.target_id, { source: 'rollback', rollback_of: version.version });
+
+    logger.info(`versions: rolled back ${req.params.target_type}/${req.params.target_id} to version ${version.version}, ${plan.changes.length} changes.`);
+  }
+
+  res.json({
+    dry_run: dry_run,
+    version: new_version ? new_version.version : null,
+    summary: summarise_reconcile(plan),
+    changes: plan.changes,
+  });
+});
+
+export default router;
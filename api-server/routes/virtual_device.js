@@ -9,6 +9,8 @@ import { Router } from "express";
 import {VirtualDevice, virtualDeviceSchema} from '../mongo/schemas/virtual_device.js';
 import { Site } from '../mongo/schemas/site.js';
 import { Model } from '../mongo/schemas/model.js';
+import { Device } from '../mongo/schemas/device.js';
+import { configEmitter } from './config.js';
 
 import { logger } from '../index.js';
 
@@ -57,7 +59,7 @@ router.post('/', async(req, res) => {
   req.body.id = nanoid(8);
   
   // Verify the site exists
-  const site = Site.findOne({id: req.params.site});
+  const site = await Site.findOne({id: req.params.site});
   if (!site) {
     res.status(400).json({
       error: 'invalid_site',
@@ -122,7 +124,7 @@ router.patch('/:id', async(req, res) => {
 
 // Delete a virtual device
 router.delete('/:id', async(req, res) => {
-  const virtual_device = VirtualDevice.findOne({ id: req.params.id, site_id: req.params.site });
+  const virtual_device = await VirtualDevice.findOne({ id: req.params.id, site_id: req.params.site });
   if (!virtual_device) {
     res.status(400).json({
       status: 'invalid_virtual_device',
@@ -131,8 +133,10 @@ router.delete('/:id', async(req, res) => {
     return;
   }
   
-  // Delete the virtual device.
+  // Delete the virtual device, and unlink it from any devices mirroring it.
   await VirtualDevice.deleteOne({ id: req.params.id });
+  await Device.updateMany({ virtual_device_ids: req.params.id }, { $pull: { virtual_device_ids: req.params.id } });
+  configEmitter.emit('config_changed', { target_type: 'virtual_device', target_id: req.params.id });
   
   res.json({
     status: 'virtual_device_deleted',
@@ -5,6 +5,7 @@ import cmd2
 
 from sections.model import ModelCLI
 from sections.site import SiteCLI
+from sections.watch import parse_watch_args, watch
 
 class YealinkProvisionCLI(cmd2.Cmd):
   """Yealink CLI - Provisioning Tool"""
@@ -24,6 +25,14 @@ class YealinkProvisionCLI(cmd2.Cmd):
     site = SiteCLI()
     site.cmdloop()
 
+  def do_watch(self, arg):
+    """Watch devices fetch their configuration live: watch [site=<site ID>] [mac=<MAC address>] [result=success|fail]"""
+    filters, error = parse_watch_args(arg)
+    if error:
+      print(error)
+      return
+    watch(filters)
+
   def do_exit(self, arg):
     """Exit the CLI"""
     return True
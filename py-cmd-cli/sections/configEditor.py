@@ -8,27 +8,62 @@
 # currently selected group or the currently selected element.
 
 from .api import api_url
+from .spec import get_spec
 
 import cmd2
+import re
 import requests
 
-def delete_config_group_or_element(target_type, target_id, intermediate_tree):
-  # Delete the configuration group or element
+def split_config_path(path):
+  # Split a path typed by the user, such as account.1 or account/1, into its groups.
+  return [item for item in re.split(r'[./:]', path) if item != ""]
+
+def delete_config_group_or_element(target_type, target_id, intermediate_tree, recursive=False):
+  # Delete the configuration group or element, recursive also deletes everything below a group.
   r = requests.delete(
     api_url + "/" +
     target_type +
     '/' +
     target_id +
     '/config/' +
-    '/'.join(intermediate_tree)
+    '/'.join(intermediate_tree),
+    params={'recursive': 'true'} if recursive else None
   )
 
   # Check if the request was successful
   if r.status_code == 200:
     return True
   
+  if r.status_code == 409:
+    print("Group has children, use delete -r to delete them too.")
+
   return False
 
+def copy_config(target_type, target_id, intermediate_tree, source_type, source_id, source_tree):
+  # Copy a group (or with an empty source_tree, all configuration) from another target, server-side.
+  url = (
+    api_url + "/" +
+    target_type +
+    '/' +
+    target_id +
+    '/config/' +
+    '/'.join(intermediate_tree)
+  )
+  r = requests.post(url, json={
+    'copy_from': {
+      'target_type': source_type,
+      'target_id': source_id,
+      'path': '/'.join(source_tree)
+    }
+  })
+
+  # Check if the request was successful
+  if r.status_code == 201:
+    return r.json()
+
+  print(r.json()['message'])
+  return None
+
 def get_config_group_or_element(target_type, target_id, intermediate_tree):
   # Get the configuration group
   r = requests.get(
@@ -112,12 +147,14 @@ class ConfigElementCLI(cmd2.Cmd):
   """Yealink Provision CLI - Configuration Element Editor"""
   prompt = 'PENDING> '
 
-  def __init__(self, target_type, target_id, target_name, intermediate_tree):
+  def __init__(self, target_type, target_id, target_name, intermediate_tree, model_id=None):
     super().__init__()
     self.target_type = target_type
     self.target_id = target_id
     self.target_name = target_name
     self.intermediate_tree = intermediate_tree
+    self.model_id = model_id
+    self.spec = get_spec(model_id)
 
     self.head = self.intermediate_tree[len(self.intermediate_tree) - 1]
     # Check if the head exists, if not, create it.
@@ -133,14 +170,24 @@ class ConfigElementCLI(cmd2.Cmd):
     print("-------------")
     print(f"{element['value']}")
 
+    description = self.spec.describe(self.intermediate_tree, element['value']) if self.spec else None
+    if description:
+      print(description)
+
   def do_value(self, arg):
     """Set the value of this configuration element"""
     if arg == "":
       print("Please specify a value")
       return
     
-    # Set the new value
+    # Set the new value, converting friendly names (i.e., BLF) if the model has a spec.
     new_value = arg
+    if self.spec:
+      new_value, error = self.spec.resolve_value(self.intermediate_tree, arg)
+      if error:
+        print(error)
+        return
+
     element = update_config_element_value(self.target_type, self.target_id, self.intermediate_tree, new_value)
     if element == None:
       print("Failed to set value")
@@ -166,12 +213,14 @@ class ConfigGroupCLI(cmd2.Cmd):
   """Yealink CLI - Configuration Group Editor"""
   prompt = 'PENDING> '
 
-  def __init__(self, target_type, target_id, target_name, intermediate_tree):
+  def __init__(self, target_type, target_id, target_name, intermediate_tree, model_id=None):
     super().__init__()
     self.target_type = target_type
     self.target_id = target_id
     self.target_name = target_name
     self.intermediate_tree = intermediate_tree
+    self.model_id = model_id
+    self.spec = get_spec(model_id)
 
     self.head = self.intermediate_tree[len(self.intermediate_tree) - 1]
     # Check if the head exists, if not, create it.
@@ -188,9 +237,14 @@ class ConfigGroupCLI(cmd2.Cmd):
   def do_group(self, arg):
     """Open a further down group"""
     new_tree = self.intermediate_tree + [arg]
-    new_cli = ConfigGroupCLI(self.target_type, self.target_id, self.target_name, new_tree)
+    new_cli = ConfigGroupCLI(self.target_type, self.target_id, self.target_name, new_tree, self.model_id)
     new_cli.cmdloop()
 
+  def complete_group(self, text, line, begidx, endidx):
+    if not self.spec:
+      return []
+    return [name for name in self.spec.children(self.intermediate_tree, elements=False) if name.startswith(text)]
+
   def do_show(self, arg):
     """Show information about this configuration group and it's downstreams (children)"""
     info = get_config_group_or_element(self.target_type, self.target_id, self.intermediate_tree)
@@ -222,13 +276,31 @@ class ConfigGroupCLI(cmd2.Cmd):
         print("No downstream elements")
 
   def do_delete(self, arg):
-    """Delete this configuration group"""
-    if delete_config_group_or_element(self.target_type, self.target_id, self.intermediate_tree):
+    """Delete this configuration group, use delete -r to also delete all downstream groups and elements"""
+    recursive = arg.strip() in ['-r', '--recursive']
+    if delete_config_group_or_element(self.target_type, self.target_id, self.intermediate_tree, recursive):
       print("Deleted")
       return True
     else:
       print("Failed to delete")
 
+  def do_copy(self, arg):
+    """Copy a group from another target into this group: copy <target_type> <target_id> <path> [new name]"""
+    args = arg.split()
+    if len(args) < 3:
+      print("Usage: copy <target_type> <target_id> <path> [new name]")
+      return
+
+    source_tree = split_config_path(args[2])
+    name = args[3] if len(args) > 3 else source_tree[-1]
+
+    result = copy_config(self.target_type, self.target_id, self.intermediate_tree + [name], args[0], args[1], source_tree)
+    if result == None:
+      print("Failed to copy")
+      return
+
+    print(f"Copied {result['groups']} groups and {result['elements']} elements")
+
   def do_element(self, arg):
     """Open a configuration element"""
     # Check if the element exists, if not, prompt for a value and create it.
@@ -241,12 +313,25 @@ class ConfigGroupCLI(cmd2.Cmd):
       if value == "":
         print("No value entered.")
         return
+
+      # Validate the value, and convert friendly names (i.e., BLF) if the model has a spec.
+      if self.spec:
+        value, error = self.spec.resolve_value(new_tree, value)
+        if error:
+          print(error)
+          return
+
       create_config_element(self.target_type, self.target_id, self.intermediate_tree, arg, value)
       element = get_config_group_or_element(self.target_type, self.target_id, new_tree)    
 
-    new_cli = ConfigElementCLI(self.target_type, self.target_id, self.target_name, new_tree)
+    new_cli = ConfigElementCLI(self.target_type, self.target_id, self.target_name, new_tree, self.model_id)
     new_cli.cmdloop()
 
+  def complete_element(self, text, line, begidx, endidx):
+    if not self.spec:
+      return []
+    return [name for name in self.spec.children(self.intermediate_tree, groups=False) if name.startswith(text)]
+
   def do_exit(self, arg):
     """Exit the CLI"""
     return True
@@ -256,19 +341,54 @@ class ConfigCLI(cmd2.Cmd):
   # Doesn't yet support root elements.
   prompt = 'config> '
 
-  def __init__(self, target_type, target_id, target_name):
+  def __init__(self, target_type, target_id, target_name, model_id=None):
     super().__init__()
     self.target_type = target_type
     self.target_id = target_id
     self.target_name = target_name
+    self.model_id = model_id
+    self.spec = get_spec(model_id)
 
     self.prompt = f"config({self.target_type}-{self.target_name})> "
 
   def do_group(self, arg):
     """Open a group"""
-    new_cli = ConfigGroupCLI(self.target_type, self.target_id, self.target_name, [arg])
+    new_cli = ConfigGroupCLI(self.target_type, self.target_id, self.target_name, [arg], self.model_id)
     new_cli.cmdloop()
 
+  def complete_group(self, text, line, begidx, endidx):
+    if not self.spec:
+      return []
+    return [name for name in self.spec.children([], elements=False) if name.startswith(text)]
+
+  def do_delete(self, arg):
+    """Delete all configuration on this target, requires delete -r"""
+    if arg.strip() not in ['-r', '--recursive']:
+      print("This deletes all configuration, use delete -r to confirm.")
+      return
+
+    if delete_config_group_or_element(self.target_type, self.target_id, [], True):
+      print("Deleted")
+    else:
+      print("Failed to delete")
+
+  def do_copy(self, arg):
+    """Copy configuration from another target: copy <target_type> <target_id> [path]"""
+    args = arg.split()
+    if len(args) < 2:
+      print("Usage: copy <target_type> <target_id> [path]")
+      return
+
+    # Without a path, all configuration is copied.
+    source_tree = split_config_path(args[2]) if len(args) > 2 else []
+
+    result = copy_config(self.target_type, self.target_id, [], args[0], args[1], source_tree)
+    if result == None:
+      print("Failed to copy")
+      return
+
+    print(f"Copied {result['groups']} groups and {result['elements']} elements")
+
   def do_exit(self, arg):
     """Exit the CLI"""
     return True
\ No newline at end of file
@@ -3,12 +3,13 @@ from .api import api_url
 
 from .configEditor import ConfigCLI
 from .model import get_model
+from .effective import get_layers, fetch_layers, merge_layers, format_effective
 
 import cmd2
 import requests
 
 class Device:
-  def __init__(self, site_id, id, name, model_id, mac_address, remark, create_date):
+  def __init__(self, site_id, id, name, model_id, mac_address, remark, create_date, virtual_device_ids=None):
     self.id = id
     self.name = name
     self.site_id = site_id
@@ -16,6 +17,7 @@ class Device:
     self.mac_address = mac_address
     self.remark = remark
     self.create_date = create_date
+    self.virtual_device_ids = virtual_device_ids or []
 
   def rename(self, name):
     # Rename the site
@@ -37,6 +39,32 @@ class Device:
       return True
     
     return False
+
+  def link_virtual_device(self, virtual_device_id):
+    # Mirror a virtual device's configuration onto this device
+    r = requests.post(api_url + '/sites/' + self.site_id + '/devices/' + self.id + '/virtual_devices', json={
+      'virtual_device_id': virtual_device_id
+    })
+
+    # Check if the request was successful
+    if r.status_code == 200:
+      self.virtual_device_ids = r.json()['virtual_device_ids']
+      return True
+
+    print(r.json()['message'])
+    return False
+
+  def unlink_virtual_device(self, virtual_device_id):
+    # Stop mirroring a virtual device's configuration onto this device
+    r = requests.delete(api_url + '/sites/' + self.site_id + '/devices/' + self.id + '/virtual_devices/' + virtual_device_id)
+
+    # Check if the request was successful
+    if r.status_code == 200:
+      self.virtual_device_ids = r.json()['virtual_device_ids']
+      return True
+
+    print(r.json()['message'])
+    return False
   
 def create_device(site_id, name, mac, model_id, remark):
   # Create the site
@@ -75,7 +103,7 @@ def get_devices(site_id):
     devices = []
     for device in r.json():
       remark = device['remark'] if 'remark' in device else "N/A"
-      devices.append(Device(site_id, device['id'], device['name'], device['model_id'], device['mac_address'], remark, device['create_date']))
+      devices.append(Device(site_id, device['id'], device['name'], device['model_id'], device['mac_address'], remark, device['create_date'], device.get('virtual_device_ids')))
     return devices
   
   return None
@@ -87,7 +115,7 @@ def get_device(site_id, id):
   # Check if the request was successful
   if r.status_code == 200:
     remark = r.json()['remark'] if 'remark' in r.json() else "N/A"
-    return Device(site_id, r.json()['id'], r.json()['name'], r.json()['model_id'], r.json()['mac_address'], remark, r.json()['create_date'])
+    return Device(site_id, r.json()['id'], r.json()['name'], r.json()['model_id'], r.json()['mac_address'], remark, r.json()['create_date'], r.json().get('virtual_device_ids'))
   
   return None
 
@@ -121,6 +149,7 @@ class DeviceEditCLI(cmd2.Cmd):
     print("Model: " + get_model(self.device.model_id).name)
     print("Remark: " + self.device.remark)
     print("Create Date: " + self.device.create_date)
+    print("Linked Virtual Devices: " + (", ".join(self.device.virtual_device_ids) or "None"))
 
   def do_delete(self, args):
     """Delete the device"""
@@ -136,9 +165,52 @@ class DeviceEditCLI(cmd2.Cmd):
     else:
       print("Error: Failed to enable device")
 
+  def do_link(self, args):
+    """Mirror a virtual device's configuration onto this device: link <virtual device ID>"""
+    if len(args) == 0:
+      print("Error: No virtual device ID specified")
+      return
+
+    if self.device.link_virtual_device(args):
+      print("Virtual device linked")
+    else:
+      print("Error: Failed to link virtual device")
+
+  def do_unlink(self, args):
+    """Stop mirroring a virtual device's configuration onto this device: unlink <virtual device ID>"""
+    if len(args) == 0:
+      print("Error: No virtual device ID specified")
+      return
+
+    if self.device.unlink_virtual_device(args):
+      print("Virtual device unlinked")
+    else:
+      print("Error: Failed to unlink virtual device")
+
+  def do_effective(self, args):
+    """Show the configuration served to the device, and the layer each value comes from: effective [-o] [search]
+    -o only shows keys that override a value from an earlier layer"""
+    args = args.split()
+    overridden_only = '-o' in args
+    search = next((arg for arg in args if arg != '-o'), None)
+
+    layers = fetch_layers(get_layers(self.device))
+    failed = [label for label, pairs in layers if pairs is None]
+    if failed:
+      print("Error: Failed to get configuration for " + ", ".join(failed))
+      return
+
+    effective = merge_layers(layers)
+    lines = format_effective(effective, search, overridden_only)
+    if lines:
+      print("\n".join(lines))
+
+    overriding = sum(1 for entry in effective.values() if entry['overridden'])
+    print(f"{len(effective)} keys, {overriding} overriding an earlier layer.")
+
   def do_config(self, args):
     """Edit the device configuration"""
-    ConfigCLI("device", self.device.id, self.device.name).cmdloop()
+    ConfigCLI("device", self.device.id, self.device.name, self.device.model_id).cmdloop()
 
 class DeviceCLI(cmd2.Cmd):
   """Yealink Provision CLI - Device Manager"""
@@ -0,0 +1,123 @@
+# Yealink Provision CLI - Effective Configuration
+# Cameron Fleming (c) 2023
+
+# Works out the configuration a device is served, and which layer each value came from.
+# The layers (model, site, linked virtual devices, device) are fetched concurrently as flat [dotted key, value]
+# lists, and merged in one pass in the same order and with the same rules as the fetch API (mergician):
+# - a later layer's value replaces an earlier one for the same key
+# - a value replaces a whole group with the same name (a.b = 1 replaces a.b.c, a.b.d, ...)
+# - a group replaces a value with the same name (a.b.c = 1 replaces a.b = 1)
+# Each key keeps the values it overrode, so it's clear why it has the value it does. Keys are listed in the order the
+# fetch API writes them.
+
+from .api import api_url
+
+from concurrent.futures import ThreadPoolExecutor
+import re
+import requests
+
+def get_layers(device):
+  # The layers applied to a device, in order, as (label, target type, target ID).
+  layers = [('model', 'model', device.model_id), ('site', 'site', device.site_id)]
+  for virtual_device_id in device.virtual_device_ids:
+    layers.append(('virtual_device ' + virtual_device_id, 'virtual_device', virtual_device_id))
+  layers.append(('device', 'device', device.id))
+  return layers
+
+def fetch_layer(target_type, target_id):
+  # Get every [dotted key, value] pair configured on a target, or None on failure.
+  try:
+    r = requests.get(api_url + '/' + target_type + '/' + target_id + '/config', params={'format': 'flat'})
+  except requests.exceptions.RequestException:
+    return None
+
+  if r.status_code == 200:
+    return r.json()['config']
+
+  return None
+
+def fetch_layers(layers):
+  # Fetch all of the layers at once, returns a list of (label, pairs), pairs is None if the layer couldn't be fetched.
+  with ThreadPoolExecutor(max_workers=min(len(layers), 8)) as executor:
+    results = executor.map(lambda layer: fetch_layer(layer[1], layer[2]), layers)
+    return [(layer[0], pairs) for layer, pairs in zip(layers, results)]
+
+# JavaScript objects keep integer-like keys (i.e., account.1) first in ascending order, then the rest in the order they
+# were added, which is the order the fetch API writes them in.
+INDEX_KEY = re.compile(r'^(0|[1-9][0-9]*)$')
+
+def ordered_names(group):
+  indexes = sorted((name for name in group if INDEX_KEY.match(name) and int(name) < 2 ** 32 - 1), key=int)
+  index_set = set(indexes)
+  return indexes + [name for name in group if name not in index_set]
+
+def values_in(group, prefix):
+  # Every (key, value, layer) in a group, including the values each of them overrode.
+  for name, child in group.items():
+    if isinstance(child, dict):
+      yield from values_in(child, prefix + name + '.')
+    else:
+      value, layer, overridden = child
+      yield (prefix + name, value, layer)
+      yield from overridden
+
+def merge_layers(layers):
+  # Merge (label, pairs) layers in order. Returns {key: {'value', 'layer', 'overridden': [(key, value, layer)]}}
+  # in the order the keys would appear in the cfg file.
+  # The layers are merged into a tree of dicts (groups) and (value, layer, overridden) tuples, so replacing a value or
+  # a group only touches that part of the tree, and replacing a key in a dict keeps its position, as in mergician.
+  tree = {}
+
+  for label, pairs in layers:
+    for key, value in pairs or []:
+      path = key.split('.')
+      overridden = []
+
+      # A group replaces a value at any of its parents.
+      node = tree
+      for i, name in enumerate(path[:-1]):
+        child = node.get(name)
+        if not isinstance(child, dict):
+          if child is not None:
+            overridden.append(('.'.join(path[:i + 1]), child[0], child[1]))
+            overridden.extend(child[2])
+          child = node[name] = {}
+        node = child
+
+      # A value replaces everything below it, or the value it overrides.
+      name = path[-1]
+      existing = node.get(name)
+      if isinstance(existing, dict):
+        overridden.extend(values_in(existing, key + '.'))
+      elif existing is not None:
+        overridden = [(key, existing[0], existing[1])] + existing[2] + overridden
+
+      node[name] = (value, label, overridden)
+
+  effective = {}
+  def flatten(group, prefix):
+    for name in ordered_names(group):
+      child = group[name]
+      if isinstance(child, dict):
+        flatten(child, prefix + name + '.')
+      else:
+        effective[prefix + name] = {'value': child[0], 'layer': child[1], 'overridden': child[2]}
+
+  flatten(tree, '')
+  return effective
+
+def format_effective(effective, search=None, overridden_only=False):
+  # Format the effective configuration as lines, optionally only keys containing search or with overridden values.
+  lines = []
+  for key, entry in effective.items():
+    if search and search not in key:
+      continue
+    if overridden_only and not entry['overridden']:
+      continue
+
+    lines.append(f"{key} = {entry['value']}  [{entry['layer']}]")
+    for overridden_key, value, layer in entry['overridden']:
+      name = '' if overridden_key == key else overridden_key + ' = '
+      lines.append(f"    overrides {name}{value}  [{layer}]")
+
+  return lines
@@ -7,12 +7,13 @@ import cmd2
 import requests
 
 class Model:
-  def __init__(self, id, name, vendor, remark, create_date):
+  def __init__(self, id, name, vendor, remark, create_date, common_cfg=None):
     self.id = id
     self.name = name
     self.remark = remark
     self.vendor = vendor
     self.create_date = create_date
+    self.common_cfg = common_cfg
 
   def rename(self, name):
     # Rename the site
@@ -25,6 +26,17 @@ class Model:
     
     return False
   
+  def set_common_cfg(self, common_cfg):
+    # Set the common cfg file (i.e., y000000000123), an empty string removes it
+    r = requests.patch(api_url + '/models/' + self.id, json={'common_cfg': common_cfg})
+
+    # Check if the request was successful
+    if r.status_code == 200:
+      self.common_cfg = common_cfg or None
+      return True, None
+
+    return False, r.json().get('message', 'Unknown error')
+
   def delete(self):
     # Delete the site
     r = requests.delete(api_url + '/models/' + self.id)
@@ -67,7 +79,7 @@ def get_model(id):
   if r.status_code == 200:
     model = r.json()
     remark = model['remark'] if 'remark' in model else "N/A"
-    return Model(model['id'], model['name'], model['vendor'], remark, model['create_date'])
+    return Model(model['id'], model['name'], model['vendor'], remark, model['create_date'], model.get('common_cfg'))
   
   return None
 
@@ -144,10 +156,24 @@ class ModelEditCLI(cmd2.Cmd):
     print("Vendor: " + self.model.vendor)
     print("Remark: " + self.model.remark)
     print("Create Date: " + self.model.create_date)
+    print("Common cfg: " + (self.model.common_cfg + ".cfg" if self.model.common_cfg else "None"))
+
+  def do_common_cfg(self, args):
+    """Set the model's common cfg file, which phones fetch before <MAC>.cfg: common_cfg <y000000000123>, or common_cfg none"""
+    if len(args) == 0:
+      print("Please specify a common cfg file name, i.e., y000000000123, or none")
+      return
+
+    common_cfg = '' if args.strip() == 'none' else args.strip().replace('.cfg', '')
+    success, error = self.model.set_common_cfg(common_cfg)
+    if success:
+      print("Common cfg " + ("removed" if not common_cfg else "set to " + common_cfg + ".cfg"))
+    else:
+      print("Failed to set common cfg: " + error)
 
   def do_config(self, arg):
     """Edit the site config"""
-    config = ConfigCLI("model", self.model.id, self.model.name)
+    config = ConfigCLI("model", self.model.id, self.model.name, self.model.id)
     config.cmdloop()
 
   def do_delete(self, args):
@@ -4,6 +4,7 @@ from .api import api_url
 from .configEditor import ConfigCLI
 from .device import DeviceCLI
 from .virtual_device import VirtualDeviceCLI
+from .watch import parse_watch_args, watch
 
 import cmd2
 import requests
@@ -134,6 +135,15 @@ class SiteEditCLI(cmd2.Cmd):
     config = ConfigCLI("site", self.site.id, self.site.name)
     config.cmdloop()
 
+  def do_watch(self, arg):
+    """Watch devices in this site fetch their configuration live: watch [mac=<MAC address>] [result=success|fail]"""
+    filters, error = parse_watch_args(arg)
+    if error:
+      print(error)
+      return
+    filters['site_id'] = self.site.id
+    watch(filters)
+
   def do_exit(self, arg):
     """Exit the CLI"""
     return True
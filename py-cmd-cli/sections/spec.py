@@ -0,0 +1,99 @@
+# Yealink Provision CLI - Configuration Spec
+# Cameron Fleming (c) 2023
+
+# Fetches the configuration spec for a model from the API once, and keeps it for the rest
+# of the session. The spec is indexed by path pattern (numbered groups are "#", i.e. linekey.#.type),
+# so completion and validation are dictionary lookups rather than walks of the spec.
+
+from .api import api_url
+
+import re
+import requests
+
+# Specs by model ID, None if the model has no spec.
+_spec_cache = {}
+
+def _normalise_name(name):
+  return re.sub(r'[^a-z0-9]', '', str(name).lower())
+
+def path_pattern(tree):
+  # Convert a path (list of groups/element) into its spec pattern.
+  return '.'.join('#' if item.isdigit() else item for item in tree)
+
+class Spec:
+  def __init__(self, spec):
+    self.device_meta = spec['device_meta']
+    self.roots = spec['roots']
+    self.paths = spec['paths']
+
+  def lookup(self, tree):
+    return self.paths.get(path_pattern(tree))
+
+  def children(self, tree, groups=True, elements=True):
+    # Names that can appear below a path, numbered groups ("#") can't be completed.
+    node = self.lookup(tree) if tree else None
+    names = node['children'] if node else (self.roots if not tree else [])
+
+    result = []
+    for name in names:
+      if name == '#':
+        continue
+      child = self.lookup(tree + [name])
+      is_group = child['type'] in ['group_only', 'group_only_numbered']
+      if (is_group and groups) or (not is_group and elements):
+        result.append(name)
+
+    return result
+
+  def resolve_value(self, tree, value):
+    # Convert a value, or its friendly name, to the config value.
+    # Returns (value, None) or (None, error message).
+    node = self.lookup(tree)
+    if node is None:
+      return value, None
+
+    if node['type'] in ['group_only', 'group_only_numbered']:
+      return None, '.'.join(tree) + " is a group, not a value."
+
+    if 'values_by_friendly_name' in node:
+      if value in node['friendly_names_by_value']:
+        return value, None
+
+      resolved = node['values_by_friendly_name'].get(_normalise_name(value))
+      if resolved is not None:
+        return resolved, None
+
+      supported = ', '.join(f"{v['config_value']} ({v['friendly_name']})" for v in node['supported_values'])
+      return None, f"{value} is not supported, expected one of {supported}."
+
+    if node['type'] == 'number' and not re.match(r'^-?[0-9]+$', value):
+      return None, '.'.join(tree) + " must be a number."
+
+    return value, None
+
+  def describe(self, tree, value=None):
+    # Friendly description of a path, and its value if it's one of the supported values.
+    node = self.lookup(tree)
+    if node is None:
+      return None
+
+    description = node['friendly_name']
+    if value is not None and 'friendly_names_by_value' in node and str(value) in node['friendly_names_by_value']:
+      description += f" ({node['friendly_names_by_value'][str(value)]})"
+
+    return description
+
+def get_spec(model_id):
+  # Get the spec for a model, fetched from the API on first use only.
+  if model_id is None:
+    return None
+
+  if model_id not in _spec_cache:
+    try:
+      r = requests.get(api_url + '/models/' + model_id + '/spec')
+      _spec_cache[model_id] = Spec(r.json()) if r.status_code == 200 else None
+    except requests.exceptions.RequestException:
+      # The spec is optional, carry on without it.
+      return None
+
+  return _spec_cache[model_id]
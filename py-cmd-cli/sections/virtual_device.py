@@ -119,7 +119,7 @@ class VirtualDeviceEditCLI(cmd2.Cmd):
             
     def do_config(self, args):
         """Enter the virtual device configuration"""
-        ConfigCLI("device", self.vdev.id, self.vdev.name).cmdloop()
+        ConfigCLI("virtual_device", self.vdev.id, self.vdev.name, self.vdev.model_id).cmdloop()
     
     
 class VirtualDeviceCLI(cmd2.Cmd):
@@ -0,0 +1,128 @@
+# Yealink Provision CLI - Watch
+# Cameron Fleming (c) 2023
+
+# Tails the live audit stream (GET /audit/stream, server-sent events) and prints each fetch as it happens,
+# with running success/failure counts and fetch latency. Press Ctrl+C to stop.
+
+from .api import api_url
+
+from bisect import bisect_left, insort
+from collections import deque
+import json
+import requests
+
+# Latency percentiles are worked out over the most recent fetches only.
+LATENCY_WINDOW = 1000
+
+def parse_watch_args(arg):
+  # Parse "site=<id> mac=<mac address> result=<success|fail>" into stream filters.
+  # Returns (filters, None) or (None, error message).
+  names = {'site': 'site_id', 'mac': 'mac_address', 'result': 'result'}
+  filters = {}
+
+  for item in arg.split():
+    key, _, value = item.partition('=')
+    if key not in names or not value:
+      return None, "Usage: watch [site=<site ID>] [mac=<MAC address>] [result=success|fail]"
+    filters[names[key]] = value
+
+  return filters, None
+
+def read_events(response):
+  # Yield (event, data) for each server-sent event, comments (heartbeats) are skipped.
+  event = 'message'
+  data = []
+
+  for line in response.iter_lines(decode_unicode=True):
+    if line is None:
+      continue
+
+    if line == '':
+      if data:
+        yield event, '\n'.join(data)
+      event = 'message'
+      data = []
+    elif line.startswith(':'):
+      continue
+    elif line.startswith('event:'):
+      event = line[6:].strip()
+    elif line.startswith('data:'):
+      data.append(line[5:].strip())
+
+class LatencyWindow:
+  # The most recent LATENCY_WINDOW latencies, kept in arrival order (to drop the oldest) and in sorted order, updated
+  # with bisect as each one arrives, so percentiles don't sort the window for every event.
+  def __init__(self, size=LATENCY_WINDOW):
+    self.size = size
+    self.recent = deque()
+    self.ordered = []
+
+  def __len__(self):
+    return len(self.recent)
+
+  def add(self, value):
+    self.recent.append(value)
+    insort(self.ordered, value)
+
+    if len(self.recent) > self.size:
+      del self.ordered[bisect_left(self.ordered, self.recent.popleft())]
+
+  def percentile(self, p):
+    if not self.ordered:
+      return 0
+    return self.ordered[min(int(len(self.ordered) * p), len(self.ordered) - 1)]
+
+  def max(self):
+    return self.ordered[-1]
+
+def watch(filters):
+  counts = {'success': 0, 'fail': 0}
+  dropped = 0
+  latencies = LatencyWindow()
+
+  try:
+    r = requests.get(api_url + '/audit/stream', params=filters, stream=True, timeout=(5, None))
+  except requests.exceptions.RequestException as e:
+    print("Failed to connect to the audit stream: " + str(e))
+    return
+
+  if r.status_code != 200:
+    print("Failed to watch: " + r.text)
+    return
+
+  print("Watching fetches, press Ctrl+C to stop.")
+  print("Time\t\t\tMAC Address\tResult\tReason\t\t\tLatency\t\tSuccess/Fail\tp50/p95")
+
+  try:
+    for event, data in read_events(r):
+      if event == 'dropped':
+        dropped += json.loads(data)['dropped']
+        print(f"({dropped} fetches dropped, watch is falling behind)")
+        continue
+
+      if event != 'audit':
+        continue
+
+      entry = json.loads(data)
+      counts[entry['result']] = counts.get(entry['result'], 0) + 1
+
+      latency = ''
+      if entry.get('duration_ms') is not None:
+        latencies.add(entry['duration_ms'])
+        latency = f"{entry['duration_ms']:.1f}ms"
+
+      print(f"{entry['timestamp']}\t{entry.get('mac_address', 'N/A')}\t{entry['result']}\t{entry.get('reason', 'N/A'):<24}"
+            f"{latency:<16}{counts['success']}/{counts['fail']}\t\t"
+            f"{latencies.percentile(0.5):.1f}/{latencies.percentile(0.95):.1f}ms")
+  except KeyboardInterrupt:
+    pass
+  except requests.exceptions.RequestException as e:
+    print("Audit stream disconnected: " + str(e))
+  finally:
+    r.close()
+
+  total = counts['success'] + counts['fail']
+  print(f"\n{total} fetches, {counts['success']} succeeded, {counts['fail']} failed"
+        + (f", {dropped} dropped" if dropped else "") + ".")
+  if latencies:
+    print(f"Latency p50 {latencies.percentile(0.5):.1f}ms, p95 {latencies.percentile(0.95):.1f}ms, max {latencies.max():.1f}ms.")
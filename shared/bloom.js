@@ -0,0 +1,64 @@
+// yealink-provision - Bloom Filter
+// Cameron Fleming 2023
+
+// A compact set membership filter, used by the API server to send the configuration agents the MAC addresses
+// it knows about. A lookup can return a false positive (at the rate the filter was sized for), but never a false
+// negative, so anything the filter doesn't contain can be rejected without asking the API server.
+
+// Keys are hashed once with MD5, the k bit positions come from double hashing the two halves (h1 + i * h2).
+
+// Shared by the API server and the configuration agents, see shared/README.md. Both must build and read filters
+// the same way, so there's only one copy.
+
+import crypto from 'crypto';
+
+export class BloomFilter {
+  constructor(size_bits, hashes, bits = null) {
+    this.size_bits = size_bits;
+    this.hashes = hashes;
+    this.bits = bits || Buffer.alloc(Math.ceil(size_bits / 8));
+  }
+
+  // Create an empty filter sized for count keys with the given false positive rate.
+  static for_capacity(count, fp_rate = 0.01) {
+    const size_bits = Math.max(Math.ceil(-Math.max(count, 1) * Math.log(fp_rate) / (Math.LN2 * Math.LN2)), 64);
+    const hashes = Math.max(Math.round(size_bits / Math.max(count, 1) * Math.LN2), 1);
+
+    return new BloomFilter(size_bits, hashes);
+  }
+
+  positions(key) {
+    const digest = crypto.createHash('md5').update(key).digest();
+    const h1 = digest.readUInt32LE(0);
+    const h2 = digest.readUInt32LE(4);
+
+    const positions = [];
+    for (let i = 0; i < this.hashes; i++) {
+      positions.push((h1 + i * h2) % this.size_bits);
+    }
+
+    return positions;
+  }
+
+  add(key) {
+    for (const position of this.positions(key)) {
+      this.bits[position >> 3] |= 1 << (position & 7);
+    }
+  }
+
+  has(key) {
+    return this.positions(key).every((position) => (this.bits[position >> 3] & (1 << (position & 7))) != 0);
+  }
+
+  to_json() {
+    return {
+      size_bits: this.size_bits,
+      hashes: this.hashes,
+      bits: this.bits.toString('base64'),
+    };
+  }
+
+  static from_json(json) {
+    return new BloomFilter(json.size_bits, json.hashes, Buffer.from(json.bits, 'base64'));
+  }
+}
@@ -0,0 +1,262 @@
+// yealink-provision - Cluster Mode
+// Cameron Fleming 2023
+
+// Optionally runs the server as a number of worker processes sharing the same ports, set CLUSTER_WORKERS
+// to the number of workers (or "auto" for one per CPU core). Unset, 0 or 1 runs a single process as before.
+
+// The primary process only supervises the workers: workers that crash are restarted (with a back-off if they
+// keep crashing), and a SIGHUP restarts the workers one at a time, so there are always workers accepting requests.
+
+// Each worker has its own in-memory caches, these are kept coherent by broadcasting invalidation events
+// through the primary to every other worker, see relay().
+
+// Shared by the API server and the configuration agents, see shared/README.md.
+
+import cluster from 'cluster';
+import os from 'os';
+
+// Set by run(), to the logger of the server being run.
+let logger = console;
+
+const SHUTDOWN_TIMEOUT = parseInt(process.env.SHUTDOWN_TIMEOUT) || 30000;
+const MAX_RESTART_DELAY = 30000;
+
+const shutdown_handlers = [];
+let shutting_down = false;
+
+export const cluster_workers = () => {
+  if (process.env.CLUSTER_WORKERS == 'auto') {
+    return os.availableParallelism ? os.availableParallelism() : os.cpus().length;
+  }
+
+  return parseInt(process.env.CLUSTER_WORKERS) || 1;
+}
+
+// Register a function to run before this process exits, such as flushing buffers.
+export const on_shutdown = (handler) => {
+  shutdown_handlers.push(handler);
+}
+
+const shutdown = async (reason) => {
+  if (shutting_down) return;
+  shutting_down = true;
+
+  logger.info(`cluster: shutting down (${reason}).`);
+  for (const handler of shutdown_handlers) {
+    try {
+      await handler();
+    } catch (err) {
+      logger.error(`cluster: shutdown handler failed: ${err}`);
+    }
+  }
+
+  process.exit(0);
+}
+
+// Send a message to every other worker, a no-op when not clustered.
+export const broadcast = (channel, payload) => {
+  if (!cluster.isWorker) return;
+
+  process.send({ type: 'broadcast', channel: channel, payload: payload });
+}
+
+// Listen for broadcasts from other workers.
+export const subscribe = (channel, handler) => {
+  if (!cluster.isWorker) return;
+
+  process.on('message', (message) => {
+    if (message && message.type == 'broadcast' && message.channel == channel) {
+      handler(message.payload);
+    }
+  });
+}
+
+// Gathering asks every worker for some data (such as metrics) and returns all of their answers.
+// on_gather(channel, handler) registers what this worker answers with.
+const GATHER_TIMEOUT = 2000;
+const gather_handlers = new Map();
+const pending_gathers = new Map();
+let gather_id = 0;
+
+export const on_gather = (channel, handler) => {
+  gather_handlers.set(channel, handler);
+}
+
+// Returns a promise of an array of answers, one from each worker, or just [local()] when not clustered.
+export const gather = async (channel, local) => {
+  if (!cluster.isWorker) return [await local()];
+
+  return await new Promise((resolve) => {
+    const id = ++gather_id;
+    pending_gathers.set(id, resolve);
+    process.send({ type: 'gather', channel: channel, id: id });
+  });
+}
+
+if (cluster.isWorker) {
+  process.on('message', async (message) => {
+    if (!message) return;
+
+    if (message.type == 'gather_request') {
+      const handler = gather_handlers.get(message.channel);
+      const data = handler ? await handler() : null;
+      process.send({ type: 'gather_reply', id: message.id, data: data });
+    } else if (message.type == 'gather_result' && pending_gathers.has(message.id)) {
+      pending_gathers.get(message.id)(message.results.filter((result) => result !== null));
+      pending_gathers.delete(message.id);
+    }
+  });
+}
+
+// Relay an event between the workers. Events emitted locally are broadcast to every other worker,
+// where they're emitted again with a second { remote: true } argument, so they aren't broadcast back.
+export const relay = (emitter, event) => {
+  emitter.on(event, (payload, meta) => {
+    if (!meta || !meta.remote) broadcast(event, payload);
+  });
+
+  subscribe(event, (payload) => emitter.emit(event, payload, { remote: true }));
+}
+
+const start_primary = (workers) => {
+  logger.info(`cluster: primary ${process.pid} starting ${workers} workers.`);
+
+  let crashes = 0;
+
+  // Ask every worker for their answer to a gather, and send them all back to the worker that asked.
+  // Workers that don't answer in time are left out.
+  const gathers = new Map();
+  let next_gather = 0;
+
+  const gather_from_workers = (requester, message) => {
+    const id = ++next_gather;
+    const workers = Object.values(cluster.workers).filter((worker) => worker.isConnected());
+
+    const gathering = { results: [], expected: workers.length };
+    gathering.finish = () => {
+      clearTimeout(gathering.timeout);
+      gathers.delete(id);
+      if (requester.isConnected()) {
+        requester.send({ type: 'gather_result', id: message.id, results: gathering.results });
+      }
+    }
+    gathering.timeout = setTimeout(gathering.finish, GATHER_TIMEOUT);
+    gathers.set(id, gathering);
+
+    for (const worker of workers) {
+      worker.send({ type: 'gather_request', channel: message.channel, id: id });
+    }
+  }
+
+  const fork = () => {
+    const worker = cluster.fork();
+    worker.started = Date.now();
+
+    worker.on('message', (message) => {
+      if (!message) return;
+
+      if (message.type == 'broadcast') {
+        // Pass broadcasts on to every other worker.
+        for (const other of Object.values(cluster.workers)) {
+          if (other.id != worker.id && other.isConnected()) other.send(message);
+        }
+      } else if (message.type == 'gather') {
+        gather_from_workers(worker, message);
+      } else if (message.type == 'gather_reply' && gathers.has(message.id)) {
+        const gathering = gathers.get(message.id);
+        gathering.results.push(message.data);
+        if (gathering.results.length >= gathering.expected) gathering.finish();
+      }
+    });
+
+    return worker;
+  }
+
+  // Ask a worker to stop accepting connections and exit once it's finished, kill it if it takes too long.
+  const stop = (worker) => {
+    return new Promise((resolve) => {
+      const timeout = setTimeout(() => {
+        logger.warn(`cluster: worker ${worker.process.pid} did not exit in time, killing.`);
+        worker.process.kill('SIGKILL');
+      }, SHUTDOWN_TIMEOUT);
+
+      worker.once('exit', () => {
+        clearTimeout(timeout);
+        resolve();
+      });
+
+      worker.disconnect();
+    });
+  }
+
+  cluster.on('exit', (worker, code, signal) => {
+    // Workers that were asked to stop aren't restarted.
+    if (shutting_down || worker.exitedAfterDisconnect) return;
+
+    // Back off if workers keep crashing shortly after starting.
+    crashes = Date.now() - worker.started < 60000 ? crashes + 1 : 0;
+    const delay = Math.min(1000 * (2 ** crashes - 1), MAX_RESTART_DELAY);
+
+    logger.error(`cluster: worker ${worker.process.pid} exited (${signal || code}), restarting in ${delay}ms.`);
+    setTimeout(() => {
+      if (!shutting_down) fork();
+    }, delay);
+  });
+
+  // Rolling restart, replace one worker at a time, waiting for the new worker to listen
+  // before stopping the old one.
+  let restarting = false;
+  process.on('SIGHUP', async () => {
+    if (restarting || shutting_down) return;
+    restarting = true;
+
+    logger.info("cluster: SIGHUP received, restarting workers.");
+    for (const worker of Object.values(cluster.workers)) {
+      const replacement = fork();
+      await new Promise((resolve) => {
+        replacement.once('listening', resolve);
+        replacement.once('exit', resolve);
+      });
+      await stop(worker);
+    }
+
+    logger.info("cluster: all workers restarted.");
+    restarting = false;
+  });
+
+  for (const signal of ['SIGINT', 'SIGTERM']) {
+    process.once(signal, async () => {
+      shutting_down = true;
+      logger.info(`cluster: received ${signal}, stopping workers.`);
+
+      await Promise.all(Object.values(cluster.workers).map(stop));
+      process.exit(0);
+    });
+  }
+
+  for (let i = 0; i < workers; i++) {
+    fork();
+  }
+}
+
+// Run main() in a single process, or in each worker when clustered.
+export const run = (main, server_logger) => {
+  if (server_logger) logger = server_logger;
+  const workers = cluster_workers();
+
+  if (workers > 1 && cluster.isPrimary) {
+    return start_primary(workers);
+  }
+
+  // When the primary disconnects a worker, its servers have already closed and finished their
+  // requests, clean up and exit.
+  if (cluster.isWorker) {
+    cluster.worker.on('disconnect', () => shutdown('disconnected'));
+  }
+
+  for (const signal of ['SIGINT', 'SIGTERM']) {
+    process.once(signal, () => shutdown(signal));
+  }
+
+  return main();
+}
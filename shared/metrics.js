@@ -0,0 +1,264 @@
+// yealink-provision - Metrics
+// Cameron Fleming 2023
+
+// A small Prometheus metrics registry, served in the text exposition format on /metrics.
+// Counters, gauges and histograms are kept in memory per process. In cluster mode each worker has its own
+// registry, the worker answering /metrics gathers a snapshot from every worker and sums them.
+
+// Shared by the API server and the configuration agents, see shared/README.md.
+
+import { gather, on_gather } from './cluster.js';
+
+const DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10];
+
+const label_key = (label_names, labels) => label_names.map((name) => String(labels[name] ?? '')).join('\u0000');
+
+const escape_label = (value) => value.replace(/\\/g, '\\\\').replace(/"/g, '\\"').replace(/\n/g, '\\n');
+
+const format_labels = (label_names, key, extra = '') => {
+  const values = key.split('\u0000');
+  const labels = label_names.map((name, i) => `${name}="${escape_label(values[i])}"`);
+  if (extra) labels.push(extra);
+
+  return labels.length > 0 ? `{${labels.join(',')}}` : '';
+}
+
+class Metric {
+  constructor(type, name, help, label_names = []) {
+    this.type = type;
+    this.name = name;
+    this.help = help;
+    this.label_names = label_names;
+    this.values = new Map();
+  }
+
+  snapshot() {
+    return {
+      type: this.type,
+      help: this.help,
+      label_names: this.label_names,
+      values: Object.fromEntries(this.values),
+    };
+  }
+}
+
+export class Counter extends Metric {
+  constructor(name, help, label_names) {
+    super('counter', name, help, label_names);
+  }
+
+  inc(labels = {}, value = 1) {
+    const key = label_key(this.label_names, labels);
+    this.values.set(key, (this.values.get(key) || 0) + value);
+  }
+
+  set(labels, value) {
+    this.values.set(label_key(this.label_names, labels), value);
+  }
+}
+
+export class Gauge extends Metric {
+  constructor(name, help, label_names) {
+    super('gauge', name, help, label_names);
+  }
+
+  inc(labels = {}, value = 1) {
+    const key = label_key(this.label_names, labels);
+    this.values.set(key, (this.values.get(key) || 0) + value);
+  }
+
+  dec(labels = {}, value = 1) {
+    this.inc(labels, -value);
+  }
+
+  set(labels, value) {
+    this.values.set(label_key(this.label_names, labels), value);
+  }
+}
+
+export class Histogram extends Metric {
+  constructor(name, help, label_names, buckets = DEFAULT_BUCKETS) {
+    super('histogram', name, help, label_names);
+    this.buckets = buckets;
+  }
+
+  observe(labels, value) {
+    const key = label_key(this.label_names, labels);
+
+    let entry = this.values.get(key);
+    if (!entry) {
+      entry = { counts: new Array(this.buckets.length).fill(0), sum: 0, count: 0 };
+      this.values.set(key, entry);
+    }
+
+    // Buckets are stored non-cumulative, and made cumulative when rendered.
+    const bucket = this.buckets.findIndex((bound) => value <= bound);
+    if (bucket != -1) entry.counts[bucket]++;
+    entry.sum += value;
+    entry.count++;
+  }
+
+  // Start a timer, calling the returned function observes the elapsed time in seconds.
+  start_timer(labels = {}) {
+    const start = process.hrtime.bigint();
+    return (end_labels = {}) => {
+      const seconds = Number(process.hrtime.bigint() - start) / 1e9;
+      this.observe({ ...labels, ...end_labels }, seconds);
+      return seconds;
+    }
+  }
+
+  snapshot() {
+    return { ...super.snapshot(), buckets: this.buckets };
+  }
+}
+
+export class Registry {
+  constructor() {
+    this.metrics = new Map();
+    this.collectors = [];
+  }
+
+  register(metric) {
+    this.metrics.set(metric.name, metric);
+    return metric;
+  }
+
+  counter(name, help, label_names) {
+    return this.register(new Counter(name, help, label_names));
+  }
+
+  gauge(name, help, label_names) {
+    return this.register(new Gauge(name, help, label_names));
+  }
+
+  histogram(name, help, label_names, buckets) {
+    return this.register(new Histogram(name, help, label_names, buckets));
+  }
+
+  // Collectors run before every snapshot, to copy values kept elsewhere (such as cache stats) into metrics.
+  collect(collector) {
+    this.collectors.push(collector);
+  }
+
+  snapshot() {
+    for (const collector of this.collectors) {
+      collector();
+    }
+
+    const snapshot = {};
+    for (const [name, metric] of this.metrics) {
+      snapshot[name] = metric.snapshot();
+    }
+
+    return snapshot;
+  }
+}
+
+// Sum snapshots from one or more processes.
+export const merge_snapshots = (snapshots) => {
+  const merged = {};
+
+  for (const snapshot of snapshots) {
+    for (const [name, metric] of Object.entries(snapshot)) {
+      if (!merged[name]) {
+        merged[name] = { ...metric, values: {} };
+      }
+
+      const values = merged[name].values;
+      for (const [key, value] of Object.entries(metric.values)) {
+        if (metric.type != 'histogram') {
+          values[key] = (values[key] || 0) + value;
+        } else if (!values[key]) {
+          values[key] = { counts: [...value.counts], sum: value.sum, count: value.count };
+        } else {
+          value.counts.forEach((count, i) => values[key].counts[i] += count);
+          values[key].sum += value.sum;
+          values[key].count += value.count;
+        }
+      }
+    }
+  }
+
+  return merged;
+}
+
+// Render a snapshot in the Prometheus text exposition format.
+export const render_snapshot = (snapshot) => {
+  const lines = [];
+
+  for (const [name, metric] of Object.entries(snapshot)) {
+    lines.push(`# HELP ${name} ${metric.help}`);
+    lines.push(`# TYPE ${name} ${metric.type}`);
+
+    for (const [key, value] of Object.entries(metric.values)) {
+      if (metric.type != 'histogram') {
+        lines.push(`${name}${format_labels(metric.label_names, key)} ${value}`);
+        continue;
+      }
+
+      let cumulative = 0;
+      metric.buckets.forEach((bound, i) => {
+        cumulative += value.counts[i];
+        lines.push(`${name}_bucket${format_labels(metric.label_names, key, `le="${bound}"`)} ${cumulative}`);
+      });
+      lines.push(`${name}_bucket${format_labels(metric.label_names, key, 'le="+Inf"')} ${value.count}`);
+      lines.push(`${name}_sum${format_labels(metric.label_names, key)} ${value.sum}`);
+      lines.push(`${name}_count${format_labels(metric.label_names, key)} ${value.count}`);
+    }
+  }
+
+  return lines.join('\n') + '\n';
+}
+
+export const registry = new Registry();
+
+// Metrics common to every HTTP service.
+export const http_request_duration = registry.histogram('http_request_duration_seconds', 'HTTP request latency by route.', ['method', 'route', 'status']);
+export const http_requests_in_flight = registry.gauge('http_requests_in_flight', 'HTTP requests currently being handled.');
+
+// Express middleware recording the latency of every request, labelled by route pattern (i.e., /:id) rather than path.
+export const track_requests = (req, res, next) => {
+  const end = http_request_duration.start_timer({ method: req.method });
+  http_requests_in_flight.inc();
+  res.locals.tracked = true;
+
+  res.once('close', () => {
+    if (!res.locals.tracked) return;
+
+    http_requests_in_flight.dec();
+    end({
+      route: req.route ? `${req.route_prefix || ''}${req.route.path}` : 'unmatched',
+      status: res.statusCode,
+    });
+  });
+
+  next();
+}
+
+// Leave a request out of the request metrics, called by handlers of streaming responses (i.e., server-sent events),
+// which stay open for as long as the client is connected and would count as in flight and slow for all of that time.
+export const untrack_request = (res) => {
+  if (!res.locals.tracked) return;
+
+  res.locals.tracked = false;
+  http_requests_in_flight.dec();
+}
+
+// Express middleware to put in front of a router, giving the pattern it's mounted at for route labels.
+export const route_prefix = (prefix) => {
+  return (req, res, next) => {
+    req.route_prefix = prefix;
+    next();
+  }
+}
+
+// Express handler for /metrics, gathers and sums the metrics from every worker when clustered.
+on_gather('metrics', () => registry.snapshot());
+
+export const metrics_handler = async (req, res) => {
+  const snapshots = await gather('metrics', () => registry.snapshot());
+
+  res.set('Content-Type', 'text/plain; version=0.0.4');
+  res.send(render_snapshot(merge_snapshots(snapshots)));
+}
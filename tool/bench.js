@@ -0,0 +1,155 @@
+// yealink-provision - Throughput Benchmark
+
+// Measures requests per second and latency against a running server, or starts the server itself with
+// a range of CLUSTER_WORKERS values to show how throughput scales with the number of workers.
+
+// Against a running server:
+//   node bench.js --url http://localhost:8080/cfg/SITEPW/001565AABBCC.cfg
+// Starting the server for each worker count:
+//   node bench.js --url http://localhost:8080/cfg/SITEPW/001565AABBCC.cfg --workers 1,2,4 --cmd "node ../yealink-provision/index.js"
+
+const http = require("http");
+const { spawn } = require("child_process");
+
+const parse_args = () => {
+  const args = {
+    url: "http://localhost:8080/",
+    connections: 64,
+    duration: 10,
+    warmup: 2,
+    workers: null,
+    cmd: null,
+  };
+
+  const argv = process.argv.slice(2);
+  for (let i = 0; i < argv.length; i += 2) {
+    const key = argv[i].replace(/^--/, "");
+    if (!(key in args)) {
+      console.error(`Unknown option --${key}`);
+      process.exit(1);
+    }
+    args[key] = argv[i + 1];
+  }
+
+  args.connections = parseInt(args.connections);
+  args.duration = parseFloat(args.duration);
+  args.warmup = parseFloat(args.warmup);
+  if (args.workers) args.workers = args.workers.split(",").map((n) => parseInt(n));
+
+  return args;
+};
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+const request = (agent, url) => {
+  return new Promise((resolve) => {
+    const start = process.hrtime.bigint();
+    const req = http.get(url, { agent: agent }, (res) => {
+      res.resume();
+      res.on("end", () => {
+        resolve({ status: res.statusCode, latency: Number(process.hrtime.bigint() - start) / 1e6 });
+      });
+    });
+
+    req.on("error", () => resolve({ status: 0, latency: Number(process.hrtime.bigint() - start) / 1e6 }));
+  });
+};
+
+// Run `connections` concurrent request loops for `duration` seconds.
+const load = async (url, connections, duration) => {
+  const agent = new http.Agent({ keepAlive: true, maxSockets: connections });
+  const latencies = [];
+  const statuses = {};
+  const deadline = Date.now() + duration * 1000;
+
+  const loop = async () => {
+    while (Date.now() < deadline) {
+      const result = await request(agent, url);
+      latencies.push(result.latency);
+      statuses[result.status] = (statuses[result.status] || 0) + 1;
+    }
+  };
+
+  const start = Date.now();
+  await Promise.all(Array.from({ length: connections }, loop));
+  const elapsed = (Date.now() - start) / 1000;
+  agent.destroy();
+
+  latencies.sort((a, b) => a - b);
+  const percentile = (p) => latencies[Math.min(Math.floor(latencies.length * p), latencies.length - 1)] || 0;
+
+  return {
+    requests: latencies.length,
+    rps: latencies.length / elapsed,
+    p50: percentile(0.5),
+    p99: percentile(0.99),
+    statuses: statuses,
+  };
+};
+
+const wait_for_server = async (url) => {
+  const agent = new http.Agent();
+  for (let i = 0; i < 100; i++) {
+    const result = await request(agent, url);
+    if (result.status != 0) return;
+    await sleep(100);
+  }
+  throw new Error(`Server did not start listening at ${url}`);
+};
+
+const start_server = (cmd, workers) => {
+  const [command, ...args] = cmd.split(" ");
+  return spawn(command, args, {
+    env: { ...process.env, CLUSTER_WORKERS: String(workers), LOG_LEVEL: process.env.LOG_LEVEL || "warn" },
+    stdio: "ignore",
+  });
+};
+
+const stop_server = (server) => {
+  return new Promise((resolve) => {
+    server.once("exit", resolve);
+    server.kill("SIGTERM");
+  });
+};
+
+const print_result = (label, result) => {
+  const statuses = Object.entries(result.statuses).map(([status, count]) => `${status}:${count}`).join(" ");
+  console.log(
+    `${label.padEnd(10)}${result.rps.toFixed(0).padStart(10)}${result.p50.toFixed(2).padStart(10)}` +
+    `${result.p99.toFixed(2).padStart(10)}${String(result.requests).padStart(10)}  ${statuses}`
+  );
+};
+
+const main = async () => {
+  const args = parse_args();
+  console.log(`Benchmarking ${args.url} with ${args.connections} connections for ${args.duration}s`);
+  console.log(`${"workers".padEnd(10)}${"req/s".padStart(10)}${"p50 ms".padStart(10)}${"p99 ms".padStart(10)}${"requests".padStart(10)}  statuses`);
+
+  if (!args.workers) {
+    if (args.warmup > 0) await load(args.url, args.connections, args.warmup);
+    print_result("-", await load(args.url, args.connections, args.duration));
+    return;
+  }
+
+  if (!args.cmd) {
+    console.error("--workers requires --cmd, the command used to start the server.");
+    process.exit(1);
+  }
+
+  let baseline;
+  for (const workers of args.workers) {
+    const server = start_server(args.cmd, workers);
+    try {
+      await wait_for_server(args.url);
+      if (args.warmup > 0) await load(args.url, args.connections, args.warmup);
+
+      const result = await load(args.url, args.connections, args.duration);
+      baseline = baseline || result.rps;
+      print_result(`${workers} (${(result.rps / baseline).toFixed(2)}x)`, result);
+    } finally {
+      await stop_server(server);
+    }
+  }
+};
+
+main();
@@ -8,6 +8,13 @@ import cors from 'cors';
 import https from 'https';
 import fs from 'fs';
 
+import { run, cluster_workers } from '../shared/cluster.js';
+import { registry, track_requests, metrics_handler } from '../shared/metrics.js';
+import { KnownMacs, NegativeCache, FailureThrottle } from './lib/fast_reject.js';
+import { ContentServer } from './lib/content.js';
+import { CommonCfgCache, ServedCommonCfg } from './lib/common_cfg.js';
+import { AdmissionControl, SeenMacs, PRIORITIES, retry_after_with_jitter } from './lib/admission.js';
+
 // Setup Winston logger
 const logger = winston.createLogger({
   level: process.env.LOG_LEVEL || 'info',
@@ -25,9 +32,29 @@ const logger = winston.createLogger({
 
 export { logger };
 
+// Setup metrics
+const phase_duration = registry.histogram('agent_phase_duration_seconds', 'Time spent in each phase of serving a cfg file.', ['phase']);
+const upstream_fetches = registry.counter('agent_upstream_fetches_total', 'Configuration fetches from the API server, by response status.', ['status']);
+const content_requests = registry.counter('agent_content_requests_total', 'Content file requests, by how they were served.', ['result']);
+const content_cache_bytes = registry.gauge('agent_content_cache_bytes', 'Bytes of content files held in memory.');
+const content_streaming = registry.gauge('agent_content_streaming', 'Content files currently being streamed from disk.');
+const fast_rejections = registry.counter('agent_fast_rejections_total', 'Requests rejected without calling the API server, by reason.', ['reason']);
+const admission_wait = registry.histogram('agent_admission_wait_seconds', 'Time requests waited for an upstream fetch slot, by priority.', ['priority']);
+const admission_queue_depth = registry.gauge('agent_admission_queue_depth', 'Requests waiting for an upstream fetch slot, by priority.', ['priority']);
+const admission_in_flight = registry.gauge('agent_admission_in_flight', 'Upstream fetches running.');
+const admission_rejections = registry.counter('agent_admission_rejections_total', 'Requests rejected by admission control, by reason.', ['reason']);
+
 // Setup Express
 const app = express();
 app.use(cors());
+app.use(track_requests);
+
+// When running behind a reverse proxy, set TRUST_PROXY (i.e., "loopback" or a number of hops) so req.ip is the
+// device's address rather than the proxy's. The address is passed to the API server to check access rules.
+if (process.env.TRUST_PROXY) {
+  app.set('trust proxy', /^[0-9]+$/.test(process.env.TRUST_PROXY) ? parseInt(process.env.TRUST_PROXY) : process.env.TRUST_PROXY);
+}
+app.get('/metrics', metrics_handler);
 
 // Setup axios
 const axios = aixos.create({
@@ -36,10 +63,189 @@ const axios = aixos.create({
   headers: {
     'Content-Type': 'application/json',
     'Accept': 'application/json',
-    'User-Agent': 'yealink-provision/Yealink Agent/1.0.0'
+    'User-Agent': 'yealink-provision/Yealink Agent/1.0.0',
+    // Lets the API server trust the client_ip sent with fetches (see the API server's access rules), and serve the
+    // known MACs filter.
+    ...(process.env.AGENT_TOKEN ? { 'X-Agent-Token': process.env.AGENT_TOKEN } : {}),
+  }
+});
+
+// Setup fast rejection, see lib/fast_reject.js.
+// The negative cache is cleared whenever the known MACs change, as a rejected device may have been added or fixed.
+const negativeCache = new NegativeCache({
+  ttl: (parseInt(process.env.NEGATIVE_CACHE_TTL) || 60) * 1000,
+});
+const failureThrottle = new FailureThrottle({
+  limit: parseInt(process.env.FAILURE_THROTTLE_LIMIT) || undefined,
+  window: (parseInt(process.env.FAILURE_THROTTLE_WINDOW) || 60) * 1000,
+});
+const knownMacs = new KnownMacs(axios, {
+  sync_interval: (parseInt(process.env.KNOWN_MACS_SYNC_INTERVAL) || 10) * 1000,
+  on_change: () => negativeCache.clear(),
+});
+
+// Serve the content directory (firmware, ring tones, ...), see lib/content.js.
+const contentServer = new ContentServer(process.env.CONTENT_DIR || 'content', {
+  max_file_bytes: parseInt(process.env.CONTENT_CACHE_MAX_FILE) || undefined,
+  max_cache_bytes: parseInt(process.env.CONTENT_CACHE_SIZE) || undefined,
+  max_concurrent_per_file: parseInt(process.env.CONTENT_MAX_CONCURRENT_PER_FILE) || undefined,
+});
+app.get('/content/*', contentServer.handler());
+
+registry.collect(() => {
+  const content = contentServer.status();
+  for (const result of ['cache_hits', 'cache_misses', 'streamed', 'not_modified', 'partial', 'rejected', 'not_found']) {
+    content_requests.set({ result: result }, content[result]);
+  }
+  content_cache_bytes.set({}, content.cache_bytes);
+  content_streaming.set({}, content.streaming);
+});
+
+// Setup admission control, see lib/admission.js. Rejected requests get a 503 with a Retry-After of
+// ADMISSION_RETRY_AFTER seconds, plus jitter.
+// Each worker has its own admission control, so ADMISSION_MAX_IN_FLIGHT and ADMISSION_MAX_QUEUE (for the whole agent)
+// are split between the workers.
+const ADMISSION_RETRY_AFTER = parseInt(process.env.ADMISSION_RETRY_AFTER) || 5;
+const per_worker = (total) => Math.max(Math.ceil(total / cluster_workers()), 1);
+const admission = new AdmissionControl({
+  max_in_flight: per_worker(parseInt(process.env.ADMISSION_MAX_IN_FLIGHT) || 50),
+  max_queue: per_worker(parseInt(process.env.ADMISSION_MAX_QUEUE) || 500),
+  max_wait: parseInt(process.env.ADMISSION_MAX_WAIT) || undefined,
+  observe_wait: (priority, seconds) => admission_wait.observe({ priority: priority }, seconds),
+});
+const seenMacs = new SeenMacs();
+
+registry.collect(() => {
+  const status = admission.status();
+  for (const priority of PRIORITIES) {
+    admission_queue_depth.set({ priority: priority }, status.queued[priority]);
+  }
+  admission_in_flight.set({}, status.in_flight);
+  for (const reason of ['queue_full', 'timeout', 'evicted']) {
+    admission_rejections.set({ reason: reason }, status[reason]);
   }
 });
 
+// Only failed authentications (wrong site password) count towards throttling, other rejections (unknown or disabled
+// devices, access rules) aren't something the phone can guess its way past.
+const is_credential_failure = (err) => {
+  return err.response && err.response.status == 403 && err.response.data &&
+    ['Incorrect password', 'Incorrect username'].includes(err.response.data.message);
+}
+
+// Only rejections that stay the same until a device is added (unknown MAC or common cfg) and failed authentications
+// are negatively cached. Disabled devices and access rules change without the known MACs changing, so they're asked
+// about every time.
+const is_cacheable_rejection = (err) => {
+  return is_credential_failure(err) || (err.response && err.response.status == 404 && err.response.data &&
+    ['No device with that MAC address was found', 'No model uses that common cfg file'].includes(err.response.data.message));
+}
+
+const reject_busy = (res) => {
+  res.set('Retry-After', retry_after_with_jitter(ADMISSION_RETRY_AFTER));
+  res.sendStatus(503);
+}
+
+// Render configuration in the compact format, [dotted key, value] pairs in order, as a cfg file with one pair per line.
+const render_cfg = (config) => {
+  const lines = ["#!version:1.0.0.1"];
+  for (const [key, value] of config) {
+    lines.push(`${key} = ${value}`);
+  }
+  return lines.join('\n') + '\n';
+}
+
+// Yealink phones put their MAC address at the end of their User-Agent, i.e., "Yealink SIP-T46U 108.86.0.20 80:5e:c0:aa:bb:cc".
+// Returns it in the same form as the cfg file name (uppercase, no separators), or null.
+const user_agent_mac = (req) => {
+  const match = /([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})\s*$/.exec(req.get('User-Agent') || '');
+  return match ? match[1].replace(/:/g, '').toUpperCase() : null;
+}
+
+// Common cfg files (i.e., y000000000123.cfg) hold the model's configuration, so it's left out of each <MAC>.cfg.
+// Set COMMON_CFG=false to serve the whole configuration in <MAC>.cfg instead.
+// The API server checks the site password against the site of the phone requesting the file, which is identified by the
+// MAC address in its User-Agent. <MAC>.cfg only leaves the model layer out for phones that were just served their
+// model's common file (see ServedCommonCfg), everyone else gets the whole configuration.
+const COMMON_CFG = process.env.COMMON_CFG != 'false';
+// Common cfg files are fetched at most once per model however many phones ask, so they're always first boot priority.
+const commonCfgCache = new CommonCfgCache(async (common_cfg, password, mac) => {
+  const release = await admission.acquire('first_boot');
+  if (!release) {
+    const err = new Error("rejected by admission control");
+    err.busy = true;
+    throw err;
+  }
+
+  try {
+    const response = await axios.get(`/fetch/model/${common_cfg}`, {
+      params: {
+        authentication_mode: 'site_pw',
+        password: password,
+        mac: mac,
+        format: 'compact',
+      }
+    });
+    upstream_fetches.inc({ status: response.status });
+
+    return render_cfg(response.data.config);
+  } finally {
+    release();
+  }
+}, {
+  ttl: (parseInt(process.env.COMMON_CFG_TTL) || 60) * 1000,
+});
+
+const servedCommonCfg = new ServedCommonCfg();
+
+const serve_common_cfg = async (req, res, common_cfg) => {
+  logger.debug(`Received request for common cfg ${common_cfg}.cfg`);
+
+  // Until this request succeeds, the phone's <MAC>.cfg includes the model layer.
+  const mac = user_agent_mac(req);
+  if (mac) servedCommonCfg.delete(mac);
+
+  if (!COMMON_CFG || !mac || negativeCache.get(req.params.sitepw, `${common_cfg}/${mac}`)) {
+    res.sendStatus(404);
+    return;
+  }
+
+  const retry_after = failureThrottle.blocked_for(req.ip, mac);
+  if (retry_after > 0) {
+    fast_rejections.inc({ reason: 'throttled' });
+    res.set('Retry-After', String(retry_after));
+    res.sendStatus(429);
+    return;
+  }
+
+  const end_upstream = phase_duration.start_timer({ phase: 'common_cfg' });
+  let body;
+  try {
+    body = await commonCfgCache.get(common_cfg, req.params.sitepw, mac);
+  } catch (err) {
+    if (err.busy) {
+      reject_busy(res);
+      return;
+    }
+
+    upstream_fetches.inc({ status: err.response ? err.response.status : 'error' });
+    if (is_cacheable_rejection(err)) {
+      negativeCache.set(req.params.sitepw, `${common_cfg}/${mac}`, err.response.status);
+    }
+    if (is_credential_failure(err)) failureThrottle.record_failure(req.ip, mac);
+
+    logger.debug(`Error fetching common cfg ${common_cfg} from API server: ${err.response ? err.response.status : err.message}`);
+    res.sendStatus(404);
+    return;
+  } finally {
+    end_upstream();
+  }
+
+  servedCommonCfg.set(mac, common_cfg);
+  res.set('Content-Type', 'text/plain');
+  res.send(body);
+}
+
 // Setup routes, handle "/cfg/[sitepw]/[MAC ADDRESS].cfg" requests.
 // This route uses site-based authentication with the site password in the URL.
 // This is supported in yealink-provision v1 due to the lack of support for device-based authentication.
@@ -51,6 +257,11 @@ app.get('/cfg/:sitepw/:mac', async (req, res) => {
     return;
   }
   const mac = req.params.mac.replace('.cfg', '');
+
+  if (/^y[0-9]{12}$/.test(mac)) {
+    await serve_common_cfg(req, res, mac);
+    return;
+  }
   
   if (mac.length != 12) {
     logger.debug("Received request for invalid mac address size.")
@@ -67,59 +278,106 @@ app.get('/cfg/:sitepw/:mac', async (req, res) => {
 
   logger.debug(`Received request for ${mac}.cfg`);
 
+  // Reject requests that can't succeed without calling the API server.
+  const retry_after = failureThrottle.blocked_for(req.ip, mac);
+  if (retry_after > 0) {
+    logger.debug(`Rejecting request from ${req.ip} for ${mac}.cfg, too many failed authentications.`);
+    fast_rejections.inc({ reason: 'throttled' });
+    res.set('Retry-After', String(retry_after));
+    res.sendStatus(429);
+    return;
+  }
+
+  if (!knownMacs.may_know(mac)) {
+    logger.debug(`Rejecting request for ${mac}.cfg, unknown MAC address.`);
+    fast_rejections.inc({ reason: 'unknown_mac' });
+    res.sendStatus(404);
+    return;
+  }
+
+  if (negativeCache.get(req.params.sitepw, mac)) {
+    logger.debug(`Rejecting request for ${mac}.cfg, recently rejected by the API server.`);
+    fast_rejections.inc({ reason: 'negative_cache' });
+    res.sendStatus(404);
+    return;
+  }
+
   logger.debug(`Site password: ${req.params.sitepw}`);
 
+  // Wait for an upstream fetch slot, phones this agent hasn't served yet go first.
+  const priority = seenMacs.has(mac) ? 'repoll' : 'first_boot';
+  const release = await admission.acquire(priority);
+  if (!release) {
+    logger.debug(`Rejecting request for ${mac}.cfg, too many upstream fetches (${priority}).`);
+    reject_busy(res);
+    return;
+  }
+
   // Fetch device from API server
+  const end_upstream = phase_duration.start_timer({ phase: 'upstream' });
   let data;
   await axios.get(`/fetch/device/${mac}`, {
     params: {
       authentication_mode: 'site_pw',
-      password: req.params.sitepw
+      password: req.params.sitepw,
+      client_ip: req.ip,
+      format: 'compact',
+      // The common cfg file served to this phone, the API server leaves the model layer out if it's the model's file.
+      exclude_common: COMMON_CFG ? servedCommonCfg.get(mac) : undefined,
     }
   }).then((response) => {
     data = response.data;
+    upstream_fetches.inc({ status: response.status });
 
   }).catch(err => {
-    logger.error(`Error fetching device ${mac} from API server: ${err.response.status} ${err.response.statusText}`);
-    logger.info(`Reason for failure: ${err.response.data.error} (${err.response.data.message})`)
+    upstream_fetches.inc({ status: err.response ? err.response.status : 'error' });
+    if (err.response) {
+      // The API server doesn't know the device or the password was wrong, don't ask again for a while.
+      if (is_cacheable_rejection(err)) {
+        negativeCache.set(req.params.sitepw, mac, err.response.status);
+      }
+      if (is_credential_failure(err)) failureThrottle.record_failure(req.ip, mac);
+
+      logger.error(`Error fetching device ${mac} from API server: ${err.response.status} ${err.response.statusText}`);
+      logger.info(`Reason for failure: ${err.response.data.error} (${err.response.data.message})`)
+    } else {
+      logger.error(`Error fetching device ${mac} from API server: ${err.message}`);
+    }
 
     res.sendStatus(404);
     return;
   });
  
+  release();
+  end_upstream();
   if (!data) return;
+  seenMacs.add(mac);
   
-  let yealink_configuration = "#!version:1.0.0.1\n";
-
-  // For every element (recursively) set the value in the configuration file, in the following format.
-  // key.key = value (where the nested keys are separated by a period)
-  // Do this asynchronously to avoid blocking the event loop.
-
-  const setConfig = async (obj, prefix) => {
-    for (const key in obj) {
-      if (typeof obj[key] === 'object') {
-        await setConfig(obj[key], `${prefix}${key}.`);
-      } else {
-        logger.debug(`${prefix}${key} = ${obj[key]}`)
-        yealink_configuration += `${prefix}${key} = ${obj[key]}\n`;
-      }
-    }
-  }
-  await setConfig(data.config, '');
+  const end_render = phase_duration.start_timer({ phase: 'render' });
+  // The configuration is requested in the compact format, already flattened into [dotted key, value] pairs
+  // in order, so each pair is one line of the cfg file: key.key = value
+  const yealink_configuration = render_cfg(data.config);
 
   logger.debug(yealink_configuration)
 
   res.set('Content-Type', 'text/plain');
 
   res.send(yealink_configuration);
+  end_render();
   logger.info("Response sent to device.")
   return;
 });
 
-// Start Express
-app.listen(process.env.PORT || 8080, () => {
-  logger.info(`Yealink Provisioning Agent listening on port ${process.env.PORT || 8080}`);
-});
+const main = () => {
+  knownMacs.start(logger);
+
+  // Start Express
+  app.listen(process.env.PORT || 8080, () => {
+    logger.info(`Yealink Provisioning Agent (pid ${process.pid}) listening on port ${process.env.PORT || 8080}`);
+  });
+}
+
+run(main, logger);
 
 // Start HTTPS server
 // https.createServer({
@@ -0,0 +1,132 @@
+// yealink-provision - Admission Control
+// Cameron Fleming 2023
+
+// Limits the number of upstream fetches to the API server running at once, so a boot storm (a whole building of
+// phones rebooting together) queues in the agent instead of overwhelming the API server and MongoDB.
+
+// Requests over max_in_flight wait in a bounded queue, for at most max_wait ms. There are two priorities: phones this
+// agent hasn't served yet (first boot, usually a person waiting for it) go before phones re-polling for changes.
+// When the queue is full a first boot request takes the place of the newest re-poll, otherwise the request is
+// rejected straight away, and the agent responds with a 503 and a jittered Retry-After so the phones spread out.
+
+// The limits are for this process only. With CLUSTER_WORKERS each worker has its own AdmissionControl, so the agent
+// splits its limits between them (see index.js).
+
+export const PRIORITIES = ['first_boot', 'repoll'];
+
+export class AdmissionControl {
+  constructor(options = {}) {
+    this.max_in_flight = options.max_in_flight || 50;
+    this.max_queue = options.max_queue || 500;
+    this.max_wait = options.max_wait || 10000;
+    // observe_wait(priority, seconds) is called when a request is admitted.
+    this.observe_wait = options.observe_wait || (() => {});
+
+    this.in_flight = 0;
+    this.queues = PRIORITIES.map(() => []);
+    this.stats = { admitted: 0, queue_full: 0, timeout: 0, evicted: 0 };
+  }
+
+  queued(priority) {
+    if (priority !== undefined) return this.queues[PRIORITIES.indexOf(priority)].length;
+    return this.queues.reduce((total, queue) => total + queue.length, 0);
+  }
+
+  // Wait for a slot. Resolves to a function that releases the slot, or null if the request was rejected.
+  acquire(priority) {
+    const level = PRIORITIES.indexOf(priority);
+
+    if (this.in_flight < this.max_in_flight && this.queued() == 0) {
+      this.observe_wait(priority, 0);
+      return Promise.resolve(this.admit());
+    }
+
+    if (this.queued() >= this.max_queue) {
+      const lower = this.queues.slice(level + 1).reverse().find((queue) => queue.length > 0);
+      if (!lower) {
+        this.stats.queue_full++;
+        return Promise.resolve(null);
+      }
+
+      const evicted = lower.pop();
+      clearTimeout(evicted.timer);
+      this.stats.evicted++;
+      evicted.resolve(null);
+    }
+
+    return new Promise((resolve) => {
+      const waiter = { priority: priority, resolve: resolve, queued_at: process.hrtime.bigint() };
+
+      waiter.timer = setTimeout(() => {
+        const queue = this.queues[level];
+        queue.splice(queue.indexOf(waiter), 1);
+        this.stats.timeout++;
+        resolve(null);
+      }, this.max_wait);
+
+      this.queues[level].push(waiter);
+    });
+  }
+
+  admit() {
+    this.in_flight++;
+    this.stats.admitted++;
+
+    let released = false;
+    return () => {
+      if (released) return;
+      released = true;
+
+      this.in_flight--;
+      this.next();
+    }
+  }
+
+  // Admit waiting requests, highest priority first, while there are free slots.
+  next() {
+    while (this.in_flight < this.max_in_flight) {
+      const queue = this.queues.find((queue) => queue.length > 0);
+      if (!queue) return;
+
+      const waiter = queue.shift();
+      clearTimeout(waiter.timer);
+      this.observe_wait(waiter.priority, Number(process.hrtime.bigint() - waiter.queued_at) / 1e9);
+      waiter.resolve(this.admit());
+    }
+  }
+
+  status() {
+    return {
+      ...this.stats,
+      in_flight: this.in_flight,
+      queued: Object.fromEntries(PRIORITIES.map((priority) => [priority, this.queued(priority)])),
+    };
+  }
+}
+
+// The MAC addresses this agent has served recently, least recently seen evicted first. A MAC that isn't here is
+// treated as a first boot.
+export class SeenMacs {
+  constructor(max_entries = 100000) {
+    this.max_entries = max_entries;
+    this.macs = new Set();
+  }
+
+  has(mac) {
+    return this.macs.has(mac.toUpperCase());
+  }
+
+  add(mac) {
+    mac = mac.toUpperCase();
+    this.macs.delete(mac);
+    this.macs.add(mac);
+
+    if (this.macs.size > this.max_entries) {
+      this.macs.delete(this.macs.values().next().value);
+    }
+  }
+}
+
+// Retry-After for a rejected request, in whole seconds: base plus up to the same again at random, so phones that were
+// rejected together don't all retry together.
+export const retry_after_with_jitter = (base) => String(base + Math.floor(Math.random() * (base + 1)));
@@ -0,0 +1,103 @@
+// yealink-provision - Common cfg Cache
+// Cameron Fleming 2023
+
+// Yealink phones request their model's common cfg file (i.e., y000000000123.cfg) before <MAC>.cfg. The common file
+// holds the model's configuration, which is the same for every phone of that model, so it's rendered once and kept
+// for ttl ms rather than fetched for each phone.
+
+// The API server still has to authenticate each site password, against the site of the phone requesting the file, so
+// the hashes of the passwords that were accepted are kept with the rendered file. Requests with another password, or
+// after the file expires, fetch it again. The file is the same for every site, so a password accepted for one phone
+// is accepted for the others.
+// Concurrent requests for a file that isn't cached share one fetch.
+
+import crypto from 'crypto';
+
+const hash_password = (password) => crypto.createHash('sha256').update(password).digest('hex');
+
+export class CommonCfgCache {
+  constructor(fetch, options = {}) {
+    // fetch(common_cfg, password, mac) resolves to the rendered file, or throws (with err.response for API errors).
+    this.fetch = fetch;
+    this.ttl = options.ttl || 60000;
+    this.max_entries = options.max_entries || 500;
+
+    this.entries = new Map();
+    this.pending = new Map();
+    this.stats = { hits: 0, misses: 0 };
+  }
+
+  async get(common_cfg, password, mac) {
+    const password_hash = hash_password(password);
+
+    const entry = this.entries.get(common_cfg);
+    if (entry && entry.expires > Date.now() && entry.passwords.has(password_hash)) {
+      this.stats.hits++;
+      return entry.body;
+    }
+
+    this.stats.misses++;
+
+    const key = `${common_cfg}/${password_hash}`;
+    if (this.pending.has(key)) {
+      return await this.pending.get(key);
+    }
+
+    const fetching = this.fetch(common_cfg, password, mac).then((body) => {
+      // Passwords accepted for the same content are kept together, a changed file starts again.
+      const current = this.entries.get(common_cfg);
+      const passwords = current && current.body == body && current.expires > Date.now() ? current.passwords : new Set();
+      passwords.add(password_hash);
+
+      this.entries.delete(common_cfg);
+      this.entries.set(common_cfg, { body: body, passwords: passwords, expires: Date.now() + this.ttl });
+      if (this.entries.size > this.max_entries) {
+        this.entries.delete(this.entries.keys().next().value);
+      }
+
+      return body;
+    }).finally(() => {
+      this.pending.delete(key);
+    });
+
+    this.pending.set(key, fetching);
+    return await fetching;
+  }
+
+  status() {
+    return { ...this.stats, entries: this.entries.size };
+  }
+}
+
+// The common cfg file this agent last served to each phone (by MAC address), so its <MAC>.cfg only leaves the model
+// layer out when the phone actually has that layer. A phone whose common cfg request failed (rejected, busy, unknown
+// model...), or was handled by another worker or agent, is served the whole configuration instead.
+export class ServedCommonCfg {
+  constructor(options = {}) {
+    this.ttl = options.ttl || 600000;
+    this.max_entries = options.max_entries || 100000;
+    this.entries = new Map();
+  }
+
+  set(mac, common_cfg) {
+    mac = mac.toUpperCase();
+    this.entries.delete(mac);
+    this.entries.set(mac, { common_cfg: common_cfg, expires: Date.now() + this.ttl });
+
+    if (this.entries.size > this.max_entries) {
+      this.entries.delete(this.entries.keys().next().value);
+    }
+  }
+
+  // The common cfg file name served to the MAC, or undefined.
+  get(mac) {
+    const entry = this.entries.get(mac.toUpperCase());
+    if (!entry || entry.expires < Date.now()) return undefined;
+
+    return entry.common_cfg;
+  }
+
+  delete(mac) {
+    this.entries.delete(mac.toUpperCase());
+  }
+}
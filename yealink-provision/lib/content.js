@@ -0,0 +1,193 @@
+// yealink-provision - Content Serving
+// Cameron Fleming 2023
+
+// Serves files from a content directory (firmware, ring tones, directories, ...) under /content/, so phones can
+// be pointed at the agent for everything they download.
+
+// - Small files (up to max_file_bytes) are kept in memory, up to max_cache_bytes in total, least recently used first.
+//   Each request still stats the file, so a changed file is read again.
+// - Larger files are streamed from disk with res.sendFile, without reading the whole file into memory.
+// - Both support conditional requests (ETag/Last-Modified) and single byte range requests, so a phone that was
+//   interrupted can resume a firmware download.
+// - During boot storms hundreds of phones may download the same firmware at once, so the number of concurrent
+//   downloads of each streamed file is limited, further requests get a 503 with Retry-After.
+
+import fs from 'fs';
+import path from 'path';
+
+export class ContentServer {
+  constructor(root, options = {}) {
+    this.root = path.resolve(root);
+    this.max_file_bytes = options.max_file_bytes || 256 * 1024;
+    this.max_cache_bytes = options.max_cache_bytes || 64 * 1024 * 1024;
+    this.max_concurrent_per_file = options.max_concurrent_per_file || 50;
+    this.retry_after = options.retry_after || 10;
+
+    this.cache = new Map();
+    this.cache_bytes = 0;
+    this.in_flight = new Map();
+    this.stats = { cache_hits: 0, cache_misses: 0, streamed: 0, not_modified: 0, partial: 0, rejected: 0, not_found: 0 };
+  }
+
+  // Resolve a request path inside the content directory, or null if it's outside it or hidden.
+  resolve(request_path) {
+    if (request_path.includes('\0')) return null;
+    if (request_path.split(/[\\/]/).some((segment) => segment.startsWith('.'))) return null;
+
+    const file = path.join(this.root, request_path);
+    const relative = path.relative(this.root, file);
+    if (!relative || relative.startsWith('..') || path.isAbsolute(relative)) return null;
+
+    return file;
+  }
+
+  cache_get(file, stat) {
+    const entry = this.cache.get(file);
+    if (!entry) return null;
+
+    this.cache.delete(file);
+    if (entry.size != stat.size || entry.mtime != stat.mtimeMs) {
+      this.cache_bytes -= entry.size;
+      return null;
+    }
+
+    this.cache.set(file, entry);
+    return entry.data;
+  }
+
+  cache_set(file, stat, data) {
+    const existing = this.cache.get(file);
+    if (existing) {
+      this.cache.delete(file);
+      this.cache_bytes -= existing.size;
+    }
+
+    this.cache.set(file, { size: stat.size, mtime: stat.mtimeMs, data: data });
+    this.cache_bytes += data.length;
+
+    while (this.cache_bytes > this.max_cache_bytes) {
+      const [oldest, entry] = this.cache.entries().next().value;
+      this.cache.delete(oldest);
+      this.cache_bytes -= entry.size;
+    }
+  }
+
+  // Send a cached file, handling conditional and range requests.
+  send_buffer(req, res, file, stat, data) {
+    const etag = `"${stat.size.toString(16)}-${Math.floor(stat.mtimeMs).toString(16)}"`;
+
+    res.set('ETag', etag);
+    res.set('Last-Modified', stat.mtime.toUTCString());
+    res.set('Accept-Ranges', 'bytes');
+    res.type(path.extname(file) || 'application/octet-stream');
+
+    if (req.fresh) {
+      this.stats.not_modified++;
+      res.status(304).end();
+      return;
+    }
+
+    // If-Range only applies the range if the file hasn't changed, otherwise the whole file is sent.
+    let ranges = req.headers.range ? req.range(data.length) : undefined;
+    const if_range = req.headers['if-range'];
+    if (ranges && if_range && if_range != etag && !(Date.parse(if_range) >= Math.floor(stat.mtimeMs / 1000) * 1000)) {
+      ranges = undefined;
+    }
+
+    if (ranges === -1) {
+      res.set('Content-Range', `bytes */${data.length}`);
+      res.status(416).end();
+      return;
+    }
+
+    // Multiple ranges aren't supported, the whole file is sent instead.
+    if (Array.isArray(ranges) && ranges.type == 'bytes' && ranges.length == 1) {
+      const { start, end } = ranges[0];
+      this.stats.partial++;
+      res.status(206);
+      res.set('Content-Range', `bytes ${start}-${end}/${data.length}`);
+      res.send(data.subarray(start, end + 1));
+      return;
+    }
+
+    res.send(data);
+  }
+
+  // Express handler, expects the path inside the content directory as req.params[0] (i.e., app.get('/content/*')).
+  handler() {
+    return async (req, res) => {
+      const file = this.resolve(req.params[0] || '');
+
+      let stat = null;
+      if (file) {
+        stat = await fs.promises.stat(file).catch(() => null);
+      }
+
+      if (!stat || !stat.isFile()) {
+        this.stats.not_found++;
+        res.sendStatus(404);
+        return;
+      }
+
+      if (stat.size <= this.max_file_bytes) {
+        let data = this.cache_get(file, stat);
+        if (data) {
+          this.stats.cache_hits++;
+        } else {
+          // The file may have been removed between the stat and the read.
+          data = await fs.promises.readFile(file).catch(() => null);
+          if (!data) {
+            this.stats.not_found++;
+            res.sendStatus(404);
+            return;
+          }
+
+          this.stats.cache_misses++;
+          // The file may have changed between the stat and the read, only cache it if it's the size we expected.
+          if (data.length == stat.size) this.cache_set(file, stat, data);
+        }
+
+        this.send_buffer(req, res, file, stat, data);
+        return;
+      }
+
+      const in_flight = this.in_flight.get(file) || 0;
+      if (in_flight >= this.max_concurrent_per_file) {
+        this.stats.rejected++;
+        res.set('Retry-After', String(this.retry_after));
+        res.sendStatus(503);
+        return;
+      }
+
+      this.in_flight.set(file, in_flight + 1);
+      res.once('close', () => {
+        const remaining = this.in_flight.get(file) - 1;
+        if (remaining > 0) {
+          this.in_flight.set(file, remaining);
+        } else {
+          this.in_flight.delete(file);
+        }
+      });
+
+      this.stats.streamed++;
+      res.sendFile(file, { dotfiles: 'deny' }, (err) => {
+        if (err) {
+          if (!res.headersSent) res.sendStatus(err.status || 500);
+          return;
+        }
+
+        if (res.statusCode == 206) this.stats.partial++;
+        if (res.statusCode == 304) this.stats.not_modified++;
+      });
+    }
+  }
+
+  status() {
+    return {
+      ...this.stats,
+      cached_files: this.cache.size,
+      cache_bytes: this.cache_bytes,
+      streaming: [...this.in_flight.values()].reduce((total, count) => total + count, 0),
+    };
+  }
+}
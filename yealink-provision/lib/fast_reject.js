@@ -0,0 +1,152 @@
+// yealink-provision - Fast Rejection
+// Cameron Fleming 2023
+
+// Requests that will never succeed (scanners, misconfigured or removed phones) are rejected by the agent without
+// calling the API server:
+// - KnownMacs keeps a Bloom filter of every MAC address the API server knows, synced from /fetch/known_macs.
+//   Until the first sync succeeds every MAC is let through.
+// - NegativeCache remembers requests the API server rejected, for a short time.
+// - FailureThrottle counts failed authentications per source address and MAC address, and blocks a pair with too
+//   many. Phones at a site usually share an address (NAT), so one misconfigured phone only throttles itself.
+
+import crypto from 'crypto';
+
+import { BloomFilter } from '../../shared/bloom.js';
+
+export class KnownMacs {
+  constructor(axios, options = {}) {
+    this.axios = axios;
+    this.sync_interval = options.sync_interval || 30000;
+    this.on_change = options.on_change || (() => {});
+
+    this.filter = null;
+    this.etag = null;
+    this.timer = null;
+    this.stats = { syncs: 0, failed_syncs: 0, count: 0 };
+  }
+
+  start(logger) {
+    if (this.timer) return;
+    this.logger = logger;
+
+    this.sync();
+    this.timer = setInterval(() => this.sync(), this.sync_interval);
+    this.timer.unref();
+  }
+
+  async sync() {
+    try {
+      const response = await this.axios.get('/fetch/known_macs', {
+        headers: this.etag ? { 'If-None-Match': this.etag } : {},
+        validateStatus: (status) => status == 200 || status == 304,
+      });
+
+      this.stats.syncs++;
+      if (response.status == 304) return;
+
+      this.filter = BloomFilter.from_json(response.data);
+      this.etag = response.headers['etag'] || null;
+      this.stats.count = response.data.count;
+      this.on_change();
+
+      if (this.logger) this.logger.debug(`fast_reject: synced known MACs filter, ${response.data.count} devices.`);
+    } catch (err) {
+      // Keep using the last filter, the API server may only be briefly unavailable.
+      this.stats.failed_syncs++;
+      if (this.logger) this.logger.error(`fast_reject: failed to sync known MACs filter: ${err.message}`);
+    }
+  }
+
+  // False if the MAC is definitely unknown, true if it may be known (or there's no filter yet).
+  may_know(mac) {
+    return !this.filter || this.filter.has(mac.toUpperCase());
+  }
+}
+
+// Expiring entries in a Map, the oldest entry is evicted when full (Maps iterate in insertion order).
+export class NegativeCache {
+  constructor(options = {}) {
+    this.ttl = options.ttl || 60000;
+    this.max_entries = options.max_entries || 10000;
+    this.entries = new Map();
+  }
+
+  // Site passwords are part of the key, so only their hash is kept.
+  key(sitepw, mac) {
+    return `${crypto.createHash('sha256').update(sitepw).digest('hex')}/${mac.toUpperCase()}`;
+  }
+
+  get(sitepw, mac) {
+    const key = this.key(sitepw, mac);
+    const entry = this.entries.get(key);
+    if (!entry) return null;
+
+    if (entry.expires < Date.now()) {
+      this.entries.delete(key);
+      return null;
+    }
+
+    return entry.status;
+  }
+
+  set(sitepw, mac, status) {
+    const key = this.key(sitepw, mac);
+    this.entries.delete(key);
+    if (this.entries.size >= this.max_entries) {
+      this.entries.delete(this.entries.keys().next().value);
+    }
+
+    this.entries.set(key, { status: status, expires: Date.now() + this.ttl });
+  }
+
+  clear() {
+    this.entries.clear();
+  }
+}
+
+// Fixed window failure counts per source address and MAC address.
+export class FailureThrottle {
+  constructor(options = {}) {
+    this.limit = options.limit || 20;
+    this.window = options.window || 60000;
+    this.max_sources = options.max_sources || 10000;
+    this.sources = new Map();
+  }
+
+  key(ip, mac) {
+    return `${ip}/${mac.toUpperCase()}`;
+  }
+
+  current(source) {
+    const entry = this.sources.get(source);
+    if (entry && entry.reset < Date.now()) {
+      this.sources.delete(source);
+      return null;
+    }
+
+    return entry;
+  }
+
+  // Seconds until the source can make requests for the MAC again, or 0 if it isn't throttled.
+  blocked_for(ip, mac) {
+    const entry = this.current(this.key(ip, mac));
+    if (!entry || entry.failures < this.limit) return 0;
+
+    return Math.ceil((entry.reset - Date.now()) / 1000);
+  }
+
+  record_failure(ip, mac) {
+    const source = this.key(ip, mac);
+    let entry = this.current(source);
+    if (!entry) {
+      if (this.sources.size >= this.max_sources) {
+        this.sources.delete(this.sources.keys().next().value);
+      }
+
+      entry = { failures: 0, reset: Date.now() + this.window };
+      this.sources.set(source, entry);
+    }
+
+    entry.failures++;
+  }
+}